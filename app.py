@@ -2,16 +2,46 @@ import os
 # 解决 protobuf 版本兼容性问题（Streamlit Cloud 部署必需）
 os.environ["PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION"] = "python"
 
-import streamlit as st
+from startup_profile import STARTUP_PROFILE, lazy_module
+
+with STARTUP_PROFILE.measure("streamlit", "import"):
+    import streamlit as st
 import json
 import re
 import time
-import requests
 import base64
+import hashlib
+import threading
+import functools
 from datetime import datetime
-from langchain_community.vectorstores import Chroma
-from langchain_community.embeddings import HuggingFaceEmbeddings
-import numpy as np
+with STARTUP_PROFILE.measure("项目模块", "import"):
+    from turn_pipeline import TurnPipeline
+    from job_queue import JobQueue
+    from embeddings import EmbeddingRegistry, QueryEmbedder, TurnEmbeddingContext, EMBEDDING_THREADS
+    from rewrite_gate import RewriteGate
+    from segmenter import Segmenter
+    from conversation_store import open_conversation_store
+    from json_cache import JSONFileCache
+    from history_window import HistoryWindowPolicy
+    from token_counter import TokenCounter
+    from context_packer import ContextPacker, hybrid_relevance
+    from warmup import Warmup
+
+# 重依赖按需导入：登录页用不到向量库、模型、numpy 和 HTTP 客户端，第一次使用时才导入
+np = lazy_module("numpy")
+requests = lazy_module("requests")
+vectorstores = lazy_module("langchain_community.vectorstores")
+hf_embeddings = lazy_module("langchain_community.embeddings")
+deepseek_client = lazy_module("deepseek_client")
+sufficiency = lazy_module("sufficiency")
+bm25_engine = lazy_module("bm25_engine")
+dedup = lazy_module("dedup")
+
+# ------------------- 小文件读穿缓存 -------------------
+@st.cache_resource
+def get_json_cache():
+    """进程级 JSON 缓存：api_keys.json、memory_*.json、summaries_*.json 按 mtime/size 失效"""
+    return JSONFileCache()
 
 # ------------------- API Key 配置文件（定义在路径配置之后） -------------------
 API_KEY_FILE = None  # 稍后初始化
@@ -26,14 +56,10 @@ def save_api_key(username, api_key):
     try:
         # 简单 base64 编码（防止明文泄露，非真正加密）
         encoded = base64.b64encode(api_key.encode()).decode()
-        if os.path.exists(API_KEY_FILE):
-            with open(API_KEY_FILE, "r", encoding="utf-8") as f:
-                data = json.load(f)
-        else:
-            data = {}
+        cache = get_json_cache()
+        data = cache.read(API_KEY_FILE, default={})
         data[username] = encoded
-        with open(API_KEY_FILE, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False)
+        cache.write(API_KEY_FILE, data, indent=None)
         return True
     except Exception as e:
         st.error(f"保存 API Key 失败: {str(e)}")
@@ -42,9 +68,8 @@ def save_api_key(username, api_key):
 def load_api_key(username):
     """加载用户的 API Key"""
     try:
-        if API_KEY_FILE and os.path.exists(API_KEY_FILE):
-            with open(API_KEY_FILE, "r", encoding="utf-8") as f:
-                data = json.load(f)
+        if API_KEY_FILE:
+            data = get_json_cache().read(API_KEY_FILE, default={})
             if username in data:
                 encoded = data[username]
                 return base64.b64decode(encoded.encode()).decode()
@@ -55,13 +80,12 @@ def load_api_key(username):
 def delete_api_key(username):
     """删除用户的 API Key"""
     try:
-        if API_KEY_FILE and os.path.exists(API_KEY_FILE):
-            with open(API_KEY_FILE, "r", encoding="utf-8") as f:
-                data = json.load(f)
+        if API_KEY_FILE:
+            cache = get_json_cache()
+            data = cache.read(API_KEY_FILE, default={})
             if username in data:
                 del data[username]
-                with open(API_KEY_FILE, "w", encoding="utf-8") as f:
-                    json.dump(data, f, ensure_ascii=False)
+                cache.write(API_KEY_FILE, data, indent=None)
         return True
     except Exception:
         return False
@@ -107,14 +131,14 @@ def call_deepseek_api_retry(
     
     for attempt in range(max_retries):
         try:
-            response = requests.post(
+            # 走进程级连接池，复用已建立的 TCP/TLS 连接
+            response_json = deepseek_client.get_deepseek_client().post_json(
                 f"{DEEPSEEK_API_BASE}/chat/completions",
                 headers=headers,
-                json=json_data,
+                json_data=json_data,
                 timeout=timeout
             )
-            response.raise_for_status()
-            result = response.json()["choices"][0]["message"]["content"].strip()
+            result = response_json["choices"][0]["message"]["content"].strip()
             return result
             
         except requests.exceptions.Timeout:
@@ -157,8 +181,19 @@ DEEPSEEK_API_BASE = "https://api.deepseek.com/v1"
 CONVERSATIONS_DIR = "./conversations"
 CHROMA_DIR = "./models/ruitongkeji"
 HISTORY_CHROMA_DIR = "./models/history_vectorstore"  # 历史对话向量库
+BM25_INDEX_DIR = "./models/bm25_index"  # 持久化 BM25 倒排索引（自动生成，分词器或词典变化时重建）
+DOMAIN_LEXICON_PATH = "./models/domain_lexicon.txt"  # 领域词典（产品名、光学术语等）
+DEEPSEEK_TOKENIZER_PATH = "./models/deepseek_tokenizer"  # DeepSeek 分词器（tokenizer.json），用于 token 计数
+EMBEDDING_MODEL_NAME = "BAAI/bge-small-zh-v1.5"  # 知识库和历史库共用的向量模型
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "pytorch")  # pytorch 或 onnx（ONNX Runtime，按 CPU 选量化版本）
+EMBEDDING_ONNX_DIR = os.getenv("EMBEDDING_ONNX_DIR", "./models/bge-small-zh-v1.5")  # onnx_embeddings.py export 的输出目录
 MEMORY_MAX_FACTS = 30
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "3"))  # 内存中最多保留的会话数（含当前会话）
+SESSIONS_PER_PAGE = int(os.getenv("SESSIONS_PER_PAGE", "20"))  # 侧边栏每页显示的会话数
+CHAT_WINDOW_SIZE = int(os.getenv("CHAT_WINDOW_SIZE", "20"))  # 聊天区默认只渲染最近这么多条消息
 SESSION_SUMMARY_THRESHOLD = 10  # 触发摘要的对话轮数
+HISTORY_RELEVANCE_WEIGHT = 0.8  # 历史检索结果的相关度折算系数（知识库优先）
+ROLLING_SUMMARY_BATCH = 4  # 滚动摘要：未摘要的消息攒够这么多条才折叠进摘要
 
 os.makedirs(CONVERSATIONS_DIR, exist_ok=True)
 init_api_key_file()  # 初始化 API Key 文件路径
@@ -169,80 +204,125 @@ def is_valid_username(username):
     return bool(re.match(r'^[a-zA-Z0-9_]+$', username))
 
 # ------------------- 会话持久化 -------------------
-def save_conversations(username):
+CONVERSATION_STORE_BACKEND = os.getenv("CONVERSATION_STORE", "sqlite")  # sqlite（单库 WAL）或 jsonl（每会话追加日志）
+
+@st.cache_resource
+@STARTUP_PROFILE.timed("对话存储")
+def get_conversation_store():
+    """进程级对话存储：只写变化的消息，按会话读取"""
+    return open_conversation_store(CONVERSATION_STORE_BACKEND, CONVERSATIONS_DIR)
+
+def legacy_conversations_path(username):
+    return os.path.join(CONVERSATIONS_DIR, f"conversations_{username}.json")
+
+def migrate_legacy_conversations(username):
+    """把旧版 conversations_{username}.json 导入存储，导入后重命名为 .imported 避免重复导入"""
+    path = legacy_conversations_path(username)
+    if not os.path.exists(path):
+        return 0
+    store = get_conversation_store()
+    count = 0
+    if not store.list_sessions(username):
+        count = store.import_json(username, path)
+    os.replace(path, f"{path}.imported")
+    return count
+
+def list_conversation_users():
+    """已有用户：存储中的用户 + 尚未导入的旧版文件"""
+    users = set(get_conversation_store().list_users())
+    users.update(
+        f.replace("conversations_", "").replace(".json", "")
+        for f in os.listdir(CONVERSATIONS_DIR)
+        if f.startswith("conversations_") and f.endswith(".json")
+    )
+    return sorted(users)
+
+def save_conversations(username, session_id=None):
+    """增量保存：指定 session_id 时只比对该会话，否则比对内存中已加载的全部会话"""
     try:
-        path = os.path.join(CONVERSATIONS_DIR, f"conversations_{username}.json")
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(st.session_state.conversations, f, ensure_ascii=False, indent=2)
+        store = get_conversation_store()
+        session_ids = [session_id] if session_id is not None else list(st.session_state.conversations)
+        for sid in session_ids:
+            session = st.session_state.conversations.get(sid)
+            if session is not None:
+                store.save_session(username, sid, session)
     except Exception as e:
         st.error(f"保存对话失败: {str(e)}")
 
-def load_conversations(username):
+def load_session_index(username):
+    """会话元数据列表（不含消息），最近更新的在前：[{"session_id", "title", "updated_at", "message_count"}, ...]"""
     try:
-        path = os.path.join(CONVERSATIONS_DIR, f"conversations_{username}.json")
-        if os.path.exists(path):
-            with open(path, "r", encoding="utf-8") as f:
-                return json.load(f)
-        else:
-            st.warning(f"未找到 {path}")
+        migrate_legacy_conversations(username)
+        sessions = get_conversation_store().list_sessions(username)
+        sessions.sort(key=lambda m: m.get("updated_at") or "", reverse=True)
+        return sessions
     except Exception as e:
-        st.error(f"加载对话失败: {str(e)}")
-    return {}
+        st.error(f"加载对话列表失败: {str(e)}")
+    return []
+
+def open_session(username, session_id):
+    """
+    切换到会话时才加载它的消息；st.session_state.conversations 只保留当前会话
+    和最近使用的 SESSION_CACHE_SIZE 个会话，其余的从内存中移除（消息已在每次修改时保存）
+    """
+    conversations = st.session_state.conversations
+    if session_id not in conversations:
+        session = load_session_from_json(username, session_id)
+        if session is None:
+            return None
+        session.pop("session_id", None)
+        conversations[session_id] = session
+    
+    recent = [sid for sid in st.session_state.get("recent_sessions", []) if sid != session_id]
+    recent.insert(0, session_id)
+    for sid in recent[SESSION_CACHE_SIZE:]:
+        if sid != st.session_state.get("current_session"):
+            conversations.pop(sid, None)
+    st.session_state.recent_sessions = recent[:SESSION_CACHE_SIZE]
+    return conversations[session_id]
+
+def create_session(username, session_id, title):
+    """新建会话（含 system prompt 和欢迎语）并立即保存"""
+    st.session_state.conversations[session_id] = {
+        "title": title,
+        "messages": [
+            {"role": "system", "content": build_system_prompt(username)},
+            {"role": "assistant", "content": "你好，我是小锐助手，有什么需要帮助的吗？"}
+        ]
+    }
+    st.session_state.current_session = session_id
+    open_session(username, session_id)
+    save_conversations(username, session_id)
 
 def delete_session(username, session_id):
     """删除指定会话"""
-    path = os.path.join(CONVERSATIONS_DIR, f"conversations_{username}.json")
     try:
-        if os.path.exists(path):
-            with open(path, "r", encoding="utf-8") as f:
-                data = json.load(f)
+        if get_conversation_store().delete_session(username, session_id):
+            # 同时删除该会话的摘要
+            update_summary_index(username, session_id, None)
             
-            if session_id in data:
-                # 删除会话
-                del data[session_id]
-                
-                # 保存更新后的数据
-                with open(path, "w", encoding="utf-8") as f:
-                    json.dump(data, f, ensure_ascii=False, indent=2)
-                
-                # 同时删除向量库中该会话的摘要
-                summary_path = os.path.join(CONVERSATIONS_DIR, f"summary_{session_id}.json")
-                if os.path.exists(summary_path):
-                    os.remove(summary_path)
-                
-                # 删除历史向量库中该会话的数据
-                history_vs = load_history_vectorstore()
-                if history_vs:
-                    try:
-                        history_vs.delete(filter={"session_id": session_id})
-                    except:
-                        pass
-                
-                return True, "删除成功"
-            else:
-                return False, "会话不存在"
+            # 删除历史向量库中该会话的数据（session_id 在用户之间可能重复，按用户限定）
+            history_vs = load_history_vectorstore()
+            if history_vs:
+                try:
+                    history_vs.delete(filter={"$and": [{"username": username}, {"session_id": session_id}]})
+                except:
+                    pass
+            
+            return True, "删除成功"
         else:
-            return False, "对话文件不存在"
+            return False, "会话不存在"
     except Exception as e:
         return False, f"删除失败: {str(e)}"
 
 def delete_user(username):
-    path = os.path.join(CONVERSATIONS_DIR, f"conversations_{username}.json")
+    path = legacy_conversations_path(username)
     mem_path = os.path.join(CONVERSATIONS_DIR, f"memory_{username}.json")
     try:
-        # 删除基础文件
-        for p in [path, mem_path]:
-            if os.path.exists(p):
-                os.remove(p)
-        
-        # 删除该用户的历史摘要文件
-        for f in os.listdir(CONVERSATIONS_DIR):
-            if f.startswith("summary_") and f.endswith(".json"):
-                summary_path = os.path.join(CONVERSATIONS_DIR, f)
-                with open(summary_path, "r", encoding="utf-8") as fp:
-                    data = json.load(fp)
-                    if data.get("session_id", "").startswith(username):
-                        os.remove(summary_path)
+        get_conversation_store().delete_user(username)
+        # 删除基础文件（含未导入或已导入的旧版对话文件、会话摘要索引）
+        for p in [path, f"{path}.imported", mem_path, summary_index_path(username)]:
+            get_json_cache().delete(p)
         
         # 删除历史向量库中该用户的数据
         history_vs = load_history_vectorstore()
@@ -260,31 +340,139 @@ def delete_user(username):
     except Exception as e:
         st.error(f"删除用户 {username} 失败: {str(e)}")
 
+# ------------------- 会话摘要索引（每个用户一个文件） -------------------
+SUMMARY_INDEX_LOCK = threading.Lock()  # 后台摘要任务与前台删除会话并发写同一索引
+
+def summary_index_path(username):
+    return os.path.join(CONVERSATIONS_DIR, f"summaries_{username}.json")
+
+def migrate_legacy_summaries(username):
+    """
+    旧版按会话存放的 summary_{session_id}.json（不含用户名）：按该用户现有的会话导入
+    旧文件没有记录所属用户，会话 id 同时属于其他用户（如共用的 "default"）时无法判断归属，跳过不导入
+    返回 (摘要字典, 已导入的文件路径列表)
+    """
+    store = get_conversation_store()
+    legacy_paths = {}
+    for meta in store.list_sessions(username):
+        legacy_path = os.path.join(CONVERSATIONS_DIR, f"summary_{meta['session_id']}.json")
+        if os.path.exists(legacy_path):
+            legacy_paths[meta["session_id"]] = legacy_path
+    if not legacy_paths:
+        return {}, []
+    
+    shared = set()
+    for other in store.list_users():
+        if other != username:
+            shared.update(m["session_id"] for m in store.list_sessions(other) if m["session_id"] in legacy_paths)
+    
+    sessions, imported = {}, []
+    for session_id, legacy_path in legacy_paths.items():
+        if session_id in shared:
+            continue
+        try:
+            with open(legacy_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            data.pop("session_id", None)
+            sessions[session_id] = data
+            imported.append(legacy_path)
+        except Exception:
+            continue
+    return sessions, imported
+
+def load_summary_index(username):
+    """读取用户的会话摘要索引 {session_id: {"summary", "watermark", "updated_at", ...}}"""
+    path = summary_index_path(username)
+    if not os.path.exists(path):
+        with SUMMARY_INDEX_LOCK:
+            if not os.path.exists(path):
+                sessions, imported = migrate_legacy_summaries(username)
+                write_summary_index(username, sessions)
+                # 索引写入后再重命名旧文件，之后不会再被任何用户导入
+                for legacy_path in imported:
+                    try:
+                        os.replace(legacy_path, f"{legacy_path}.migrated")
+                    except OSError:
+                        pass
+                return sessions
+    try:
+        return get_json_cache().read(path, default={}).get("sessions", {})
+    except Exception:
+        return {}
+
+def write_summary_index(username, sessions):
+    """整体写入索引（先写临时文件再替换）；调用方需持有 SUMMARY_INDEX_LOCK"""
+    get_json_cache().write(summary_index_path(username), {"username": username, "sessions": sessions})
+
+def update_summary_index(username, session_id, entry=None):
+    """写入或删除（entry=None）一个会话的摘要"""
+    load_summary_index(username)  # 确保旧版摘要已导入
+    with SUMMARY_INDEX_LOCK:
+        try:
+            sessions = get_json_cache().read(summary_index_path(username), default={}).get("sessions", {})
+        except Exception:
+            sessions = {}
+        if entry is None:
+            if sessions.pop(session_id, None) is None:
+                return
+        else:
+            # 合并写入：摘要和历史窗口状态各自只更新自己的字段
+            sessions[session_id] = {**sessions.get(session_id, {}), **entry}
+        write_summary_index(username, sessions)
+
+def get_user_summaries(username):
+    """获取用户所有会话摘要（含session_id），按更新时间升序（最近的在最后）"""
+    sessions = load_summary_index(username)
+    summaries = [
+        {"summary": data["summary"], "session_id": session_id, "updated_at": data.get("updated_at", "")}
+        for session_id, data in sessions.items()
+        if data.get("summary")
+    ]
+    summaries.sort(key=lambda s: s["updated_at"])
+    return summaries
+
 # ------------------- 长期记忆 -------------------
 def load_long_term_memory(username):
     path = os.path.join(CONVERSATIONS_DIR, f"memory_{username}.json")
-    if os.path.exists(path):
-        with open(path, "r", encoding="utf-8") as f:
-            return json.load(f).get("facts", [])
-    return []
+    return get_json_cache().read(path, default={}).get("facts", [])
 
 def save_long_term_memory(username, facts):
     path = os.path.join(CONVERSATIONS_DIR, f"memory_{username}.json")
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump({
-            "updated_at": datetime.now().isoformat(timespec="seconds"),
-            "facts": facts[-MEMORY_MAX_FACTS:]
-        }, f, ensure_ascii=False, indent=2)
+    get_json_cache().write(path, {
+        "updated_at": datetime.now().isoformat(timespec="seconds"),
+        "facts": facts[-MEMORY_MAX_FACTS:]
+    })
+
+# ------------------- 共享向量模型 -------------------
+def create_embedding_model(model_name):
+    """按 EMBEDDING_BACKEND 创建编码器；ONNX 模型不可用时退回 PyTorch"""
+    if EMBEDDING_BACKEND == "onnx":
+        try:
+            from onnx_embeddings import OnnxEmbeddings
+            return OnnxEmbeddings(EMBEDDING_ONNX_DIR, threads=EMBEDDING_THREADS)
+        except Exception as e:
+            st.warning(f"ONNX 向量模型加载失败，改用 PyTorch: {e}")
+    return hf_embeddings.HuggingFaceEmbeddings(model_name=model_name)
+
+@st.cache_resource
+def get_embedding_registry():
+    """进程级向量模型注册表（线程数 EMBEDDING_THREADS，批大小 EMBEDDING_BATCH_SIZE）"""
+    return EmbeddingRegistry(create_embedding_model)
+
+@STARTUP_PROFILE.timed("向量模型")
+def get_embeddings():
+    """知识库和历史库共用的编码器，模型只加载一次"""
+    return get_embedding_registry().get(EMBEDDING_MODEL_NAME)
 
 # ------------------- 历史对话向量库 -------------------
 @st.cache_resource
+@STARTUP_PROFILE.timed("历史向量库")
 def load_history_vectorstore():
     """加载用户历史对话向量库"""
     try:
-        embeddings = HuggingFaceEmbeddings(model_name="BAAI/bge-small-zh-v1.5")
-        history_vs = Chroma(
+        history_vs = vectorstores.Chroma(
             persist_directory=HISTORY_CHROMA_DIR, 
-            embedding_function=embeddings,
+            embedding_function=get_embeddings(),
             collection_name="history"
         )
         return history_vs
@@ -292,101 +480,278 @@ def load_history_vectorstore():
         st.warning(f"历史向量库加载失败: {e}")
         return None
 
-def generate_session_summary(session_messages, session_id):
-    """生成会话摘要"""
-    dialogue = [m for m in session_messages if m["role"] in ("user", "assistant")]
-    if len(dialogue) < SESSION_SUMMARY_THRESHOLD:
-        return None
-    
-    dialogue_text = "\n".join(
+def format_dialogue(dialogue):
+    """把对话消息拼接成「用户/助手: 内容」文本"""
+    return "\n".join(
         f"{'用户' if m['role']=='user' else '助手'}: {m['content']}"
         for m in dialogue
     )
+
+def message_fingerprint(message):
+    """消息指纹，用于判断摘要水位线之前的对话是否被编辑过"""
+    return hashlib.md5(f"{message['role']}:{message['content']}".encode("utf-8")).hexdigest()
+
+def load_session_summary_state(username, session_id, dialogue=None):
+    """
+    读取会话的滚动摘要状态：{"summary", "watermark"}
+    watermark 为已折叠进摘要的对话消息数；传入 dialogue 时校验水位线，
+    对话被编辑/重新生成导致不一致时返回 None（需要重新摘要）
+    """
+    data = load_summary_index(username).get(session_id)
+    if not data:
+        return None
     
-    prompt = (
-        f"请将以下对话压缩成一个300字以内的摘要，包含：\n"
-        f"1. 讨论的主题或核心话题\n"
-        f"2. 用户的核心需求或问题\n"
-        f"3. 达成的结论或关键信息\n"
-        f"4. 用户的偏好或关注点（如有）\n\n"
-        f"对话内容：\n{dialogue_text}"
-    )
+    # 旧格式没有 watermark，用 message_count 代替
+    watermark = data.get("watermark", data.get("message_count", 0))
+    if dialogue is not None:
+        if watermark > len(dialogue):
+            return None
+        boundary_hash = data.get("watermark_hash")
+        if boundary_hash and watermark > 0 and message_fingerprint(dialogue[watermark - 1]) != boundary_hash:
+            return None
+    return {"summary": data.get("summary", ""), "watermark": watermark, "created_at": data.get("created_at")}
+
+def generate_session_summary(username, session_messages, session_id, api_key=None, min_new_messages=1,
+                             raise_on_failure=False):
+    """
+    生成会话摘要（增量）：只把水位线之后的新对话折叠进已有摘要
+    新增消息少于 min_new_messages 时直接返回缓存的摘要，不调用 API
+    raise_on_failure: API 没有返回结果时抛出异常而不是退回旧摘要（后台任务据此重试）
+    返回 (摘要, 是否生成了新摘要)；没有新对话或 API 失败时返回缓存的旧摘要，标记为 False
+    """
+    dialogue = [m for m in session_messages if m["role"] in ("user", "assistant")]
+    if len(dialogue) < SESSION_SUMMARY_THRESHOLD:
+        return None, False
+    
+    state = load_session_summary_state(username, session_id, dialogue)
+    previous_summary = state["summary"] if state else ""
+    watermark = state["watermark"] if state and previous_summary else 0
+    new_dialogue = dialogue[watermark:]
+    
+    if previous_summary and len(new_dialogue) < max(1, min_new_messages):
+        return previous_summary, False
+    
+    if previous_summary:
+        prompt = (
+            f"以下是一段对话的已有摘要，以及摘要之后新增的对话。"
+            f"请把新增内容合并进摘要，输出更新后的完整摘要（300字以内），包含：\n"
+            f"1. 讨论的主题或核心话题\n"
+            f"2. 用户的核心需求或问题\n"
+            f"3. 达成的结论或关键信息\n"
+            f"4. 用户的偏好或关注点（如有）\n\n"
+            f"已有摘要：\n{previous_summary}\n\n"
+            f"新增对话：\n{format_dialogue(new_dialogue)}"
+        )
+    else:
+        prompt = (
+            f"请将以下对话压缩成一个300字以内的摘要，包含：\n"
+            f"1. 讨论的主题或核心话题\n"
+            f"2. 用户的核心需求或问题\n"
+            f"3. 达成的结论或关键信息\n"
+            f"4. 用户的偏好或关注点（如有）\n\n"
+            f"对话内容：\n{format_dialogue(dialogue)}"
+        )
     
     # 使用通用重试函数
     summary = call_deepseek_api_retry(
         prompt=prompt,
         max_tokens=500,
-        timeout=30
+        timeout=30,
+        api_key=api_key
     )
     
     if summary:
-        # 保存摘要到JSON
-        summary_path = os.path.join(CONVERSATIONS_DIR, f"summary_{session_id}.json")
-        with open(summary_path, "w", encoding="utf-8") as f:
-            json.dump({
-                "session_id": session_id,
-                "summary": summary,
-                "created_at": datetime.now().isoformat(timespec="seconds"),
-                "message_count": len(dialogue)
-            }, f, ensure_ascii=False, indent=2)
-        return summary
+        # 保存摘要和水位线到该用户的摘要索引
+        now = datetime.now().isoformat(timespec="seconds")
+        update_summary_index(username, session_id, {
+            "summary": summary,
+            "created_at": (state or {}).get("created_at") or now,
+            "updated_at": now,
+            "message_count": len(dialogue),
+            "watermark": len(dialogue),
+            "watermark_hash": message_fingerprint(dialogue[-1])
+        })
+        return summary, True
     
-    return None
+    if raise_on_failure:
+        raise RuntimeError("会话摘要生成失败：API 没有返回结果")
+    return previous_summary or None, False
+
+def build_session_history_context(username, session_messages, session_id, api_key=None):
+    """
+    当前会话的历史上下文：滚动摘要 + 水位线之后尚未摘要的最近对话
+    未摘要的消息攒够 ROLLING_SUMMARY_BATCH 条才调用一次 API 折叠
+    """
+    dialogue = [m for m in session_messages if m["role"] in ("user", "assistant")]
+    state = load_session_summary_state(username, session_id, dialogue)
+    summary = state["summary"] if state else ""
+    watermark = state["watermark"] if summary else 0
+    
+    if len(dialogue) - watermark >= ROLLING_SUMMARY_BATCH:
+        new_summary, updated = generate_session_summary(
+            username, session_messages, session_id, api_key=api_key, min_new_messages=ROLLING_SUMMARY_BATCH
+        )
+        if updated:
+            summary, watermark = new_summary, len(dialogue)
+    
+    tail = dialogue[watermark:]
+    if not summary:
+        # 对话条数不足以摘要（如少量超长消息），只保留最近几条原文
+        tail = dialogue[-ROLLING_SUMMARY_BATCH:]
+    
+    parts = []
+    if summary:
+        parts.append(f"【此前对话摘要】\n{summary}")
+    if tail:
+        parts.append(f"【最近对话】\n{format_dialogue(tail)}")
+    return "\n".join(parts)
+
+# ------------------- Token 计数 -------------------
+@st.cache_resource
+@STARTUP_PROFILE.timed("Token 计数器")
+def get_token_counter():
+    """进程级 token 计数器（本地 DeepSeek 分词器，不可用时按官方换算比例估算）"""
+    return TokenCounter(os.getenv("DEEPSEEK_TOKENIZER_PATH", DEEPSEEK_TOKENIZER_PATH))
+
+def count_tokens(text):
+    return get_token_counter().count(text)
+
+def message_tokens(message):
+    """消息 token 数（记录在消息上，随会话保存，只计算一次）"""
+    return get_token_counter().message_tokens(message)
+
+def truncate_tokens(text, max_tokens):
+    """按 token 截断文本"""
+    return get_token_counter().truncate(text, max_tokens)
+
+@st.cache_resource
+def get_context_packer():
+    """检索上下文打包器：去重叠 + 按相关度/token 装入预算（CONTEXT_TOKEN_BUDGET）"""
+    return ContextPacker(count_tokens, truncate=truncate_tokens)
+
+@st.cache_resource
+def get_near_duplicate_filter():
+    """近重复过滤器（SimHash，汉明距离 <= NEAR_DUP_DISTANCE），累计各来源的去重率"""
+    return dedup.NearDuplicateFilter()
+
+# ------------------- 对话历史窗口（流式回答） -------------------
+@st.cache_resource
+def get_history_window_policy():
+    """流式回答的历史窗口：system prompt + 滚动摘要 + 预算内的最近几轮"""
+    return HistoryWindowPolicy(count_tokens, count_message=message_tokens)
+
+def apply_history_window(username, session_id, session_messages):
+    """
+    返回 (要发送的消息, 统计报告)
+    窗口水位线保存在摘要索引中，下一轮从水位线开始计算
+    """
+    dialogue = [m for m in session_messages if m["role"] in ("user", "assistant")]
+    summary_state = load_session_summary_state(username, session_id, dialogue)
+    summary = summary_state["summary"] if summary_state else ""
+    window_state = load_summary_index(username).get(session_id, {}).get("history_window")
+    
+    messages_to_send, new_state, report = get_history_window_policy().apply(session_messages, summary, window_state)
+    if new_state != window_state:
+        try:
+            update_summary_index(username, session_id, {"history_window": new_state})
+        except Exception:
+            pass
+    return messages_to_send, report
 
 def save_to_history_vectorstore(username, texts, metadata_type="summary", session_id=None):
-    """保存摘要或对话片段到向量库"""
+    """保存摘要或对话片段到向量库，返回是否写入成功"""
     history_vs = load_history_vectorstore()
     if not history_vs or not texts:
-        return
+        return False
     
     try:
         ids = [f"{username}_{session_id or metadata_type}_{i}_{datetime.now().strftime('%Y%m%d%H%M%S')}" 
                for i in range(len(texts))]
+        # 近重复指纹随条目保存，检索去重时不必重新计算
         metadatas = [
-            {"username": username, "type": metadata_type, "session_id": session_id or ""} 
-            for _ in texts
+            {"username": username, "type": metadata_type, "session_id": session_id or "",
+             "simhash": dedup.to_hex(dedup.simhash(t))}
+            for t in texts
         ]
         history_vs.add_texts(texts=texts, ids=ids, metadatas=metadatas)
         history_vs.persist()
+        return True
     except Exception as e:
         st.warning(f"保存到历史向量库失败: {e}")
+        return False
 
-def search_history_vectorstore(query, username, k=5, return_with_score=True):
+def search_history_vectorstore(query, username, k=5, return_with_score=True, embedding_ctx=None):
     """从历史向量库检索相关内容，返回带session_id的结果"""
     history_vs = load_history_vectorstore()
     if not history_vs:
         return []
     
     try:
-        results = history_vs.similarity_search_with_score(
-            query, k=k, filter={"username": username}
-        )
+        query_vector = embed_query(query, embedding_ctx)
+        if query_vector is not None:
+            results = history_vs.similarity_search_by_vector_with_relevance_scores(
+                query_vector, k=k, filter={"username": username}
+            )
+        else:
+            results = history_vs.similarity_search_with_score(
+                query, k=k, filter={"username": username}
+            )
         # 返回结果：包含内容、分数、session_id
         formatted_results = []
         for r, score in results:
             formatted_results.append({
                 "content": r.page_content,
                 "score": score,
+                "relevance": sufficiency.distance_to_similarity(score),
                 "session_id": r.metadata.get("session_id", ""),
-                "type": r.metadata.get("type", "")
+                "type": r.metadata.get("type", ""),
+                "fingerprint": dedup.from_hex(r.metadata.get("simhash"))
             })
         return formatted_results
     except Exception:
         return []
 
-def get_user_summaries(username):
-    """获取用户所有会话摘要（含session_id）"""
-    summaries = []
-    for f in os.listdir(CONVERSATIONS_DIR):
-        if f.startswith("summary_") and f.endswith(".json"):
-            path = os.path.join(CONVERSATIONS_DIR, f)
-            with open(path, "r", encoding="utf-8") as fp:
-                data = json.load(fp)
-                summaries.append({
-                    "summary": data["summary"],
-                    "session_id": data.get("session_id", "")
-                })
-    return summaries
+def search_history_by_sessions(query, username, session_ids, k_per_session=3, embedding_ctx=None):
+    """
+    批量检索多个会话的历史细节：一次带 $in 过滤的向量查询，按会话各取 top-k
+    返回按相似度排序的列表，元素可直接交给 rrf_fusion
+    """
+    history_vs = load_history_vectorstore()
+    session_ids = [sid for sid in session_ids if sid]
+    if not history_vs or not session_ids:
+        return []
+    
+    history_filter = {"$and": [{"username": username}, {"session_id": {"$in": session_ids}}]}
+    # 多取一些候选，保证每个会话尽量能凑满 k_per_session 条
+    k = k_per_session * len(session_ids) * 2
+    try:
+        query_vector = embed_query(query, embedding_ctx)
+        if query_vector is not None:
+            results = history_vs.similarity_search_by_vector_with_relevance_scores(
+                query_vector, k=k, filter=history_filter
+            )
+        else:
+            results = history_vs.similarity_search_with_score(query, k=k, filter=history_filter)
+    except Exception:
+        return []
+    
+    per_session_count = {}
+    matches = []
+    for r, score in sorted(results, key=lambda x: x[1]):  # Chroma 返回距离，越小越相似
+        session_id = r.metadata.get("session_id", "")
+        if per_session_count.get(session_id, 0) >= k_per_session:
+            continue
+        per_session_count[session_id] = per_session_count.get(session_id, 0) + 1
+        matches.append({
+            "session_id": session_id,
+            "content": r.page_content,
+            "score": score,
+            "relevance": sufficiency.distance_to_similarity(score),
+            "type": r.metadata.get("type", ""),
+            "fingerprint": dedup.from_hex(r.metadata.get("simhash")),
+            "rank_source": "vector"
+        })
+    return matches
 
 # ------------------- RRF融合排序 -------------------
 def rrf_fusion(*ranked_lists, k=60):
@@ -416,17 +781,17 @@ def rrf_fusion(*ranked_lists, k=60):
     return [{"key": k, "score": scores[k], **item_data[k]} for k in sorted_keys]
 
 # ------------------- 关键词提取与匹配 -------------------
+@st.cache_resource
+@STARTUP_PROFILE.timed("分词器")
+def get_segmenter():
+    """分词器（领域词典 + 未登录词 bigram），BM25 和关键词匹配共用"""
+    return Segmenter.from_file(DOMAIN_LEXICON_PATH, bigrams=os.getenv("SEGMENT_BIGRAMS", "1") == "1")
+
 def extract_keywords_from_query(query):
-    """从查询中提取关键词"""
-    # 简单分词 + 去停用词
-    stopwords = {"的", "是", "在", "和", "了", "我", "你", "他", "她", "它", "这", "那", "有", "什么", "怎么", "如何", "吗", "呢", "吧"}
-    
-    # 简单按标点和空格分词
-    words = re.findall(r'[\u4e00-\u9fa5a-zA-Z0-9]+', query)
-    keywords = [w for w in words if len(w) >= 2 and w not in stopwords]
-    return list(set(keywords))
+    """从查询中提取关键词（词典分词 + 去停用词，英文统一小写）"""
+    return get_segmenter().keywords(query)
 
-def keyword_match_in_session(query, session_messages, max_matches=3):
+def keyword_match_in_session(query, session_messages, max_matches=3, session_id=""):
     """在会话中用关键词匹配，返回匹配片段"""
     keywords = extract_keywords_from_query(query)
     if not keywords:
@@ -436,7 +801,7 @@ def keyword_match_in_session(query, session_messages, max_matches=3):
     dialogue = [m for m in session_messages if m["role"] in ("user", "assistant")]
     
     for i, msg in enumerate(dialogue):
-        text = msg["content"]
+        text = msg["content"].lower()
         # 计算关键词匹配数
         matched_kws = [kw for kw in keywords if kw in text]
         if matched_kws:
@@ -452,7 +817,8 @@ def keyword_match_in_session(query, session_messages, max_matches=3):
                 "content": window_text,
                 "matched_keywords": matched_kws,
                 "match_count": len(matched_kws),
-                "session_id": session_messages.get("session_id", "")
+                "relevance": len(matched_kws) / len(keywords),  # 关键词覆盖率
+                "session_id": session_id
             })
     
     # 按匹配数排序
@@ -460,21 +826,14 @@ def keyword_match_in_session(query, session_messages, max_matches=3):
     return matches[:max_matches]
 
 def load_session_from_json(username, session_id):
-    """从JSON加载指定会话"""
-    path = os.path.join(CONVERSATIONS_DIR, f"conversations_{username}.json")
-    if not os.path.exists(path):
-        return None
-    
-    with open(path, "r", encoding="utf-8") as f:
-        data = json.load(f)
-        if session_id in data:
-            session = data[session_id].copy()
-            session["session_id"] = session_id
-            return session
-    return None
+    """从对话存储加载指定会话"""
+    session = get_conversation_store().load_session(username, session_id)
+    if session is not None:
+        session["session_id"] = session_id
+    return session
 
 # ------------------- 混合历史检索（核心） -------------------
-def hybrid_history_search(query, username, k_summary=5, k_session=3):
+def hybrid_history_search(query, username, k_summary=5, k_session=3, embedding_ctx=None):
     """
     混合历史检索流程：
     1. 向量检索摘要（快速定位话题）
@@ -483,7 +842,7 @@ def hybrid_history_search(query, username, k_summary=5, k_session=3):
     4. 返回匹配片段
     """
     # Step 1: 检索相关摘要
-    summary_results = search_history_vectorstore(query, username, k=k_summary)
+    summary_results = search_history_vectorstore(query, username, k=k_summary, embedding_ctx=embedding_ctx)
     
     if not summary_results:
         return {"status": "no_summary", "results": [], "keywords": extract_keywords_from_query(query)}
@@ -506,34 +865,40 @@ def hybrid_history_search(query, username, k_summary=5, k_session=3):
     # 获取相关的session_id列表
     relevant_sessions = list(set([r.get("session_id", "") for r in summary_results if r.get("session_id")]))
     
-    # 存储所有匹配结果
-    all_vector_matches = []
-    all_keyword_matches = []
+    # 向量检索所有相关会话的细节（一次批量查询）
+    vector_for_rrf = search_history_by_sessions(
+        query, username, relevant_sessions, k_per_session=k_session, embedding_ctx=embedding_ctx
+    )
     
+    # 关键词匹配各会话
+    all_keyword_matches = []
     for session_id in relevant_sessions:
-        # 向量检索该会话的细节
-        session_vectors = search_history_vectorstore(query, username, k=k_session, return_with_score=True)
-        session_vectors = [r for r in session_vectors if r.get("session_id") == session_id]
-        all_vector_matches.extend(session_vectors)
-        
-        # 关键词匹配该会话
         session_data = load_session_from_json(username, session_id)
         if session_data:
-            keyword_matches = keyword_match_in_session(query, session_data.get("messages", []))
+            keyword_matches = keyword_match_in_session(query, session_data.get("messages", []), session_id=session_id)
             all_keyword_matches.extend(keyword_matches)
     
     # Step 5: RRF融合排序
     # 转换格式以便RRF处理
-    vector_for_rrf = [{"session_id": r.get("session_id", ""), "content": r.get("content", ""), "rank_source": "vector"} 
-                      for r in all_vector_matches]
-    keyword_for_rrf = [{"session_id": m.get("session_id", ""), "content": m.get("content", ""), "rank_source": "keyword"} 
+    keyword_for_rrf = [{"session_id": m.get("session_id", ""), "content": m.get("content", ""), "rank_source": "keyword",
+                        "matched_keywords": m.get("matched_keywords", []), "relevance": m.get("relevance", 0.0)}
                        for m in all_keyword_matches]
     
     fused_results = rrf_fusion(vector_for_rrf, keyword_for_rrf)
     
+    # RRF 只决定顺序；相关度取两路中较高的真实得分（向量相似度 / 关键词覆盖率），供上下文打包使用
+    best_relevance = {}
+    for m in vector_for_rrf + keyword_for_rrf:
+        key = (m.get("session_id", ""), m.get("content", "")[:50])
+        best_relevance[key] = max(best_relevance.get(key, 0.0), m.get("relevance", 0.0))
+    for item in fused_results:
+        item["relevance"] = best_relevance.get((item.get("session_id", ""), item.get("content", "")[:50]), 0.0)
+    
     # 合并摘要结果
     combined = fused_results + [{"content": r.get("content", ""), "session_id": r.get("session_id", ""), 
-                                 "source": "summary", "score": r.get("score", 1.0)} 
+                                 "source": "summary", "score": r.get("score", 1.0),
+                                 "relevance": r.get("relevance", 0.0),
+                                 "fingerprint": r.get("fingerprint")} 
                                 for r in summary_results]
     
     return {
@@ -542,32 +907,52 @@ def hybrid_history_search(query, username, k_summary=5, k_session=3):
         "keywords": summary_keywords
     }
 
+@st.cache_resource
+def get_rewrite_gate():
+    """Query 改写门控（进程级，含改写结果缓存）"""
+    return RewriteGate()
+
+@st.cache_resource
+@STARTUP_PROFILE.timed("充分性判断器")
+def get_sufficiency_judge():
+    """本地充分性判断器，LLM 回退的结论保存在 judge_calibration.json 用于校准"""
+    return sufficiency.SufficiencyJudge(os.path.join(CONVERSATIONS_DIR, "judge_calibration.json"))
+
 def check_summary_enough(query, summary_results):
-    """判断摘要是否足够回答问题"""
+    """判断摘要是否足够回答问题（本地打分，不确定时才调用 LLM）"""
     if not summary_results:
         return False
     
     # 合并所有摘要内容
     all_summary_text = "\n".join([r.get("content", "") for r in summary_results])
     
-    prompt = (
-        f"基于以下摘要内容，判断能否回答用户问题。\n\n"
-        f"摘要内容：\n{all_summary_text[:1000]}\n\n"
-        f"用户问题：{query}\n\n"
-        "如果摘要内容能回答问题（即使需要推理），返回'是'；如果明显需要更多信息，返回'否'。"
-        "只返回'是'或'否'，不要其他内容。"
+    judge = get_sufficiency_judge()
+    features = judge.features(
+        [sufficiency.distance_to_similarity(r.get("score", 2.0)) for r in summary_results],
+        extract_keywords_from_query(query),
+        all_summary_text
     )
     
-    result = call_deepseek_api_retry(
-        prompt=prompt,
-        max_tokens=50,
-        timeout=30
-    )
+    def ask_llm():
+        prompt = (
+            f"基于以下摘要内容，判断能否回答用户问题。\n\n"
+            f"摘要内容：\n{truncate_tokens(all_summary_text, 500)}\n\n"
+            f"用户问题：{query}\n\n"
+            "如果摘要内容能回答问题（即使需要推理），返回'是'；如果明显需要更多信息，返回'否'。"
+            "只返回'是'或'否'，不要其他内容。"
+        )
+        
+        result = call_deepseek_api_retry(
+            prompt=prompt,
+            max_tokens=50,
+            timeout=30
+        )
+        return result == "是" if result else None
     
     # 默认认为足够，避免频繁回退
-    return result == "是" if result else True
+    return judge.decide(features, ask_llm, default=True)
 
-def extract_and_update_memory(username, messages):
+def extract_and_update_memory(username, messages, api_key=None):
     dialogue = [m for m in messages if m["role"] in ("user", "assistant")]
     if len(dialogue) < 4:
         return
@@ -589,9 +974,14 @@ def extract_and_update_memory(username, messages):
     raw = call_deepseek_api_retry(
         prompt=prompt,
         max_tokens=200,
-        timeout=30
+        timeout=30,
+        api_key=api_key
     )
     
+    if raw is None:
+        # 在后台线程中 st.warning 不会显示，抛出异常让任务队列记录失败并重试
+        raise RuntimeError("长期记忆提取失败：API 没有返回结果")
+    
     if raw:
         match = re.search(r'\[.*?\]', raw, re.DOTALL)
         new_facts = json.loads(match.group()) if match else []
@@ -599,6 +989,45 @@ def extract_and_update_memory(username, messages):
             merged = existing_facts + [f for f in new_facts if f not in existing_facts]
             save_long_term_memory(username, merged)
 
+# ------------------- 后台任务（记忆提取 / 会话摘要） -------------------
+def run_memory_job(username, messages, _api_key=None):
+    """后台任务：提取长期记忆"""
+    extract_and_update_memory(username, messages, api_key=_api_key or load_api_key(username))
+
+def run_summary_job(username, session_id, messages, _api_key=None):
+    """后台任务：生成会话摘要并写入历史向量库"""
+    summary, updated = generate_session_summary(username, messages, session_id,
+                                                api_key=_api_key or load_api_key(username), raise_on_failure=True)
+    if not summary:
+        return
+    # 没有生成新摘要、且当前摘要已写入过历史向量库时跳过，避免重复的摘要向量
+    # （前台滚动摘要更新的摘要没有写入向量库，由 indexed_hash 不一致识别出来）
+    summary_hash = hashlib.md5(summary.encode("utf-8")).hexdigest()
+    if not updated and load_summary_index(username).get(session_id, {}).get("indexed_hash") == summary_hash:
+        return
+    if not save_to_history_vectorstore(username, [summary], "summary", session_id=session_id):
+        raise RuntimeError("会话摘要写入历史向量库失败")
+    update_summary_index(username, session_id, {"indexed_hash": summary_hash})
+
+@st.cache_resource
+@STARTUP_PROFILE.timed("后台任务队列")
+def get_job_queue():
+    """进程级后台任务队列，未完成的任务保存在 jobs.json，重启后继续执行"""
+    queue = JobQueue(os.path.join(CONVERSATIONS_DIR, "jobs.json"))
+    queue.register("memory", run_memory_job)
+    queue.register("session_summary", run_summary_job)
+    return queue.start()
+
+def enqueue_post_turn_jobs(username, session_id, messages, api_key=None, memory=False, summary=False):
+    """回复完成后的工作放入后台队列（同一会话只保留最新的一份）"""
+    snapshot = [dict(m) for m in messages]
+    queue = get_job_queue()
+    if memory:
+        queue.enqueue("memory", session_id, username=username, messages=snapshot, _api_key=api_key)
+    if summary:
+        queue.enqueue("session_summary", session_id, username=username, session_id=session_id,
+                      messages=snapshot, _api_key=api_key)
+
 # ------------------- 动态 system prompt -------------------
 def build_system_prompt(username):
     base = (
@@ -615,6 +1044,7 @@ def build_system_prompt(username):
 
 # ------------------- 加载知识库 -------------------
 @st.cache_resource
+@STARTUP_PROFILE.timed("知识库向量库")
 def load_vectorstore():
     """加载知识库向量库（文件已包含在 GitHub 仓库中）"""
     
@@ -640,10 +1070,8 @@ def load_vectorstore():
     # sqlite_size = os.path.getsize(sqlite_path)
     # st.info(f"知识库文件大小: {sqlite_size/1024:.1f} KB")
     
-    MODEL_NAME = "BAAI/bge-small-zh-v1.5"
     try:
-        embeddings = HuggingFaceEmbeddings(model_name=MODEL_NAME)
-        vectorstore = Chroma(persist_directory=CHROMA_DIR, embedding_function=embeddings)
+        vectorstore = vectorstores.Chroma(persist_directory=CHROMA_DIR, embedding_function=get_embeddings())
         
         # 验证向量库是否可用
         count = vectorstore._collection.count()
@@ -654,26 +1082,79 @@ def load_vectorstore():
         return None
         return None
 
-
-vectorstore = load_vectorstore()
+# ------------------- 查询向量缓存 -------------------
+@st.cache_resource
+@STARTUP_PROFILE.timed("查询向量缓存")
+def get_query_embedder():
+    """进程级查询向量 LRU 缓存（知识库和历史库共用同一个编码器，向量可共用）"""
+    if load_vectorstore() is None and load_history_vectorstore() is None:
+        return None
+    return QueryEmbedder(get_embeddings())
+
+def embed_query(text, embedding_ctx=None):
+    """编码查询：优先使用本轮上下文，其次进程级缓存；模型不可用时返回 None"""
+    if embedding_ctx is not None:
+        return embedding_ctx.embed(text)
+    embedder = get_query_embedder()
+    return embedder.embed(text) if embedder else None
 # if vectorstore:
 #     st.success("锐瞳知识库加载完成！")
 # else:
 #     st.error("知识库加载失败，请检查路径或数据。")
 
 # ------------------- 加载 BM25 索引 -------------------
+KB_VERSION_FILE = "kb_version"  # 导入脚本可在知识库目录写入版本号，存在时代替数据库文件修改时间
+
+def kb_storage_stamp(chroma_dir):
+    """
+    知识库存储版本戳（启动时不读取正文）：优先使用导入时写入的版本号，
+    否则用 Chroma 数据库文件（含 WAL）的修改时间和大小；重新导入或修改切块后会变化
+    """
+    version_path = os.path.join(chroma_dir, KB_VERSION_FILE)
+    if os.path.exists(version_path):
+        with open(version_path, "r", encoding="utf-8") as f:
+            return f"version:{f.read().strip()}"
+    parts = []
+    for name in ("chroma.sqlite3", "chroma.sqlite3-wal"):
+        path = os.path.join(chroma_dir, name)
+        if os.path.exists(path):
+            stat = os.stat(path)
+            parts.append(f"{name}:{stat.st_mtime_ns}:{stat.st_size}")
+    return ";".join(parts)
+
+def bm25_tokenize(text):
+    """BM25 分词（与关键词匹配共用同一个分词器）"""
+    return get_segmenter().tokens(text)
+
 @st.cache_resource
+@STARTUP_PROFILE.timed("BM25 索引")
 def load_bm25_index():
+    """加载持久化 BM25 索引（内存映射），知识库内容或分词器变化时才重建"""
+    vectorstore = load_vectorstore()
+    if vectorstore is None:
+        return None
     try:
-        from rank_bm25 import BM25Okapi
-        raw = vectorstore.get()
-        docs = raw.get("documents", [])
-        tokenized = [list(d) for d in docs]
-        bm25 = BM25Okapi(tokenized)
-        return bm25, docs
+        collection = vectorstore._collection
+        doc_ids = collection.get(include=[])["ids"]
+        
+        def doc_batches(batch_size=1000):
+            # 分批读取文档，避免一次性加载整个知识库
+            for offset in range(0, len(doc_ids), batch_size):
+                batch = collection.get(ids=doc_ids[offset:offset + batch_size], include=["documents"])
+                yield list(zip(batch["ids"], batch["documents"]))
+        
+        return bm25_engine.load_or_build(
+            BM25_INDEX_DIR,
+            bm25_engine.collection_signature(doc_ids, kb_storage_stamp(CHROMA_DIR)),
+            get_segmenter().version,
+            doc_batches,
+            bm25_tokenize,
+            force=os.getenv("BM25_FORCE_REBUILD") == "1",
+            fingerprint=dedup.simhash
+        )
     except Exception as e:
         st.warning(f"BM25 索引构建失败: {e}")
-        return None, []
+        return None
 
 # ------------------- 加载 bge-reranker -------------------
 # RERANKER_MODEL_PATH = "./models/BAAI/bge-reranker-base"
@@ -696,10 +1177,57 @@ def load_bm25_index():
 #         st.warning(f"Reranker 加载失败: {e}")
 #         return None, None
 
-# BM25 加载（必要）
-# with st.spinner("正在加载 BM25 索引..."):
-#     bm25_index, bm25_docs = load_bm25_index() if vectorstore else (None, [])
-bm25_index, bm25_docs = load_bm25_index() if vectorstore else (None, [])
+# 知识库向量库和 BM25 索引不在模块顶层加载：登录页不等模型，由启动预热在后台线程构建，
+# 或在检索时第一次使用（load_vectorstore / load_bm25_index 均为进程级缓存）
+
+# ------------------- 启动预热 -------------------
+WARMUP_QUERY = "锐瞳智能科技的机器视觉产品"
+
+def require(resource, name):
+    """预热步骤中资源不可用时报错（加载函数失败时返回 None）"""
+    if resource is None:
+        raise RuntimeError(f"{name}不可用")
+    return resource
+
+def warm_knowledge_search():
+    """用一条示例查询跑一遍编码 + 向量检索 + BM25，加载 HNSW 索引和倒排内存映射"""
+    vector = get_embeddings().embed_query(WARMUP_QUERY)
+    vectorstore = require(load_vectorstore(), "知识库向量库")
+    vectorstore._collection.query(query_embeddings=[[float(x) for x in vector]], n_results=1, include=[])
+    bm25_index = load_bm25_index()
+    if bm25_index:
+        bm25_index.top_k(bm25_tokenize(WARMUP_QUERY), k=1)
+
+def warm_history_search():
+    """加载历史向量库（有数据时跑一次检索）"""
+    history_vs = require(load_history_vectorstore(), "历史向量库")
+    if history_vs._collection.count():
+        vector = get_embeddings().embed_query(WARMUP_QUERY)
+        history_vs._collection.query(query_embeddings=[[float(x) for x in vector]], n_results=1, include=[])
+
+def warm_api_connections():
+    """预先与 DeepSeek API 建立连接池中的连接（TLS 握手）"""
+    headers = {"Authorization": f"Bearer {DEEPSEEK_API_KEY}"} if DEEPSEEK_API_KEY else None
+    if not deepseek_client.get_deepseek_client().warm_up(f"{DEEPSEEK_API_BASE}/models", headers=headers):
+        raise RuntimeError("无法连接 DeepSeek API")
+
+@st.cache_resource
+def get_warmup():
+    """
+    进程级启动预热（第一次执行脚本时启动，后台线程执行，不阻塞登录页）
+    启用 server.scriptHealthCheckEnabled 后，部署时请求一次 /_stcore/script-health-check 即可在没有用户访问前开始预热
+    """
+    warmup = Warmup()
+    warmup.add_step("配置与会话存储", lambda: (get_json_cache(), get_conversation_store()))
+    warmup.add_step("分词器", lambda: (get_segmenter().tokens(WARMUP_QUERY), count_tokens(WARMUP_QUERY)))
+    warmup.add_step("检索组件", lambda: (get_rewrite_gate(), get_sufficiency_judge(), get_context_packer(),
+                                         get_near_duplicate_filter(), get_history_window_policy()))
+    warmup.add_step("向量模型", lambda: require(get_query_embedder(), "查询向量缓存"), required=True)
+    warmup.add_step("知识库检索", warm_knowledge_search, required=True)
+    warmup.add_step("历史检索", warm_history_search)
+    warmup.add_step("后台任务队列", get_job_queue)
+    warmup.add_step("DeepSeek 连接", warm_api_connections)
+    return warmup.start()
 
 # Reranker 加载（已禁用）
 # with st.spinner("正在加载 Reranker 模型..."):
@@ -712,6 +1240,43 @@ bm25_index, bm25_docs = load_bm25_index() if vectorstore else (None, [])
 # 禁用 reranker
 reranker_tokenizer, reranker_model = None, None
 
+# ------------------- 局部重跑（fragment） -------------------
+# st.fragment（1.37+）或 st.experimental_fragment（1.33~1.36）；更老的版本退化为普通函数（整页重跑）
+_fragment = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None) or (lambda fn: fn)
+FRAGMENT_TIMING_OVERLAY = os.getenv("FRAGMENT_TIMING_OVERLAY", "1") == "1"  # 在各区域底部显示本次执行耗时
+
+def rerun_fragment():
+    """只重跑当前 fragment；不支持 scope 参数的旧版本退化为整页重跑"""
+    try:
+        st.rerun(scope="fragment")
+    except TypeError:
+        st.rerun()
+
+def timed_fragment(name):
+    """注册为可独立重跑的 fragment，并记录每次执行耗时（显示在区域底部和「性能统计」中）"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            completed = False
+            try:
+                result = fn(*args, **kwargs)
+                completed = True
+                return result
+            finally:
+                elapsed = time.perf_counter() - start
+                timings = st.session_state.setdefault("fragment_timings", {})
+                entry = timings.setdefault(name, {"runs": 0, "last": 0.0, "total": 0.0})
+                entry["runs"] += 1
+                entry["last"] = elapsed
+                entry["total"] += elapsed
+                if completed and FRAGMENT_TIMING_OVERLAY:
+                    st.caption(f"⏱️ {name}：{elapsed * 1000:.0f} ms（第 {entry['runs']} 次执行）")
+        return _fragment(wrapper)
+    return decorator
+
+get_warmup()
+
 # ------------------- 用户选择/输入界面 -------------------
 if "username" not in st.session_state:
     st.session_state.username = None
@@ -719,11 +1284,7 @@ if "username" not in st.session_state:
 
 if not st.session_state.username:
     st.title("请选择或输入用户名")
-    existing_users = [
-        f.replace("conversations_", "").replace(".json", "")
-        for f in os.listdir(CONVERSATIONS_DIR)
-        if f.startswith("conversations_") and f.endswith(".json")
-    ]
+    existing_users = list_conversation_users()
     if existing_users:
         selected_user = st.selectbox("已有用户：", existing_users)
         if st.button("加载已有用户"):
@@ -738,34 +1299,35 @@ if not st.session_state.username:
             st.rerun()
         else:
             st.error("用户名无效或为空（仅限字母、数字、下划线）！")
+    STARTUP_PROFILE.mark("登录页就绪")
 else:
     # ------------------- 初始化会话状态 -------------------
     if "conversations" not in st.session_state or st.session_state.conversations is None:
-        st.session_state.conversations = load_conversations(st.session_state.username)
-        if not st.session_state.conversations or st.session_state.conversations == {}:
-            default_id = "default"
-            st.session_state.conversations = {
-                default_id: {
-                    "title": "新对话",
-                    "messages": [
-                        {"role": "system", "content": build_system_prompt(st.session_state.username)},
-                        {"role": "assistant", "content": "你好，我是小锐助手，有什么需要帮助的吗？"}
-                    ]
-                }
-            }
+        # 登录时只读会话元数据，消息在选中会话时才加载
+        st.session_state.conversations = {}
+        st.session_state.recent_sessions = []
+        st.session_state.session_page = 0
+        sessions_meta = load_session_index(st.session_state.username)
+        if sessions_meta:
+            st.session_state.current_session = sessions_meta[0]["session_id"]
+        else:
+            create_session(st.session_state.username, "default", "新对话")
             st.info("初始化新会话")
-        st.session_state.current_session = list(st.session_state.conversations.keys())[0]
-        save_conversations(st.session_state.username)
+    
+    if open_session(st.session_state.username, st.session_state.current_session) is None:
+        # 当前会话已被删除（例如在另一个标签页中），新建一个
+        create_session(st.session_state.username, f"chat_{int(time.time() * 1000)}", "新对话")
 
     # ------------------- DeepSeek API（流式输出） -------------------
     def call_deepseek_api_stream(messages, context, api_key=None):
         """流式生成回答的API调用"""
         try:
-            messages_to_send = list(messages)
+            # 只发送 role/content（消息上还记录了 token 计数等本地字段）
+            messages_to_send = [{"role": m["role"], "content": m["content"]} for m in messages]
             if context:
                 messages_to_send.insert(-1, {
                     "role": "system",
-                    "content": f"[检索到的相关知识库内容，仅供参考：{context[:60000]}]"
+                    "content": f"[检索到的相关知识库内容，仅供参考：{context}]"
                 })
             
             # 优先使用传入的 api_key，否则使用全局变量
@@ -784,21 +1346,16 @@ else:
                 "stream": True  # 启用流式输出
             }
             
-            response = requests.post(
+            # 流式读取响应（走进程级连接池）
+            full_response = ""
+            with deepseek_client.get_deepseek_client().stream_lines(
                 f"{DEEPSEEK_API_BASE}/chat/completions",
                 headers=headers,
-                json=json_data,
-                stream=True,
+                json_data=json_data,
                 timeout=120
-            )
-            response.raise_for_status()
-            
-            # 流式读取响应
-            full_response = ""
-            for line in response.iter_lines():
-                if line:
-                    line_text = line.decode('utf-8')
-                    if line_text.startswith("data: "):
+            ) as lines:
+                for line_text in lines:
+                    if line_text and line_text.startswith("data: "):
                         data_str = line_text[6:]
                         if data_str == "[DONE]":
                             break
@@ -828,11 +1385,12 @@ else:
     def call_deepseek_api(messages, context):
         """生成回答的API调用（非流式，用于摘要等）"""
         try:
-            messages_to_send = list(messages)
+            # 只发送 role/content（消息上还记录了 token 计数等本地字段）
+            messages_to_send = [{"role": m["role"], "content": m["content"]} for m in messages]
             if context:
                 messages_to_send.insert(-1, {
                     "role": "system",
-                    "content": f"[检索到的相关知识库内容，仅供参考：{context[:60000]}]"
+                    "content": f"[检索到的相关知识库内容，仅供参考：{context}]"
                 })
             
             full_prompt = "\n".join([f"{m['role']}: {m['content']}" for m in messages_to_send])
@@ -870,159 +1428,148 @@ else:
             return candidates[:top_k]
 
     # ------------------- 混合检索（知识库 + 历史回退 + RRF融合） -------------------
-    def retrieve_context(query, username, history_context="", need_full_retrieval=True):
+    def search_knowledge_base(query, embedding_ctx=None):
         """
-        检索上下文 - 完整流程：
-        1. 历史摘要向量检索（快速定位话题）
-        2. 判断摘要是否足够
-        3. 如果不足，会话JSON + 关键词匹配 + RRF融合
-        4. 合并知识库检索结果
+        知识库检索（向量 + BM25），返回按文档 id 去重后的结果（未重排）
+        每条结果为 {"id", "text", "fingerprint", "score"}，指纹取自 BM25 索引中预先计算的值；
+        score 为两路检索得分合成的相关度（hybrid_relevance）：只被一路命中的文档补算另一路的得分
         """
-        results = []
-        
-        # Step 1: 如果有当前会话上下文，标记来源
-        if history_context:
-            results.append(f"[当前会话上下文]\n{history_context[:800]}")
-        
-        # Step 2: 使用混合检索（摘要 + 会话细节 + RRF）
-        if need_full_retrieval:
-            # 混合历史检索
-            history_search_result = hybrid_history_search(query, username)
-            
-            # 添加检索结果（带来源标记）
-            for item in history_search_result.get("results", []):
-                content = item.get("content", "")
-                source = item.get("source", item.get("type", "history"))
-                session_id = item.get("session_id", "")
-                
-                if source == "summary":
-                    results.append(f"[历史摘要] {content}")
-                elif source == "vector":
-                    results.append(f"[历史会话-向量] {content}")
-                elif source == "keyword":
-                    keywords = item.get("matched_keywords", [])
-                    results.append(f"[历史会话-关键词:{','.join(keywords)}] {content}")
-                else:
-                    results.append(f"[历史对话] {content}")
-        
-        # Step 3: 知识库检索（向量 + BM25）
-        vector_texts = []
+        vectorstore = load_vectorstore()
+        bm25_index = load_bm25_index()
+        texts = {}  # key -> 原文，key 为文档 id（无 id 时取文本前 100 字）
+        doc_ids = {}  # key -> 文档 id
+        similarity = {}  # key -> 余弦相似度
+        query_vector = None
         if vectorstore:
-            vector_docs = vectorstore.similarity_search(query, k=6)
-            vector_texts = [d.page_content for d in vector_docs]
-
-        bm25_texts = []
-        if bm25_index and bm25_docs:
-            scores = bm25_index.get_scores(list(query))
-            top_indices = np.argsort(scores)[::-1][:6]
-            bm25_texts = [bm25_docs[i] for i in top_indices if scores[i] > 0]
+            query_vector = embed_query(query, embedding_ctx)
+            if query_vector is not None:
+                # 直接查询底层集合以拿到文档 id（用于合并和取预计算指纹）和距离
+                found = vectorstore._collection.query(
+                    query_embeddings=[[float(x) for x in query_vector]], n_results=6,
+                    include=["documents", "distances"]
+                )
+                for doc_id, text, distance in zip(found["ids"][0], found["documents"][0], found["distances"][0]):
+                    texts[doc_id], doc_ids[doc_id] = text, doc_id
+                    similarity[doc_id] = sufficiency.distance_to_similarity(distance)
+            else:
+                for doc, distance in vectorstore.similarity_search_with_score(query, k=6):
+                    key = doc.page_content[:100]
+                    texts.setdefault(key, doc.page_content)
+                    doc_ids.setdefault(key, None)
+                    similarity[key] = sufficiency.distance_to_similarity(distance)
+
+        lexical = {}  # key -> BM25 得分 / 本次查询最高分
+        if bm25_index and vectorstore:
+            query_tokens = bm25_tokenize(query)
+            hits = bm25_index.top_k(query_tokens, k=6)
+            if hits:
+                top_score = hits[0][1]
+                # 索引只保存文档 id，命中后再从 Chroma 取原文（有查询向量时顺带取向量补算相似度）
+                new_ids = [doc_id for doc_id, _ in hits if doc_id not in texts]
+                if new_ids:
+                    include = ["documents", "embeddings"] if query_vector is not None else ["documents"]
+                    fetched = vectorstore.get(ids=new_ids, include=include)
+                    for i, doc_id in enumerate(fetched["ids"]):
+                        texts[doc_id], doc_ids[doc_id] = fetched["documents"][i], doc_id
+                        if query_vector is not None:
+                            vec = np.asarray(fetched["embeddings"][i], dtype=np.float32)
+                            qv = np.asarray(query_vector, dtype=np.float32)
+                            cosine = float(vec @ qv / max(float(np.linalg.norm(vec) * np.linalg.norm(qv)), 1e-12))
+                            similarity[doc_id] = min(1.0, max(0.0, cosine))
+                bm25_scores = dict(hits)
+                # 只被向量检索命中的文档补算 BM25 得分
+                bm25_scores.update(bm25_index.scores(
+                    query_tokens, [doc_id for doc_id in similarity if doc_ids.get(doc_id) and doc_id not in bm25_scores]
+                ))
+                lexical = {doc_id: score / top_score for doc_id, score in bm25_scores.items() if doc_id in texts}
+            else:
+                # 没有任何查询词命中：词法得分为 0
+                lexical = {key: 0.0 for key in texts}
 
-        seen = set()
         merged = []
-        for t in vector_texts + bm25_texts:
-            key = t[:100]
-            if key not in seen:
-                seen.add(key)
-                merged.append(t)
-        
-        knowledge_results = rerank(query, merged, top_k=5)
-        
-        # 合并知识库结果
-        for text in knowledge_results:
-            results.append(f"[知识库] {text}")
-        
-        return results
-
-    # ------------------- 多轮感知检索：增强版 Query Rewriting -------------------
-    def rewrite_query(user_input, recent_messages, username):
-        """增强版Query改写：融合长期记忆 + 历史摘要 + 当前会话"""
-        
-        # 0. 常量定义
-        MAX_TURNS_FOR_DIRECT = 5          # 轮数阈值
-        MAX_TOKENS_FOR_DIRECT = 800        # Token阈值（中文约1字=1token）
+        for key, text in texts.items():
+            doc_id = doc_ids.get(key)
+            merged.append({
+                "id": doc_id,
+                "text": text,
+                "fingerprint": bm25_index.fingerprint(doc_id) if bm25_index and doc_id else None,
+                "score": hybrid_relevance(similarity.get(key), lexical.get(key))
+            })
+        merged.sort(key=lambda hit: hit["score"], reverse=True)
+        return merged
+
+    def history_result_label(item):
+        """混合历史检索结果的来源标记"""
+        source = item.get("source", item.get("type", "history"))
+        if source == "summary":
+            return "[历史摘要]"
+        elif source == "vector":
+            return "[历史会话-向量]"
+        elif source == "keyword":
+            keywords = item.get("matched_keywords", [])
+            return f"[历史会话-关键词:{','.join(keywords)}]"
+        return "[历史对话]"
+
+    def build_context_results(query, history_context, history_search_results, *knowledge_lists):
+        """
+        组装检索上下文：当前会话 + 历史检索 + 知识库（多路结果去重后重排），
+        近重复的历史/知识库片段（SimHash）只保留最相关的一条，再按相关度/token 装入上下文预算
+        history_search_results: 一个或多个 hybrid_history_search 的返回值（None 表示未检索）
+        knowledge_lists: 一个或多个 search_knowledge_base 的返回值
+        返回 (带来源标记的文本列表, 打包报告)
+        """
+        candidates = []
         
-        # 1. 获取长期记忆 facts
-        user_facts = load_long_term_memory(username)
-        facts_context = ""
-        if user_facts:
-            facts_context = "\n【用户的已知偏好/信息】：\n" + "\n".join(f"- {f}" for f in user_facts)
+        # 当前会话上下文，标记来源（相关度最高）
+        if history_context:
+            candidates.append({"text": history_context, "score": 1.5, "source": "session", "label": "[当前会话上下文]"})
         
-        # 2. 获取历史会话摘要
-        summaries_data = get_user_summaries(username)
-        summaries_context = ""
-        if summaries_data:
-            summary_texts = [s["summary"] for s in summaries_data[-3:]]
-            summaries_context = "\n【该用户的历史会话摘要】：\n" + "\n".join(f"- {s}" for s in summary_texts)
+        # 多路历史检索结果按会话 + 内容去重合并，同一片段取最高相关度
+        history_items = {}
+        for search_result in history_search_results:
+            for item in (search_result or {}).get("results", []):
+                key = (item.get("session_id", ""), item.get("content", "")[:100])
+                if key not in history_items or item.get("relevance", 0.0) > history_items[key].get("relevance", 0.0):
+                    history_items[key] = item
         
-        # 3. 当前会话处理：轮数<=5 且 token<800 → 用原始对话；否则用摘要
-        dialogue = [m for m in recent_messages if m["role"] in ("user", "assistant")]
-        history_text = ""
-        history_source = "direct"  # 标记来源
+        for item in history_items.values():
+            candidates.append({"text": item.get("content", ""),
+                               "score": HISTORY_RELEVANCE_WEIGHT * item.get("relevance", 0.0),
+                               "source": "history", "label": history_result_label(item),
+                               "fingerprint": item.get("fingerprint")})
         
-        # 计算对话总token数（简单估算：中文约1字=1token）
-        total_chars = sum(len(m.get("content", "")) for m in dialogue)
-        total_tokens_est = total_chars // 2  # 中文字符转token估算
+        # 多路知识库结果按文档去重，同一文档取最高相关度
+        merged = {}
+        for hits in knowledge_lists:
+            for hit in hits or []:
+                if hit["text"] not in merged or hit["score"] > merged[hit["text"]]["score"]:
+                    merged[hit["text"]] = hit
+        merged = dict(sorted(merged.items(), key=lambda item: item[1]["score"], reverse=True))
         
-        # 判断：轮数<=5 且 token<阈值 → 用原始对话
-        if len(dialogue) <= MAX_TURNS_FOR_DIRECT and total_tokens_est <= MAX_TOKENS_FOR_DIRECT:
-            # 对话短，用原始对话
-            history_text = "\n【当前对话内容】：\n" + "\n".join(
-                f"{'用户' if m['role']=='user' else '助手'}: {m['content'][:500]}"
-                for m in dialogue
-            )
-        else:
-            # 对话长或token多，用摘要
-            summary = generate_session_summary(recent_messages, st.session_state.current_session)
-            if summary:
-                history_text = "\n【当前对话摘要】：\n" + summary
-                history_source = "summary"
-                # 同时保存摘要到向量库
-                save_to_history_vectorstore(username, [summary], "current_summary")
+        # 多保留几条候选，由打包器按预算取舍
+        knowledge_results = rerank(query, list(merged), top_k=10)
         
-        # 4. 构造改写Prompt
-        prompt = (
-            f"你需要根据上下文，补全用户最新问题中的指代词和省略内容。\n\n"
-            f"{facts_context}"
-            f"{summaries_context}"
-            f"{history_text}\n\n"
-            f"【用户最新问题】：{user_input}\n\n"
-            "请将问题改写为一个独立、完整的检索查询，只返回改写后的查询，不要解释。"
-            "如果问题已经完整，直接返回原问题。"
-        )
+        # 合并知识库结果
+        for text in knowledge_results:
+            candidates.append({"text": text, "score": merged[text]["score"], "source": "knowledge", "label": "[知识库]",
+                               "fingerprint": merged[text]["fingerprint"]})
         
-        rewritten = call_deepseek_api_retry(
-            prompt=prompt,
-            max_tokens=100,
-            timeout=30
+        # 近重复过滤：按相关度从高到低，当前会话上下文不参与
+        candidates.sort(key=lambda c: c["score"], reverse=True)
+        session_candidates = [c for c in candidates if c["source"] == "session"]
+        deduped, dedup_report = get_near_duplicate_filter().filter(
+            [c for c in candidates if c["source"] != "session"]
         )
         
-        if rewritten:
-            return rewritten, history_source
-        return user_input, "error"
-
-    def check_if_answered_by_history(query, username, rewritten_query, history_context):
-        """检查问题是否可以被历史上下文直接回答"""
-        # 如果有足够的当前会话上下文，可能不需要额外检索
-        if history_context and len(history_context) > 50:
-            prompt = (
-                f"基于以下上下文，判断能否直接回答用户问题。\n\n"
-                f"上下文：\n{history_context[:800]}\n\n"  # 限制长度
-                f"用户问题：{query}\n\n"
-                "如果上下文能回答问题，返回'是'；如果需要更多外部知识，返回'否'。"
-                "只返回'是'或'否'，不要其他内容。"
-            )
-            
-            result = call_deepseek_api_retry(
-                prompt=prompt,
-                max_tokens=50,
-                timeout=30
-            )
-            
-            return result == "是" if result else False
-        return False
+        packed, report = get_context_packer().pack(session_candidates + deduped)
+        report["near_duplicates"] = dedup_report
+        return [f"{c['label']} {c['text']}" for c in packed], report
 
     # ------------------- 侧边栏：API Key 管理 -------------------
-    with st.sidebar:
+    # 侧边栏的两个区域和聊天记录各自是一个 fragment：区域内的点击只重跑该区域，
+    # 只有会影响其他区域的操作（切换会话、保存 Key、提交编辑等）才调用 st.rerun() 整页重跑
+    @timed_fragment("API Key 面板")
+    def render_api_key_panel():
         st.header("🔑 API Key 设置")
         
         # 初始化 API Key 相关 session_state
@@ -1041,7 +1588,7 @@ else:
             with col1:
                 if st.button("显示" if not st.session_state.show_api_key else "隐藏", key="toggle_show_key"):
                     st.session_state.show_api_key = not st.session_state.show_api_key
-                    st.rerun()
+                    rerun_fragment()
             with col2:
                 if st.button("🗑️清除", key="clear_api_key"):
                     delete_api_key(st.session_state.username)
@@ -1079,18 +1626,15 @@ else:
         with col_cancel:
             if st.button("🔄重置", key="reset_api_key_btn"):
                 st.session_state.api_key_input = ""
-                st.rerun()
+                rerun_fragment()
         
         st.divider()
-        
-        # 使用保存的或当前输入的 API Key
-        current_api_key = saved_api_key if saved_api_key else api_key_input
-        if current_api_key:
-            # 更新全局 API Key（确保所有 API 调用都能使用）
-            DEEPSEEK_API_KEY = current_api_key
-        else:
-            # 如果没有 API Key，设置默认值（让代码不报错，但实际调用会失败）
-            DEEPSEEK_API_KEY = ""
+
+    # ------------------- 侧边栏：会话管理 -------------------
+    @timed_fragment("会话列表")
+    def render_session_sidebar():
+        # 使用保存的或当前输入的 API Key（全局 DEEPSEEK_API_KEY 由聊天界面设置）
+        current_api_key = load_api_key(st.session_state.username) or st.session_state.get("api_key_text_input", "")
         
         st.header(f"💬{st.session_state.username}的对话历史")
         if st.button("新建对话", key="new_chat"):
@@ -1098,28 +1642,28 @@ else:
             old_session_id = st.session_state.current_session
             if old_session_id and old_session_id in st.session_state.conversations:
                 old_messages = st.session_state.conversations[old_session_id]["messages"]
-                summary = generate_session_summary(old_messages, old_session_id)
-                if summary:
-                    save_to_history_vectorstore(st.session_state.username, [summary], "summary")
+                # 后台生成，不阻塞新建对话
+                enqueue_post_turn_jobs(st.session_state.username, old_session_id, old_messages,
+                                       api_key=current_api_key, summary=True)
             
             # 生成唯一 ID（使用时间戳避免重复）
-            import uuid
             new_id = f"chat_{int(time.time() * 1000)}"
-            st.session_state.conversations[new_id] = {
-                "title": f"对话 {len(st.session_state.conversations) + 1}",
-                "messages": [
-                    {"role": "system", "content": build_system_prompt(st.session_state.username)},
-                    {"role": "assistant", "content": "你好，我是小锐助手，有什么需要帮助的吗？"}
-                ]
-            }
-            st.session_state.current_session = new_id
-            save_conversations(st.session_state.username)
+            session_count = len(get_conversation_store().list_sessions(st.session_state.username))
+            create_session(st.session_state.username, new_id, f"对话 {session_count + 1}")
+            st.session_state.session_page = 0
             st.rerun()
 
         st.subheader("对话列表")
+        # 会话列表由元数据索引驱动并分页，只渲染当前页的按钮
+        sessions_meta = load_session_index(st.session_state.username)
+        total_pages = max(1, (len(sessions_meta) + SESSIONS_PER_PAGE - 1) // SESSIONS_PER_PAGE)
+        page = min(st.session_state.get("session_page", 0), total_pages - 1)
+        page_sessions = sessions_meta[page * SESSIONS_PER_PAGE:(page + 1) * SESSIONS_PER_PAGE]
+        
         # 可点击的对话列表，每个后面带删除按钮
-        for session_id in list(st.session_state.conversations.keys()):
-            session_title = st.session_state.conversations[session_id]["title"]
+        for meta in page_sessions:
+            session_id = meta["session_id"]
+            session_title = meta["title"]
             col1, col2 = st.columns([4, 1])
             with col1:
                 # 当前选中的对话高亮显示
@@ -1130,53 +1674,48 @@ else:
                     st.rerun()
             with col2:
                 if st.button("🗑️", key=f"delete_{session_id}", help=f"删除「{session_title}」"):
-                    # 直接在内存中删除，不需要调用 delete_session
-                    if session_id in st.session_state.conversations:
-                        del st.session_state.conversations[session_id]
-                        
-                        # 切换到第一个可用会话
-                        if st.session_state.conversations:
-                            st.session_state.current_session = list(st.session_state.conversations.keys())[0]
-                        else:
-                            # 如果没有会话了，创建新的
-                            new_id = "default"
-                            st.session_state.conversations = {
-                                new_id: {
-                                    "title": "新对话",
-                                    "messages": [
-                                        {"role": "system", "content": build_system_prompt(st.session_state.username)},
-                                        {"role": "assistant", "content": "你好，我是小锐助手，有什么需要帮助的吗？"}
-                                    ]
-                                }
-                            }
-                            st.session_state.current_session = new_id
-                        
-                        # 同时删除文件中的数据和向量库
-                        delete_session(st.session_state.username, session_id)
-                        save_conversations(st.session_state.username)
+                    # 删除存储中的会话、摘要和向量库数据，再移出内存
+                    deleted, message = delete_session(st.session_state.username, session_id)
+                    if deleted:
+                        st.session_state.conversations.pop(session_id, None)
+                        if session_id == st.session_state.current_session:
+                            # 切换到最近更新的会话；没有会话了就创建新的
+                            remaining = load_session_index(st.session_state.username)
+                            if remaining:
+                                st.session_state.current_session = remaining[0]["session_id"]
+                            else:
+                                create_session(st.session_state.username, "default", "新对话")
                         st.rerun()
                     else:
-                        st.error("会话不存在")
+                        st.error(message)
+        
+        if total_pages > 1:
+            col1, col2, col3 = st.columns([1, 2, 1])
+            with col1:
+                if st.button("◀", key="session_page_prev", disabled=page == 0):
+                    st.session_state.session_page = page - 1
+                    rerun_fragment()
+            with col2:
+                st.caption(f"第 {page + 1}/{total_pages} 页，共 {len(sessions_meta)} 个对话")
+            with col3:
+                if st.button("▶", key="session_page_next", disabled=page >= total_pages - 1):
+                    st.session_state.session_page = page + 1
+                    rerun_fragment()
 
         current_conv = st.session_state.conversations[st.session_state.current_session]
         if len(current_conv["messages"]) > 2:
             title = st.text_input("重命名对话：", value=current_conv["title"], key="rename")
             if title != current_conv["title"]:
                 current_conv["title"] = title
-                save_conversations(st.session_state.username)
+                save_conversations(st.session_state.username, st.session_state.current_session)
 
         if st.button("清除所有对话历史", key="clear_history"):
-            st.session_state.conversations = {
-                "default": {
-                    "title": "新对话",
-                    "messages": [
-                        {"role": "system", "content": build_system_prompt(st.session_state.username)},
-                        {"role": "assistant", "content": "你好，我是小锐助手，有什么需要帮助的吗？"}
-                    ]
-                }
-            }
-            st.session_state.current_session = "default"
-            save_conversations(st.session_state.username)
+            for meta in load_session_index(st.session_state.username):
+                delete_session(st.session_state.username, meta["session_id"])
+            st.session_state.conversations = {}
+            st.session_state.recent_sessions = []
+            st.session_state.session_page = 0
+            create_session(st.session_state.username, "default", "新对话")
             st.rerun()
 
         if "show_delete_confirmation" not in st.session_state:
@@ -1202,6 +1741,150 @@ else:
             st.session_state.show_delete_confirmation = False
             st.rerun()
 
+        # ------------------- 性能统计 -------------------
+        with st.expander("📊 性能统计"):
+            pool_stats = deepseek_client.get_deepseek_client().stats()
+            st.caption(
+                f"API 连接池（{pool_stats['protocol']}，池大小 {pool_stats['pool_size']}）："
+                f"请求 {pool_stats['requests']} 次，新建连接 {pool_stats['new_connections']} 个，"
+                f"复用率 {pool_stats['reuse_rate']:.0%}，失败 {pool_stats['errors']} 次，预热连接 {pool_stats['warmed']} 个"
+            )
+            # 只展示已加载的资源，面板本身不触发模型加载
+            query_embedder = get_query_embedder() if STARTUP_PROFILE.loaded("查询向量缓存") else None
+            if query_embedder:
+                embed_stats = query_embedder.stats()
+                st.caption(
+                    f"查询向量缓存：{embed_stats['size']}/{embed_stats['maxsize']} 条，"
+                    f"命中 {embed_stats['hits']} 次，未命中 {embed_stats['misses']} 次，"
+                    f"命中率 {embed_stats['hit_rate']:.0%}"
+                )
+            for model_report in get_embedding_registry().report():
+                memory_text = "，".join(
+                    text for text in (
+                        f"权重 {model_report['parameter_mb']:.0f} MB" if model_report["parameter_mb"] is not None else "",
+                        f"RSS +{model_report['rss_delta_mb']:.0f} MB" if model_report["rss_delta_mb"] is not None else ""
+                    ) if text
+                )
+                st.caption(
+                    f"向量模型 {model_report['model']}（{model_report['backend']}）：加载 {model_report['load_seconds']:.1f}s"
+                    f"{'（' + memory_text + '）' if memory_text else ''}，"
+                    f"线程 {model_report['threads'] or '默认'}，查询编码 {model_report['queries']} 次，"
+                    f"批量编码 {model_report['documents']} 条（{model_report['batches']} 批）"
+                )
+            judge_stats = get_sufficiency_judge().stats()
+            st.caption(
+                f"充分性判断：共 {judge_stats['total']} 次，本地判定 {judge_stats['local']} 次，"
+                f"回退 LLM {judge_stats['fallbacks']} 次（{judge_stats['fallback_rate']:.0%}），"
+                f"回退时本地倾向一致率 {judge_stats['agreement_rate']:.0%}，校准样本 {judge_stats['samples']} 条"
+            )
+            gate_stats = get_rewrite_gate().stats()
+            st.caption(
+                f"Query 改写：共 {gate_stats['total']} 次，跳过 {gate_stats['skipped']} 次（{gate_stats['skip_rate']:.0%}），"
+                f"缓存命中 {gate_stats['cache_hits']} 次（{gate_stats['hit_rate']:.0%}），"
+                f"调用 API {gate_stats['llm_calls']} 次，节省 {gate_stats['saved_calls']} 次往返"
+            )
+            token_stats = get_token_counter().stats()
+            if not token_stats["exact"]:
+                st.caption("⚠️ 未找到 DeepSeek 分词器，token 数为按字符比例的估算值（`python token_counter.py download` 下载）")
+            st.caption(
+                f"Token 计数（{token_stats['backend']}）：缓存 {token_stats['cached']} 条，"
+                f"命中率 {token_stats['hit_rate']:.0%}，实际计算 {token_stats['misses']} 次"
+            )
+            file_cache_stats = get_json_cache().stats()
+            st.caption(
+                f"配置/记忆文件缓存：{file_cache_stats['entries']} 个文件，"
+                f"命中 {file_cache_stats['hits']} 次，读盘 {file_cache_stats['misses']} 次，"
+                f"命中率 {file_cache_stats['hit_rate']:.0%}，写入 {file_cache_stats['writes']} 次"
+            )
+            dedup_stats = get_near_duplicate_filter().stats()
+            st.caption(
+                f"近重复过滤：累计 {dedup_stats['total']} 条候选，去掉 {dedup_stats['dropped']} 条"
+                f"（{dedup_stats['ratio']:.0%}）" + "".join(
+                    f"，{source} {ratio:.0%}" for source, ratio in dedup_stats["by_source"].items()
+                )
+            )
+            job_stats = get_job_queue().stats()
+            st.caption(
+                f"后台任务：排队 {job_stats['depth']} 个，完成 {job_stats['processed']} 个，"
+                f"失败 {job_stats['failed']} 个（重试 {job_stats['retried']} 次，待重试 {job_stats['retrying']} 个），"
+                f"合并 {job_stats['deduped']} 个，"
+                f"平均等待 {job_stats['avg_wait']:.1f}s，平均执行 {job_stats['avg_run']:.1f}s"
+            )
+            turn_timings = st.session_state.get("last_turn_timings")
+            if turn_timings:
+                stage_text = "，".join(
+                    f"{t['stage']} {t['duration']:.2f}s" for t in turn_timings["stages"]
+                )
+                ttft_text = f"首字 {turn_timings['ttft']:.2f}s，" if turn_timings["ttft"] is not None else ""
+                st.caption(
+                    f"上一轮：检索流水线 {turn_timings['pipeline_total']:.2f}s（{stage_text}），"
+                    f"{ttft_text}总计 {turn_timings['total']:.2f}s"
+                )
+                if turn_timings.get("embeddings"):
+                    st.caption(
+                        f"上一轮查询编码：请求 {turn_timings['embeddings']['requests']} 次，"
+                        f"涉及 {turn_timings['embeddings']['distinct']} 个不同查询"
+                    )
+                if turn_timings.get("history_window"):
+                    window_report = turn_timings["history_window"]
+                    st.caption(
+                        f"上一轮历史窗口：发送 {window_report['kept_messages']} 条消息（约 {window_report['kept_tokens']} tokens），"
+                        f"省略 {window_report['dropped_messages']} 条（约 {window_report['dropped_tokens']} tokens）"
+                        f"{'，已用摘要代替' if window_report['summary_used'] else ''}"
+                    )
+                if turn_timings.get("context_pack"):
+                    pack_report = turn_timings["context_pack"]
+                    st.caption(
+                        f"上一轮检索上下文：候选 {pack_report['candidates']} 条，装入 {pack_report['packed']} 条"
+                        f"（{pack_report['packed_tokens']}/{pack_report['budget']} tokens），"
+                        f"丢弃 {pack_report['dropped']} 条（约 {pack_report['dropped_tokens']} tokens，"
+                        f"其中重叠 {pack_report['overlap_dropped']} 条）"
+                    )
+                    dedup_report = pack_report.get("near_duplicates")
+                    if dedup_report:
+                        st.caption(
+                            f"上一轮近重复过滤：{dedup_report['total']} 条中去掉 {dedup_report['dropped']} 条"
+                            f"（{dedup_report['ratio']:.0%}；" + "，".join(
+                                f"{source} {r['dropped']}/{r['total']}"
+                                for source, r in dedup_report["by_source"].items()
+                            ) + "）"
+                        )
+            fragment_timings = st.session_state.get("fragment_timings")
+            if fragment_timings:
+                st.caption("区域重跑：" + "，".join(
+                    f"{name} 上次 {t['last'] * 1000:.0f} ms / 平均 {t['total'] / t['runs'] * 1000:.0f} ms（{t['runs']} 次）"
+                    for name, t in fragment_timings.items()
+                ))
+            warmup_status = get_warmup().status()
+            failed_steps = [f"{step['name']}（{step['error']}）" for step in warmup_status["steps"] if step["state"] == "failed"]
+            if warmup_status["finished"]:
+                warmup_text = f"{'已就绪' if warmup_status['ready'] else '未就绪'}，用时 {warmup_status['elapsed']:.1f}s"
+            else:
+                done = sum(1 for step in warmup_status["steps"] if step["state"] in ("ok", "failed"))
+                warmup_text = f"进行中（{done}/{len(warmup_status['steps'])} 步）"
+            st.caption(
+                f"启动预热：{warmup_text}"
+                f"{'，失败：' + '、'.join(failed_steps) if failed_steps else ''}"
+                f"{'，' + warmup_status['server_error'] if warmup_status['server_error'] else ''}"
+            )
+            startup = STARTUP_PROFILE.report()
+            marks_text = "，".join(f"{name} {seconds:.2f}s" for name, seconds in startup["marks"].items())
+            st.caption(
+                f"启动：导入 {startup['import_seconds']:.2f}s（" + "，".join(
+                    f"{e['name']} {e['seconds']:.2f}s" for e in startup["imports"]
+                ) + f"），{marks_text}"
+            )
+            if startup["resources"]:
+                st.caption("资源构建：" + "，".join(
+                    f"{e['name']} {e['seconds']:.2f}s{'' if e['ok'] else '（不可用）'}"
+                    for e in startup["resources"]
+                ))
+
+    with st.sidebar:
+        render_api_key_panel()
+        render_session_sidebar()
+    STARTUP_PROFILE.mark("主页面就绪")
+
     # ------------------- 聊天界面 -------------------
     st.title(f"💡锐瞳智能科技公司——小锐智能体（欢迎，{st.session_state.username}）")
     
@@ -1233,59 +1916,79 @@ else:
     if "regenerate" not in st.session_state:
         st.session_state.regenerate = False
 
-    # 显示消息
-    for i, msg in enumerate(current_messages):
-        if msg["role"] != "system":
-            # 检查是否在编辑模式
-            if st.session_state.edit_mode and st.session_state.editing_index == i:
-                # 显示编辑框
-                edited_text = st.text_area("编辑问题：", value=msg["content"], height=100, key=f"edit_input_{i}")
-                col1, col2 = st.columns([1, 4])
-                with col1:
-                    if st.button("✅ 确认", key=f"confirm_edit_{i}"):
-                        # 更新消息内容
-                        current_messages[i]["content"] = edited_text
-                        # 删除该消息之后的所有回复（assistant消息）
-                        while len(current_messages) > i + 1:
-                            if current_messages[-1]["role"] == "assistant":
-                                current_messages.pop()
-                        save_conversations(st.session_state.username)
-                        st.session_state.edit_mode = False
-                        st.session_state.editing_index = None
-                        st.session_state.regenerate = True
-                        st.rerun()
-                with col2:
-                    if st.button("❌ 取消", key=f"cancel_edit_{i}"):
-                        st.session_state.edit_mode = False
-                        st.session_state.editing_index = None
-                        st.rerun()
-            else:
-                with st.chat_message(msg["role"]):
-                    st.write(msg["content"])
-                    # 在用户消息后显示编辑按钮
-                    if msg["role"] == "user" and i == len(current_messages) - 1:
-                        col1, col2 = st.columns([1, 1])
-                        with col1:
-                            if st.button("✏️ 编辑", key=f"edit_btn_{i}"):
-                                st.session_state.edit_mode = True
-                                st.session_state.editing_index = i
-                                st.session_state.edit_text = msg["content"]
-                                st.rerun()
-                        with col2:
-                            if st.button("🔄 重新生成", key=f"regenerate_btn_{i}"):
-                                # 删除最后一条助手回复
-                                if len(current_messages) > i + 1 and current_messages[-1]["role"] == "assistant":
+    # ------------------- 聊天记录（可独立重跑） -------------------
+    @timed_fragment("聊天记录")
+    def render_chat_history():
+        current_messages = st.session_state.conversations[st.session_state.current_session]["messages"]
+        
+        # 显示消息：只渲染最近 CHAT_WINDOW_SIZE 条，更早的消息点击后再加载
+        if "chat_window" not in st.session_state:
+            st.session_state.chat_window = {}
+        window_size = st.session_state.chat_window.get(st.session_state.current_session, CHAT_WINDOW_SIZE)
+        visible_indices = [i for i, m in enumerate(current_messages) if m["role"] != "system"]
+        hidden_count = max(0, len(visible_indices) - window_size)
+        if hidden_count:
+            if st.button(f"⬆️ 加载更早的消息（还有 {hidden_count} 条）", key="load_earlier"):
+                st.session_state.chat_window[st.session_state.current_session] = window_size + CHAT_WINDOW_SIZE
+                rerun_fragment()
+    
+        # 编辑/重新生成只作用于最后一条消息，始终在可见窗口内；i 仍是在 current_messages 中的下标
+        for i in visible_indices[hidden_count:]:
+            msg = current_messages[i]
+            if msg["role"] != "system":
+                # 检查是否在编辑模式
+                if st.session_state.edit_mode and st.session_state.editing_index == i:
+                    # 显示编辑框
+                    edited_text = st.text_area("编辑问题：", value=msg["content"], height=100, key=f"edit_input_{i}")
+                    col1, col2 = st.columns([1, 4])
+                    with col1:
+                        if st.button("✅ 确认", key=f"confirm_edit_{i}"):
+                            # 更新消息内容
+                            current_messages[i]["content"] = edited_text
+                            current_messages[i].pop("tokens", None)  # 内容变了，token 计数重新计算
+                            # 删除该消息之后的所有回复（assistant消息）
+                            while len(current_messages) > i + 1:
+                                if current_messages[-1]["role"] == "assistant":
                                     current_messages.pop()
-                                save_conversations(st.session_state.username)
+                            save_conversations(st.session_state.username, st.session_state.current_session)
+                            st.session_state.edit_mode = False
+                            st.session_state.editing_index = None
+                            st.session_state.regenerate = True
+                            st.rerun()  # 整页重跑，由下方的生成流程处理
+                    with col2:
+                        if st.button("❌ 取消", key=f"cancel_edit_{i}"):
+                            st.session_state.edit_mode = False
+                            st.session_state.editing_index = None
+                            rerun_fragment()
+                else:
+                    with st.chat_message(msg["role"]):
+                        st.markdown(msg["content"])
+                        # 在用户消息后显示编辑按钮
+                        if msg["role"] == "user" and i == len(current_messages) - 1:
+                            col1, col2 = st.columns([1, 1])
+                            with col1:
+                                if st.button("✏️ 编辑", key=f"edit_btn_{i}"):
+                                    st.session_state.edit_mode = True
+                                    st.session_state.editing_index = i
+                                    st.session_state.edit_text = msg["content"]
+                                    rerun_fragment()
+                            with col2:
+                                if st.button("🔄 重新生成", key=f"regenerate_btn_{i}"):
+                                    # 删除最后一条助手回复
+                                    if len(current_messages) > i + 1 and current_messages[-1]["role"] == "assistant":
+                                        current_messages.pop()
+                                    save_conversations(st.session_state.username, st.session_state.current_session)
+                                    st.session_state.regenerate = True
+                                    st.rerun()
+                        # 在助手消息后显示重新生成按钮
+                        elif msg["role"] == "assistant" and i == len(current_messages) - 1:
+                            if st.button("🔄 重新生成", key="regenerate_last_btn"):
+                                current_messages.pop()  # 删除助手回复
+                                save_conversations(st.session_state.username, st.session_state.current_session)
                                 st.session_state.regenerate = True
                                 st.rerun()
-                    # 在助手消息后显示重新生成按钮
-                    elif msg["role"] == "assistant" and i == len(current_messages) - 1:
-                        if st.button("🔄 重新生成", key="regenerate_last_btn"):
-                            current_messages.pop()  # 删除助手回复
-                            save_conversations(st.session_state.username)
-                            st.session_state.regenerate = True
-                            st.rerun()
+
+    render_chat_history()
 
     # 输入框
     user_input = st.chat_input("请输入您的问题...", key=f"chat_input_{st.session_state.current_session}")
@@ -1313,74 +2016,130 @@ else:
                 current_messages.pop()
         
         with st.chat_message("assistant"):
+            username = st.session_state.username
+            session_id = st.session_state.current_session
+            turn_start = time.perf_counter()
+            
             # 获取当前会话对话
             recent = [m for m in current_messages if m["role"] in ("user", "assistant")]
             
-            # 计算对话轮数和token数
-            total_chars = sum(len(m.get("content", "")) for m in recent)
-            total_tokens_est = total_chars // 2
+            # 计算对话轮数和token数（每条消息的计数缓存在消息上）
+            total_tokens_est = sum(message_tokens(m) for m in recent)
             
             # 简化判断：轮数<=8 且 token<2000 时直接使用对话历史
             use_direct = len(recent) <= 8 and total_tokens_est <= 2000
             
-            if use_direct:
-                # 用原始对话作为上下文
-                history_context = "\n".join(
-                    f"{'用户' if m['role']=='user' else '助手'}: {m['content']}"
-                    for m in recent
-                )
-            else:
-                # 对话太长，生成摘要
-                with st.spinner("正在生成答案..."):
-                    summary = generate_session_summary(current_messages, st.session_state.current_session)
-                    history_context = summary if summary else ""
+            def stage_history_context():
+                if use_direct:
+                    # 用原始对话作为上下文
+                    return "\n".join(
+                        f"{'用户' if m['role']=='user' else '助手'}: {m['content']}"
+                        for m in recent
+                    )
+                # 对话太长，使用滚动摘要 + 最近几轮原文
+                return build_session_history_context(username, current_messages, session_id, api_key=current_api_key)
             
-            # Step 1: Query改写（简化版，不重复生成摘要）
-            search_query = user_input  # 默认使用原问题
-            if history_context or get_user_summaries(st.session_state.username):
-                # 只有在有上下文时才改写
-                user_facts = load_long_term_memory(st.session_state.username)
-                facts_context = "\n【用户偏好】：" + "\n".join(f"- {f}" for f in user_facts) if user_facts else ""
+            def stage_rewrite(history_context):
+                # Query改写（简化版，不重复生成摘要），默认使用原问题
+                if not (history_context or get_user_summaries(username)):
+                    return user_input
+                # 只有在有上下文时才改写；问题本身完整（无指代/省略）时由门控直接跳过
+                def llm_rewrite():
+                    user_facts = load_long_term_memory(username)
+                    facts_context = "\n【用户偏好】：" + "\n".join(f"- {f}" for f in user_facts) if user_facts else ""
+                    
+                    prompt = (
+                        f"{facts_context}\n\n"
+                        f"对话历史：\n{truncate_tokens(history_context, 500)}\n\n"
+                        f"用户问题：{user_input}\n\n"
+                        "请补全问题中的指代词，只返回改写后的问题。"
+                    )
+                    
+                    return call_deepseek_api_retry(prompt=prompt, max_tokens=100, timeout=30, api_key=current_api_key)
                 
-                prompt = (
-                    f"{facts_context}\n\n"
-                    f"对话历史：\n{history_context[:1000]}\n\n"
-                    f"用户问题：{user_input}\n\n"
-                    "请补全问题中的指代词，只返回改写后的问题。"
-                )
-                
-                result = call_deepseek_api_retry(prompt=prompt, max_tokens=100, timeout=30)
-                if result:
-                    search_query = result
+                return get_rewrite_gate().rewrite(user_input, truncate_tokens(history_context, 500), llm_rewrite)
+            
+            # 本轮查询向量上下文：同一查询字符串只编码一次，知识库和历史库共用
+            query_embedder = get_query_embedder()
+            embedding_ctx = TurnEmbeddingContext(query_embedder) if query_embedder else None
+            
+            def stage_kb_rewritten(rewrite):
+                # 改写后的问题与原问题不同时，补充一次知识库检索
+                if rewrite == user_input:
+                    return []
+                return search_knowledge_base(rewrite, embedding_ctx)
+            
+            def stage_history_rewritten(rewrite):
+                # 改写后的问题补全了指代/省略，同样补充一次历史检索
+                if rewrite == user_input:
+                    return None
+                return hybrid_history_search(rewrite, username, embedding_ctx=embedding_ctx)
+            
+            # 并发流水线：知识库检索、历史检索与摘要/改写同时进行
+            pipeline = TurnPipeline()
+            pipeline.add_stage("history_context", stage_history_context)
+            pipeline.add_stage("kb_search", lambda: search_knowledge_base(user_input, embedding_ctx))
+            pipeline.add_stage("history_search",
+                               lambda: hybrid_history_search(user_input, username, embedding_ctx=embedding_ctx))
+            pipeline.add_stage("rewrite", stage_rewrite, deps=("history_context",))
+            pipeline.add_stage("kb_search_rewritten", stage_kb_rewritten, deps=("rewrite",))
+            pipeline.add_stage("history_search_rewritten", stage_history_rewritten, deps=("rewrite",))
             
-            # Step 2: 直接检索上下文
             with st.spinner("正在检索知识库..."):
-                text_docs = retrieve_context(search_query, st.session_state.username, history_context, need_full_retrieval=True)
+                stage_results = pipeline.run()
+                history_context = stage_results["history_context"] or ""
+                search_query = stage_results["rewrite"] or user_input
+                text_docs, pack_report = build_context_results(
+                    search_query,
+                    history_context,
+                    [stage_results["history_search_rewritten"], stage_results["history_search"]],
+                    stage_results["kb_search_rewritten"],
+                    stage_results["kb_search"]
+                )
                 context_str = "\n".join(text_docs) if text_docs else None
             
+            for stage_name, error in pipeline.errors.items():
+                st.warning(f"检索阶段 {stage_name} 失败: {error}")
+            
             # 流式输出回答
             reply = ""
+            first_token_time = None
             message_placeholder = st.empty()
-            for chunk in call_deepseek_api_stream(current_messages, context_str, api_key=current_api_key):
+            # 只发送 system prompt + 摘要 + 预算内的最近几轮，不再发送整个会话
+            messages_to_send, window_report = apply_history_window(username, session_id, current_messages)
+            for chunk in call_deepseek_api_stream(messages_to_send, context_str, api_key=current_api_key):
                 if chunk == "__DONE__":
                     break
+                if first_token_time is None:
+                    first_token_time = time.perf_counter() - turn_start
                 reply += chunk
                 message_placeholder.write(reply + "▌")  # 闪烁光标效果
-            message_placeholder.write(reply)  # 最终显示
+            message_placeholder.markdown(reply)  # 最终显示
+            
+            # 记录本轮各阶段耗时，供性能统计面板展示
+            st.session_state.last_turn_timings = {
+                "stages": pipeline.timing_report(),
+                "pipeline_total": pipeline.total_time,
+                "embeddings": embedding_ctx.stats() if embedding_ctx else None,
+                "ttft": first_token_time,
+                "total": time.perf_counter() - turn_start,
+                "history_window": window_report,
+                "context_pack": pack_report
+            }
 
         current_messages.append({"role": "assistant", "content": reply})
-        save_conversations(st.session_state.username)
+        save_conversations(st.session_state.username, st.session_state.current_session)
 
-        # 每 3 轮提取一次长期记忆
+        # 每 3 轮提取一次长期记忆；达到阈值时生成会话摘要（均在后台执行）
         user_msg_count = sum(1 for m in current_messages if m["role"] == "user")
-        if user_msg_count % 3 == 0:
-            extract_and_update_memory(st.session_state.username, current_messages)
-        
-        # 检查是否需要生成会话摘要
-        if user_msg_count == SESSION_SUMMARY_THRESHOLD:
-            summary = generate_session_summary(current_messages, st.session_state.current_session)
-            if summary:
-                save_to_history_vectorstore(st.session_state.username, [summary], "summary")
+        enqueue_post_turn_jobs(
+            st.session_state.username,
+            st.session_state.current_session,
+            current_messages,
+            api_key=current_api_key,
+            memory=user_msg_count % 3 == 0,
+            summary=user_msg_count == SESSION_SUMMARY_THRESHOLD
+        )
 
     # ------------------- 操作指南 -------------------
     if st.checkbox("操作指南"):
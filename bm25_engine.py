@@ -0,0 +1,247 @@
+"""
+持久化稀疏 BM25 引擎
+
+替代每次进程启动都用 rank_bm25.BM25Okapi 重建索引、每次查询在 Python 里遍历全部文档：
+- 倒排表以 CSR 数组（按词项分行）保存到磁盘，加载时 np.load(mmap_mode="r") 内存映射
+- 每条倒排记录预先算好 BM25 权重（idf × tf 归一化），查询时只累加查询词命中的倒排
+- 用 np.argpartition 取 top-k，不对全部文档排序
+- 索引记录知识库签名（文档 id + 存储版本戳，启动时不读正文）和分词器版本，二者变化时才重建；
+  重建时顺带记录全文指纹（meta.json 的 text_hash）
+- 可选地为每个文档预先计算近重复指纹（simhash.npy，与 ids.json 对齐），查询去重时直接取用
+评分公式与 rank_bm25.BM25Okapi 一致（k1=1.5, b=0.75, epsilon=0.25）。
+"""
+import hashlib
+import json
+import os
+import shutil
+import time
+from collections import Counter
+
+import numpy as np
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+BM25_EPSILON = 0.25
+INDEX_FORMAT_VERSION = 2
+
+
+def collection_signature(doc_ids, stamp=""):
+    """
+    知识库签名（每次启动时计算，不读取正文）：文档 id 集合 + 数量 + 存储版本戳
+    stamp: 知识库写入时会变化的标记（导入脚本写的版本号，或向量库数据库文件的修改时间），
+    同一 id 下的正文被修改时由它让签名变化
+    """
+    h = hashlib.sha1()
+    for doc_id in sorted(doc_ids):
+        h.update(doc_id.encode("utf-8"))
+        h.update(b"\0")
+    h.update(str(len(doc_ids)).encode("utf-8"))
+    h.update(b"\0")
+    h.update(str(stamp).encode("utf-8"))
+    return h.hexdigest()
+
+
+def _text_hash(digests):
+    """全文指纹：[(doc_id, 正文 sha1)] 按 id 排序后整体哈希（与读取顺序无关）"""
+    h = hashlib.sha1()
+    for doc_id, digest in sorted(digests):
+        h.update(doc_id.encode("utf-8"))
+        h.update(b"\0")
+        h.update(digest)
+    h.update(str(len(digests)).encode("utf-8"))
+    return h.hexdigest()
+
+
+def read_meta(index_dir):
+    path = os.path.join(index_dir, "meta.json")
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception:
+        return None
+
+
+class BM25Engine:
+    """从磁盘加载的 BM25 索引（只读）"""
+
+    def __init__(self, index_dir, mmap=True):
+        mmap_mode = "r" if mmap else None
+        self.index_dir = index_dir
+        self.meta = read_meta(index_dir)
+        with open(os.path.join(index_dir, "vocab.json"), "r", encoding="utf-8") as f:
+            self.vocab = json.load(f)
+        with open(os.path.join(index_dir, "ids.json"), "r", encoding="utf-8") as f:
+            self.doc_ids = json.load(f)
+        self.indptr = np.load(os.path.join(index_dir, "indptr.npy"), mmap_mode=mmap_mode)
+        self.postings = np.load(os.path.join(index_dir, "postings.npy"), mmap_mode=mmap_mode)
+        self.weights = np.load(os.path.join(index_dir, "weights.npy"), mmap_mode=mmap_mode)
+        fingerprint_path = os.path.join(index_dir, "simhash.npy")
+        self.fingerprints = (np.load(fingerprint_path, mmap_mode=mmap_mode)
+                             if os.path.exists(fingerprint_path) else None)
+        self._doc_index = None
+        self.n_docs = len(self.doc_ids)
+
+    @classmethod
+    def build(cls, index_dir, doc_batches, tokenize, content_hash, tokenizer_name,
+              k1=BM25_K1, b=BM25_B, epsilon=BM25_EPSILON, fingerprint=None):
+        """
+        构建索引并写入 index_dir
+        doc_batches: 可迭代的 [(doc_id, text), ...] 批次，避免一次性把全部文档放进内存
+        fingerprint: 可选，文本 → 64 位近重复指纹，结果保存为 simhash.npy
+        """
+        start = time.time()
+        vocab = {}
+        doc_ids = []
+        doc_lens = []
+        fingerprints = []
+        text_digests = []
+        term_rows, doc_cols, tfs = [], [], []
+
+        for batch in doc_batches:
+            for doc_id, text in batch:
+                doc_index = len(doc_ids)
+                doc_ids.append(doc_id)
+                text_digests.append((doc_id, hashlib.sha1((text or "").encode("utf-8")).digest()))
+                counts = Counter(tokenize(text or ""))
+                doc_lens.append(sum(counts.values()))
+                if fingerprint:
+                    fingerprints.append(fingerprint(text or ""))
+                for term, tf in counts.items():
+                    term_id = vocab.setdefault(term, len(vocab))
+                    term_rows.append(term_id)
+                    doc_cols.append(doc_index)
+                    tfs.append(tf)
+
+        n_docs = len(doc_ids)
+        term_rows = np.asarray(term_rows, dtype=np.int32)
+        doc_cols = np.asarray(doc_cols, dtype=np.int32)
+        tfs = np.asarray(tfs, dtype=np.float32)
+        doc_lens = np.asarray(doc_lens, dtype=np.float32)
+        avgdl = float(doc_lens.mean()) if n_docs else 0.0
+
+        # 按词项排序得到 CSR（行 = 词项，列 = 文档）
+        order = np.argsort(term_rows, kind="stable")
+        term_rows, doc_cols, tfs = term_rows[order], doc_cols[order], tfs[order]
+        df = np.bincount(term_rows, minlength=len(vocab))
+        indptr = np.zeros(len(vocab) + 1, dtype=np.int64)
+        np.cumsum(df, out=indptr[1:])
+        df = df.astype(np.float64)
+
+        # idf 与 rank_bm25 相同：负 idf 用 epsilon × 平均 idf 代替
+        idf = np.log(n_docs - df + 0.5) - np.log(df + 0.5)
+        if len(idf):
+            idf = np.where(idf < 0, epsilon * float(idf.mean()), idf)
+        dl = doc_lens[doc_cols]
+        weights = idf[term_rows] * tfs * (k1 + 1) / (tfs + k1 * (1 - b + b * dl / max(avgdl, 1e-9)))
+
+        tmp_dir = f"{index_dir}.tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        np.save(os.path.join(tmp_dir, "indptr.npy"), indptr)
+        np.save(os.path.join(tmp_dir, "postings.npy"), doc_cols)
+        np.save(os.path.join(tmp_dir, "weights.npy"), weights.astype(np.float32))
+        if fingerprint:
+            np.save(os.path.join(tmp_dir, "simhash.npy"), np.asarray(fingerprints, dtype=np.uint64))
+        with open(os.path.join(tmp_dir, "vocab.json"), "w", encoding="utf-8") as f:
+            json.dump(vocab, f, ensure_ascii=False)
+        with open(os.path.join(tmp_dir, "ids.json"), "w", encoding="utf-8") as f:
+            json.dump(doc_ids, f, ensure_ascii=False)
+        with open(os.path.join(tmp_dir, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump({
+                "format_version": INDEX_FORMAT_VERSION,
+                "content_hash": content_hash,
+                "text_hash": _text_hash(text_digests),
+                "tokenizer": tokenizer_name,
+                "n_docs": n_docs,
+                "n_terms": len(vocab),
+                "n_postings": int(len(doc_cols)),
+                "avgdl": avgdl,
+                "k1": k1,
+                "b": b,
+                "epsilon": epsilon,
+                "fingerprints": bool(fingerprint),
+                "build_seconds": round(time.time() - start, 3),
+                "built_at": time.strftime("%Y-%m-%dT%H:%M:%S")
+            }, f, ensure_ascii=False, indent=2)
+
+        shutil.rmtree(index_dir, ignore_errors=True)
+        os.replace(tmp_dir, index_dir)
+        return cls(index_dir)
+
+    def fingerprint(self, doc_id):
+        """文档的预计算近重复指纹（int）；索引没有保存指纹或 id 不存在时返回 None"""
+        if self.fingerprints is None:
+            return None
+        if self._doc_index is None:
+            self._doc_index = {d: i for i, d in enumerate(self.doc_ids)}
+        i = self._doc_index.get(doc_id)
+        return int(self.fingerprints[i]) if i is not None else None
+
+    def top_k(self, query_tokens, k=6):
+        """返回 [(doc_id, score), ...]，只包含得分 > 0 的文档，按得分降序"""
+        term_counts = Counter(t for t in query_tokens if t in self.vocab)
+        if not term_counts or not self.n_docs:
+            return []
+
+        doc_parts, weight_parts = [], []
+        for term, qf in term_counts.items():
+            term_id = self.vocab[term]
+            start, end = int(self.indptr[term_id]), int(self.indptr[term_id + 1])
+            doc_parts.append(self.postings[start:end])
+            # 查询中重复出现的词按次数累加，与 BM25Okapi.get_scores 一致
+            weight_parts.append(self.weights[start:end] * qf)
+
+        docs = np.concatenate(doc_parts)
+        # 只在命中的候选文档上累加，开销与倒排长度成正比，与知识库总量无关
+        candidates, inverse = np.unique(docs, return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(weight_parts))
+
+        k = min(k, len(candidates))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self.doc_ids[candidates[i]], float(scores[i])) for i in top if scores[i] > 0]
+
+    def scores(self, query_tokens, doc_ids):
+        """
+        指定文档的 BM25 得分 {doc_id: score}（与 top_k 同一公式），用于给其他检索通道命中的文档补算词法得分
+        只扫描查询词的倒排，不在索引中的 id 不返回
+        """
+        if self._doc_index is None:
+            self._doc_index = {d: i for i, d in enumerate(self.doc_ids)}
+        wanted = sorted({self._doc_index[d] for d in doc_ids if d in self._doc_index})
+        if not wanted:
+            return {}
+        targets = np.asarray(wanted, dtype=np.int64)
+        totals = np.zeros(len(targets))
+        term_counts = Counter(t for t in query_tokens if t in self.vocab)
+        for term, qf in term_counts.items():
+            term_id = self.vocab[term]
+            start, end = int(self.indptr[term_id]), int(self.indptr[term_id + 1])
+            docs = self.postings[start:end]
+            mask = np.isin(docs, targets)
+            if mask.any():
+                np.add.at(totals, np.searchsorted(targets, docs[mask]), self.weights[start:end][mask] * qf)
+        return {self.doc_ids[i]: float(score) for i, score in zip(wanted, totals)}
+
+
+def load_or_build(index_dir, content_hash, tokenizer_name, doc_batches_fn, tokenize, force=False,
+                  fingerprint=None):
+    """
+    索引存在且内容指纹、分词器一致时直接加载（内存映射），否则重建
+    doc_batches_fn: 无参函数，返回文档批次迭代器（只在需要重建时调用）
+    fingerprint: 传给 BM25Engine.build；已有索引缺少指纹时也会重建
+    """
+    meta = read_meta(index_dir)
+    if (not force and meta
+            and meta.get("format_version") == INDEX_FORMAT_VERSION
+            and meta.get("content_hash") == content_hash
+            and meta.get("tokenizer") == tokenizer_name
+            and (fingerprint is None or meta.get("fingerprints"))):
+        try:
+            return BM25Engine(index_dir)
+        except Exception:
+            pass
+    return BM25Engine.build(index_dir, doc_batches_fn(), tokenize, content_hash, tokenizer_name,
+                            fingerprint=fingerprint)
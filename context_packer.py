@@ -0,0 +1,112 @@
+"""
+检索上下文打包
+
+替代「把所有检索结果拼成一个字符串，再按字符截断」：
+- 候选片段来自当前会话、历史检索和知识库，各带一个相关度分数
+- 去掉与更相关片段高度重叠的候选（字符 n-gram 包含度）
+- 最相关的片段先装入（超出预算时截断），其余按「相关度 / token 数」从高到低贪心装入剩余预算，
+  装不下的跳过、继续尝试更小的候选
+- 装入的片段按相关度排序输出，并报告装入/丢弃的片段数和 token 数
+"""
+import os
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "6000"))  # 检索上下文的 token 预算
+CONTEXT_OVERLAP_THRESHOLD = 0.7  # 候选有这么大比例的 n-gram 已出现在更相关的片段中时视为重复
+SHINGLE_SIZE = 4
+HYBRID_VECTOR_WEIGHT = float(os.getenv("HYBRID_VECTOR_WEIGHT", "0.7"))  # 知识库相关度中向量相似度的权重（其余为 BM25）
+
+
+def hybrid_relevance(similarity=None, lexical=None, vector_weight=HYBRID_VECTOR_WEIGHT):
+    """
+    检索相关度（0~1）：向量余弦相似度与归一化的 BM25 得分（本次查询最高分记为 1）加权合成
+    某一路不可用（None）时只用另一路
+    """
+    if similarity is None and lexical is None:
+        return 0.0
+    if lexical is None:
+        return similarity
+    if similarity is None:
+        return lexical
+    return vector_weight * similarity + (1 - vector_weight) * lexical
+
+
+def _shingles(text):
+    text = "".join(text.split())
+    if len(text) <= SHINGLE_SIZE:
+        return {text} if text else set()
+    return {text[i:i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1)}
+
+
+class ContextPacker:
+    """按 token 预算挑选检索片段"""
+
+    def __init__(self, count_tokens, truncate=None, budget=CONTEXT_TOKEN_BUDGET,
+                 overlap_threshold=CONTEXT_OVERLAP_THRESHOLD):
+        self.count_tokens = count_tokens
+        self.truncate = truncate
+        self.budget = budget
+        self.overlap_threshold = overlap_threshold
+
+    def pack(self, candidates, budget=None):
+        """
+        candidates: [{"text", "score", "source", "label"}, ...]，label 为输出时的来源标记（如「[知识库]」）
+        返回 (装入的候选列表（按相关度降序）, 报告)
+        """
+        budget = self.budget if budget is None else budget
+        ordered = sorted((c for c in candidates if c.get("text")), key=lambda c: c["score"], reverse=True)
+
+        # 1. 去重叠：与更相关的已保留片段 n-gram 包含度过高的候选丢弃
+        kept, kept_shingles, overlap_dropped = [], [], []
+        for cand in ordered:
+            shingles = _shingles(cand["text"])
+            duplicate = False
+            for other in kept_shingles:
+                if shingles and len(shingles & other) / len(shingles) >= self.overlap_threshold:
+                    duplicate = True
+                    break
+            if duplicate:
+                overlap_dropped.append(cand)
+                continue
+            kept.append(dict(cand, tokens=self.count_tokens(cand["text"])))
+            kept_shingles.append(shingles)
+
+        # 2. 最相关的片段先装入：超出预算时截断到预算内，不会因为过长被第一个丢掉
+        packed, budget_dropped = [], []
+        used = 0
+        truncated_tokens = 0
+        if kept:
+            top = kept[0]
+            if top["tokens"] <= budget:
+                packed.append(top)
+                used = top["tokens"]
+            elif self.truncate:
+                text = self.truncate(top["text"], budget)
+                partial = dict(top, text=text, tokens=self.count_tokens(text), truncated=True)
+                packed.append(partial)
+                used = partial["tokens"]
+                truncated_tokens = top["tokens"] - partial["tokens"]
+            else:
+                budget_dropped.append(top)
+
+        # 3. 其余候选按相关度/token 贪心装入剩余预算
+        by_density = sorted(kept[1:], key=lambda c: c["score"] / max(c["tokens"], 1), reverse=True)
+        for cand in by_density:
+            if used + cand["tokens"] <= budget:
+                packed.append(cand)
+                used += cand["tokens"]
+            else:
+                budget_dropped.append(cand)
+
+        packed.sort(key=lambda c: c["score"], reverse=True)
+        dropped_tokens = truncated_tokens + sum(c["tokens"] for c in budget_dropped) + sum(
+            self.count_tokens(c["text"]) for c in overlap_dropped)
+        report = {
+            "candidates": len(ordered),
+            "packed": len(packed),
+            "packed_tokens": used,
+            "dropped": len(budget_dropped) + len(overlap_dropped),
+            "dropped_tokens": dropped_tokens,
+            "overlap_dropped": len(overlap_dropped),
+            "budget": budget
+        }
+        return packed, report
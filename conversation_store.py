@@ -0,0 +1,412 @@
+"""
+对话存储
+
+替代「每条消息都把整个 conversations_{username}.json 重写一遍」：
+- 只写新增/变化的消息：按消息指纹比对已持久化的内容，找到第一处不同，
+  截断其后的旧消息并追加新消息（编辑/重新生成也能正确处理）
+- 按会话读取，会话列表只读元数据（标题、更新时间、消息数）
+- 两种后端：
+    sqlite：单个 SQLite 数据库（WAL 模式），默认
+    jsonl ：每个会话一个追加写日志文件 + 每个用户一个元数据索引
+- 支持导入旧版 conversations_{username}.json
+"""
+import hashlib
+import json
+import os
+import re
+import shutil
+import sqlite3
+import threading
+from datetime import datetime
+
+SAFE_NAME_PATTERN = re.compile(r"^[A-Za-z0-9_\-]+$")
+
+
+def message_fingerprint(message):
+    """消息指纹（包含所有字段，字段变化也视为修改）"""
+    data = json.dumps(message, ensure_ascii=False, sort_keys=True)
+    return hashlib.md5(data.encode("utf-8")).hexdigest()
+
+
+def _now():
+    return datetime.now().isoformat(timespec="seconds")
+
+
+class ConversationStore:
+    """存储后端基类：实现增量比对，子类负责实际读写"""
+
+    backend = "base"
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._synced = {}  # (username, session_id) -> (title, [指纹...])，已持久化内容的缓存
+        self.saves = 0
+        self.skipped_saves = 0
+        self.messages_written = 0
+        self.messages_truncated = 0
+
+    # ------------------- 子类实现 -------------------
+    def list_users(self):
+        raise NotImplementedError
+
+    def list_sessions(self, username):
+        """[{"session_id", "title", "created_at", "updated_at", "message_count"}, ...]，按创建顺序"""
+        raise NotImplementedError
+
+    def load_session(self, username, session_id):
+        """返回 {"title", "messages"}，不存在返回 None"""
+        raise NotImplementedError
+
+    def _read_synced(self, username, session_id):
+        """读取已持久化的 (title, [指纹...])，不存在返回 None"""
+        raise NotImplementedError
+
+    def _write(self, username, session_id, title, keep, new_messages, new_fingerprints, total):
+        """保留前 keep 条消息，追加 new_messages，更新标题和元数据"""
+        raise NotImplementedError
+
+    def _delete_session(self, username, session_id):
+        raise NotImplementedError
+
+    def _delete_user(self, username):
+        raise NotImplementedError
+
+    # ------------------- 公共接口 -------------------
+    def load_all(self, username):
+        """按创建顺序读取用户全部会话 {session_id: {"title", "messages"}}"""
+        conversations = {}
+        for meta in self.list_sessions(username):
+            session = self.load_session(username, meta["session_id"])
+            if session is not None:
+                conversations[meta["session_id"]] = session
+        return conversations
+
+    def save_session(self, username, session_id, session):
+        """增量保存一个会话，返回写入的消息条数"""
+        title = session.get("title", "")
+        messages = session.get("messages", [])
+        fingerprints = [message_fingerprint(m) for m in messages]
+        with self._lock:
+            key = (username, session_id)
+            if key not in self._synced:
+                self._synced[key] = self._read_synced(username, session_id)
+            synced = self._synced[key]
+            old_title, old_fingerprints = synced if synced else (None, [])
+
+            # 第一处不同的位置之前的消息保持不变
+            keep = 0
+            for old_fp, new_fp in zip(old_fingerprints, fingerprints):
+                if old_fp != new_fp:
+                    break
+                keep += 1
+
+            self.saves += 1
+            if synced and old_title == title and keep == len(old_fingerprints) == len(fingerprints):
+                self.skipped_saves += 1
+                return 0
+
+            self._write(username, session_id, title, keep, messages[keep:], fingerprints[keep:], len(messages))
+            self._synced[key] = (title, fingerprints)
+            self.messages_written += len(messages) - keep
+            self.messages_truncated += len(old_fingerprints) - keep
+            return len(messages) - keep
+
+    def save_all(self, username, conversations):
+        """保存用户全部会话，并删除存储中已不存在于 conversations 的会话"""
+        with self._lock:
+            for session_id, session in conversations.items():
+                self.save_session(username, session_id, session)
+            for meta in self.list_sessions(username):
+                if meta["session_id"] not in conversations:
+                    self.delete_session(username, meta["session_id"])
+
+    def delete_session(self, username, session_id):
+        """删除会话，返回是否存在"""
+        with self._lock:
+            self._synced.pop((username, session_id), None)
+            return self._delete_session(username, session_id)
+
+    def delete_user(self, username):
+        with self._lock:
+            for key in [k for k in self._synced if k[0] == username]:
+                del self._synced[key]
+            self._delete_user(username)
+
+    def import_json(self, username, path):
+        """导入旧版 conversations_{username}.json，返回导入的会话数"""
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        with self._lock:
+            for session_id, session in data.items():
+                self.save_session(username, session_id, session)
+        return len(data)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "backend": self.backend,
+                "saves": self.saves,
+                "skipped_saves": self.skipped_saves,
+                "messages_written": self.messages_written,
+                "messages_truncated": self.messages_truncated
+            }
+
+
+class SQLiteConversationStore(ConversationStore):
+    """单个 SQLite 数据库（WAL），每条消息一行"""
+
+    backend = "sqlite"
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT NOT NULL,
+                session_id TEXT NOT NULL,
+                title TEXT,
+                created_at TEXT,
+                updated_at TEXT,
+                message_count INTEGER DEFAULT 0,
+                UNIQUE (username, session_id)
+            );
+            CREATE TABLE IF NOT EXISTS messages (
+                username TEXT NOT NULL,
+                session_id TEXT NOT NULL,
+                idx INTEGER NOT NULL,
+                fingerprint TEXT NOT NULL,
+                data TEXT NOT NULL,
+                PRIMARY KEY (username, session_id, idx)
+            );
+        """)
+        self._conn.commit()
+
+    def list_users(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT DISTINCT username FROM sessions ORDER BY username").fetchall()
+        return [r[0] for r in rows]
+
+    def list_sessions(self, username):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT session_id, title, created_at, updated_at, message_count FROM sessions "
+                "WHERE username = ? ORDER BY id", (username,)
+            ).fetchall()
+        return [
+            {"session_id": r[0], "title": r[1], "created_at": r[2], "updated_at": r[3], "message_count": r[4]}
+            for r in rows
+        ]
+
+    def load_session(self, username, session_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT title FROM sessions WHERE username = ? AND session_id = ?", (username, session_id)
+            ).fetchone()
+            if row is None:
+                return None
+            messages = self._conn.execute(
+                "SELECT data FROM messages WHERE username = ? AND session_id = ? ORDER BY idx",
+                (username, session_id)
+            ).fetchall()
+        return {"title": row[0], "messages": [json.loads(m[0]) for m in messages]}
+
+    def _read_synced(self, username, session_id):
+        row = self._conn.execute(
+            "SELECT title FROM sessions WHERE username = ? AND session_id = ?", (username, session_id)
+        ).fetchone()
+        if row is None:
+            return None
+        fingerprints = self._conn.execute(
+            "SELECT fingerprint FROM messages WHERE username = ? AND session_id = ? ORDER BY idx",
+            (username, session_id)
+        ).fetchall()
+        return row[0], [f[0] for f in fingerprints]
+
+    def _write(self, username, session_id, title, keep, new_messages, new_fingerprints, total):
+        now = _now()
+        with self._conn:
+            self._conn.execute(
+                "INSERT INTO sessions (username, session_id, title, created_at, updated_at, message_count) "
+                "VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (username, session_id) DO UPDATE SET "
+                "title = excluded.title, updated_at = excluded.updated_at, message_count = excluded.message_count",
+                (username, session_id, title, now, now, total)
+            )
+            self._conn.execute(
+                "DELETE FROM messages WHERE username = ? AND session_id = ? AND idx >= ?",
+                (username, session_id, keep)
+            )
+            self._conn.executemany(
+                "INSERT INTO messages (username, session_id, idx, fingerprint, data) VALUES (?, ?, ?, ?, ?)",
+                [
+                    (username, session_id, keep + i, fp, json.dumps(m, ensure_ascii=False))
+                    for i, (m, fp) in enumerate(zip(new_messages, new_fingerprints))
+                ]
+            )
+
+    def _delete_session(self, username, session_id):
+        with self._conn:
+            cur = self._conn.execute(
+                "DELETE FROM sessions WHERE username = ? AND session_id = ?", (username, session_id)
+            )
+            self._conn.execute(
+                "DELETE FROM messages WHERE username = ? AND session_id = ?", (username, session_id)
+            )
+        return cur.rowcount > 0
+
+    def _delete_user(self, username):
+        with self._conn:
+            self._conn.execute("DELETE FROM sessions WHERE username = ?", (username,))
+            self._conn.execute("DELETE FROM messages WHERE username = ?", (username,))
+
+
+class JSONLConversationStore(ConversationStore):
+    """
+    每个会话一个追加写日志：{base_dir}/{username}/{session_id}.jsonl
+    日志记录 append / truncate / title 操作，读取时回放；日志过长时压缩为快照
+    每个用户一个 index.json 保存会话元数据和顺序
+    """
+
+    backend = "jsonl"
+
+    def __init__(self, base_dir):
+        super().__init__()
+        self.base_dir = base_dir
+        os.makedirs(base_dir, exist_ok=True)
+
+    def _user_dir(self, username):
+        if not SAFE_NAME_PATTERN.match(username):
+            raise ValueError(f"非法用户名: {username}")
+        return os.path.join(self.base_dir, username)
+
+    def _log_path(self, username, session_id):
+        if not SAFE_NAME_PATTERN.match(session_id):
+            raise ValueError(f"非法会话 ID: {session_id}")
+        return os.path.join(self._user_dir(username), f"{session_id}.jsonl")
+
+    def _read_index(self, username):
+        path = os.path.join(self._user_dir(username), "index.json")
+        if not os.path.exists(path):
+            return {"sessions": {}}
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def _write_index(self, username, index):
+        path = os.path.join(self._user_dir(username), "index.json")
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(index, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def _replay(self, username, session_id):
+        """回放日志，返回 (title, messages, 日志行数)"""
+        path = self._log_path(username, session_id)
+        title, messages, ops = "", [], 0
+        if not os.path.exists(path):
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    op = json.loads(line)
+                except json.JSONDecodeError:
+                    break  # 崩溃时写了一半的最后一行，忽略
+                ops += 1
+                if op["op"] == "append":
+                    messages.append(op["message"])
+                elif op["op"] == "truncate":
+                    del messages[op["length"]:]
+                elif op["op"] == "title":
+                    title = op["title"]
+        return title, messages, ops
+
+    def list_users(self):
+        if not os.path.isdir(self.base_dir):
+            return []
+        return sorted(
+            d for d in os.listdir(self.base_dir)
+            if os.path.exists(os.path.join(self.base_dir, d, "index.json"))
+        )
+
+    def list_sessions(self, username):
+        with self._lock:
+            index = self._read_index(username)
+        return [
+            {"session_id": sid, "title": meta["title"], "created_at": meta["created_at"],
+             "updated_at": meta["updated_at"], "message_count": meta["message_count"]}
+            for sid, meta in index["sessions"].items()
+        ]
+
+    def load_session(self, username, session_id):
+        with self._lock:
+            replayed = self._replay(username, session_id)
+        if replayed is None:
+            return None
+        title, messages, _ = replayed
+        return {"title": title, "messages": messages}
+
+    def _read_synced(self, username, session_id):
+        replayed = self._replay(username, session_id)
+        if replayed is None:
+            return None
+        title, messages, _ = replayed
+        return title, [message_fingerprint(m) for m in messages]
+
+    def _write(self, username, session_id, title, keep, new_messages, new_fingerprints, total):
+        os.makedirs(self._user_dir(username), exist_ok=True)
+        index = self._read_index(username)
+        now = _now()
+        meta = index["sessions"].get(session_id) or {"title": None, "created_at": now, "log_length": 0}
+        old_count = meta.get("message_count", 0)
+
+        ops = []
+        if meta.get("title") != title:
+            ops.append({"op": "title", "title": title})
+        if keep < old_count:
+            ops.append({"op": "truncate", "length": keep})
+        ops.extend({"op": "append", "message": m} for m in new_messages)
+
+        path = self._log_path(username, session_id)
+        log_length = meta.get("log_length", 0) + len(ops)
+        if log_length > 2 * total + 20:
+            # 日志中无效操作过多，压缩为快照
+            session = self.load_session(username, session_id) or {"messages": []}
+            messages = session["messages"][:keep] + list(new_messages)
+            ops = [{"op": "title", "title": title}] + [{"op": "append", "message": m} for m in messages]
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.writelines(json.dumps(op, ensure_ascii=False) + "\n" for op in ops)
+            os.replace(tmp_path, path)
+            log_length = len(ops)
+        else:
+            with open(path, "a", encoding="utf-8") as f:
+                f.writelines(json.dumps(op, ensure_ascii=False) + "\n" for op in ops)
+
+        meta.update({"title": title, "updated_at": now, "message_count": total, "log_length": log_length})
+        index["sessions"][session_id] = meta
+        self._write_index(username, index)
+
+    def _delete_session(self, username, session_id):
+        index = self._read_index(username)
+        existed = index["sessions"].pop(session_id, None) is not None
+        path = self._log_path(username, session_id)
+        if os.path.exists(path):
+            os.remove(path)
+        if existed:
+            self._write_index(username, index)
+        return existed
+
+    def _delete_user(self, username):
+        shutil.rmtree(self._user_dir(username), ignore_errors=True)
+
+
+def open_conversation_store(backend, base_dir):
+    """按名称创建存储后端：sqlite（默认）或 jsonl"""
+    if backend == "jsonl":
+        return JSONLConversationStore(os.path.join(base_dir, "sessions"))
+    return SQLiteConversationStore(os.path.join(base_dir, "conversations.db"))
@@ -8,6 +8,7 @@ import requests
 import zipfile
 from io import BytesIO
 import shutil
+from deepseek_client import get_deepseek_client
 
 # ------------------- Streamlit 配置 -------------------
 st.set_page_config(
@@ -204,13 +205,13 @@ else:
     # ------------------- 调用 DeepSeek API -------------------
     def call_deepseek_api(messages, context):
         try:
-            response = requests.post(
+            response_json = get_deepseek_client().post_json(
                 f"{DEEPSEEK_API_BASE}/chat/completions",
                 headers={
                     "Content-Type": "application/json",
                     "Authorization": f"Bearer {DEEPSEEK_API_KEY}"
                 },
-                json={
+                json_data={
                     "model": DEEPSEEK_MODEL,
                     "messages": messages,
                     "temperature": 0.7,
@@ -218,8 +219,7 @@ else:
                 },
                 timeout=30
             )
-            response.raise_for_status()
-            return response.json()["choices"][0]["message"]["content"].strip()
+            return response_json["choices"][0]["message"]["content"].strip()
         except Exception as e:
             st.error(f"API 调用失败: {str(e)}")
             return "API 调用失败，请稍后重试。"
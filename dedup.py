@@ -0,0 +1,116 @@
+"""
+近重复过滤（SimHash）
+
+精确前缀去重（t[:100]、content[:50]）挡不住重叠切块、反复生成的相近摘要、
+同一段回答以不同 id 保存多次等情况。
+- simhash：字符 3-gram 的 64 位 SimHash 指纹，汉明距离 <= max_distance 视为近重复
+- 指纹在入库时预先计算：知识库切块随 BM25 索引保存（simhash.npy），
+  历史对话保存在向量库 metadata 的 simhash 字段；查询时只需比较整数
+- NearDuplicateFilter：每个候选只与已保留的指纹做异或 + popcount（每轮候选只有十几二十条），
+  按来源统计去重率
+阈值参考（约 400 字的切块）：错开 20 字的重叠切块距离约 7，改动 5 处约 9，无关文本约 32。
+"""
+import hashlib
+import os
+import threading
+
+import numpy as np
+
+SIMHASH_BITS = 64
+SHINGLE_SIZE = 3
+NEAR_DUP_DISTANCE = int(os.getenv("NEAR_DUP_DISTANCE", "10"))
+
+
+def _shingles(text):
+    text = "".join((text or "").lower().split())
+    if len(text) <= SHINGLE_SIZE:
+        return {text} if text else set()
+    return {text[i:i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1)}
+
+
+def simhash(text):
+    """64 位 SimHash 指纹（int）；空文本返回 0"""
+    shingles = _shingles(text)
+    if not shingles:
+        return 0
+    digests = b"".join(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest() for s in shingles)
+    bits = np.unpackbits(np.frombuffer(digests, dtype=np.uint8)).reshape(-1, SIMHASH_BITS)
+    votes = bits.sum(axis=0, dtype=np.int64) * 2 - len(shingles)
+    fingerprint = 0
+    for bit in np.nonzero(votes > 0)[0]:
+        fingerprint |= 1 << (SIMHASH_BITS - 1 - int(bit))
+    return fingerprint
+
+
+def to_hex(fingerprint):
+    """指纹转 16 位十六进制字符串（向量库 metadata 不支持无符号 64 位整数）"""
+    return format(fingerprint, "016x")
+
+
+def from_hex(value):
+    try:
+        return int(value, 16) if value else None
+    except (TypeError, ValueError):
+        return None
+
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+class NearDuplicateFilter:
+    """按顺序保留每组近重复中的第一个（调用方应先按相关度排序），线程安全"""
+
+    def __init__(self, max_distance=NEAR_DUP_DISTANCE):
+        self.max_distance = max_distance
+        self._lock = threading.Lock()
+        self._totals = {}  # source -> [总数, 去掉的数量]
+
+    def filter(self, items, text_key="text", fingerprint_key="fingerprint", source_key="source"):
+        """
+        items: dict 列表；没有预计算指纹的条目现场计算
+        返回 (保留的条目, 报告 {"total", "dropped", "ratio", "by_source"})
+        """
+        kept_fingerprints = []
+        kept = []
+        by_source = {}
+        for item in items:
+            fingerprint = item.get(fingerprint_key)
+            if fingerprint is None:
+                fingerprint = simhash(item.get(text_key, ""))
+            source = item.get(source_key, "")
+            counts = by_source.setdefault(source, [0, 0])
+            counts[0] += 1
+
+            if any(hamming(fingerprint, other) <= self.max_distance for other in kept_fingerprints):
+                counts[1] += 1
+                continue
+            kept_fingerprints.append(fingerprint)
+            kept.append(item)
+
+        with self._lock:
+            for source, (total, dropped) in by_source.items():
+                totals = self._totals.setdefault(source, [0, 0])
+                totals[0] += total
+                totals[1] += dropped
+
+        total = len(items)
+        dropped = total - len(kept)
+        return kept, {
+            "total": total,
+            "dropped": dropped,
+            "ratio": dropped / total if total else 0.0,
+            "by_source": {s: {"total": t, "dropped": d} for s, (t, d) in by_source.items()}
+        }
+
+    def stats(self):
+        """进程级累计去重率（按来源）"""
+        with self._lock:
+            total = sum(t for t, _ in self._totals.values())
+            dropped = sum(d for _, d in self._totals.values())
+            return {
+                "total": total,
+                "dropped": dropped,
+                "ratio": dropped / total if total else 0.0,
+                "by_source": {s: (d / t if t else 0.0) for s, (t, d) in self._totals.items()}
+            }
@@ -0,0 +1,201 @@
+"""
+DeepSeek API 连接池客户端
+
+进程内所有 DeepSeek 调用（app.py / dabao.py）共用一个 HTTP 客户端：
+- 连接池 + keep-alive，避免每次调用重新做 TCP/TLS 握手
+- 安装了 httpx 和 h2 时自动启用 HTTP/2（单连接多路复用）
+- 统计请求数、新建连接数、连接复用率
+"""
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import requests
+from requests.adapters import HTTPAdapter
+import streamlit as st
+
+# HTTP/2 为可选依赖：pip install "httpx[http2]"
+try:
+    import httpx
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    httpx = None
+    HTTP2_AVAILABLE = False
+
+# ------------------- 连接池配置（可用环境变量覆盖） -------------------
+DEEPSEEK_POOL_SIZE = int(os.getenv("DEEPSEEK_POOL_SIZE", "10"))  # 每个主机的最大连接数
+DEEPSEEK_KEEPALIVE_EXPIRY = float(os.getenv("DEEPSEEK_KEEPALIVE_EXPIRY", "60"))  # 空闲连接保活秒数
+DEEPSEEK_HTTP2 = os.getenv("DEEPSEEK_HTTP2", "1") == "1"  # 是否尝试 HTTP/2
+DEEPSEEK_WARMUP_CONNECTIONS = int(os.getenv("DEEPSEEK_WARMUP_CONNECTIONS", "3"))  # 启动时预先建立的连接数
+
+
+class DeepSeekClient:
+    """带连接池的 HTTP 客户端，线程安全，异常统一为 requests.exceptions.*"""
+
+    def __init__(self, pool_size=DEEPSEEK_POOL_SIZE, keepalive_expiry=DEEPSEEK_KEEPALIVE_EXPIRY,
+                 http2=DEEPSEEK_HTTP2):
+        self.pool_size = pool_size
+        self.keepalive_expiry = keepalive_expiry
+        self.http2 = http2 and HTTP2_AVAILABLE
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._new_connections = 0
+        self._errors = 0
+        self._warmed = 0
+        self._last_used = time.monotonic()
+
+        if self.http2:
+            self._client = httpx.Client(
+                http2=True,
+                limits=httpx.Limits(
+                    max_connections=pool_size,
+                    max_keepalive_connections=pool_size,
+                    keepalive_expiry=keepalive_expiry
+                )
+            )
+        else:
+            # requests.Session 默认 keep-alive，这里只需放大连接池
+            self._session = requests.Session()
+            self._adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            self._session.mount("https://", self._adapter)
+            self._session.mount("http://", self._adapter)
+
+    # ------------------- 连接统计 -------------------
+    def _trace(self, event_name, info):
+        """httpx 的 trace 回调：每建立一条新 TCP 连接计数一次"""
+        if event_name == "connection.connect_tcp.complete":
+            with self._lock:
+                self._new_connections += 1
+
+    def _pool_connection_count(self):
+        """urllib3 连接池中累计新建的连接数"""
+        pools = self._adapter.poolmanager.pools
+        return sum(pools[key].num_connections for key in list(pools.keys()))
+
+    def _before_request(self):
+        with self._lock:
+            self._requests += 1
+            idle = time.monotonic() - self._last_used
+            self._last_used = time.monotonic()
+        # urllib3 不会主动回收空闲连接，超过保活时间后清空连接池，避免复用已被服务端关闭的连接
+        if not self.http2 and idle > self.keepalive_expiry:
+            with self._lock:
+                self._new_connections += self._pool_connection_count()
+                self._adapter.poolmanager.clear()
+
+    def stats(self):
+        """返回连接池统计信息"""
+        with self._lock:
+            new_connections = self._new_connections
+            if not self.http2:
+                new_connections += self._pool_connection_count()
+            total = self._requests
+            reused = max(0, total - new_connections)
+            return {
+                "protocol": "HTTP/2" if self.http2 else "HTTP/1.1 keep-alive",
+                "pool_size": self.pool_size,
+                "requests": total,
+                "new_connections": new_connections,
+                "reused_connections": reused,
+                "reuse_rate": reused / total if total else 0.0,
+                "errors": self._errors,
+                "warmed": self._warmed
+            }
+
+    # ------------------- 请求 -------------------
+    def _translate_error(self, e):
+        """把 httpx 异常转换成 requests 异常，调用方只需处理一套异常类型"""
+        if isinstance(e, requests.exceptions.RequestException):
+            with self._lock:
+                self._errors += 1
+            return e
+        if httpx is None or not isinstance(e, httpx.HTTPError):
+            return e
+        with self._lock:
+            self._errors += 1
+        if isinstance(e, httpx.TimeoutException):
+            return requests.exceptions.Timeout(str(e))
+        if isinstance(e, httpx.HTTPStatusError):
+            return requests.exceptions.HTTPError(str(e))
+        return requests.exceptions.ConnectionError(str(e))
+
+    def post_json(self, url, headers, json_data, timeout=60):
+        """POST 并返回解析后的 JSON（非 2xx 抛出 HTTPError）"""
+        self._before_request()
+        try:
+            if self.http2:
+                response = self._client.post(url, headers=headers, json=json_data, timeout=timeout,
+                                             extensions={"trace": self._trace})
+            else:
+                response = self._session.post(url, headers=headers, json=json_data, timeout=timeout)
+            response.raise_for_status()
+            return response.json()
+        except Exception as e:
+            translated = self._translate_error(e)
+            if translated is e:
+                raise
+            raise translated from e
+
+    @contextmanager
+    def stream_lines(self, url, headers, json_data, timeout=120):
+        """POST 流式请求，产出解码后的文本行（SSE）"""
+        self._before_request()
+        try:
+            if self.http2:
+                with self._client.stream("POST", url, headers=headers, json=json_data, timeout=timeout,
+                                         extensions={"trace": self._trace}) as response:
+                    response.raise_for_status()
+                    yield response.iter_lines()
+            else:
+                response = self._session.post(url, headers=headers, json=json_data, stream=True, timeout=timeout)
+                try:
+                    response.raise_for_status()
+                    yield (line.decode("utf-8") for line in response.iter_lines())
+                finally:
+                    response.close()  # 归还连接到连接池
+        except Exception as e:
+            translated = self._translate_error(e)
+            if translated is e:
+                raise
+            raise translated from e
+
+    def warm_up(self, url, headers=None, connections=DEEPSEEK_WARMUP_CONNECTIONS, timeout=10):
+        """
+        预先建立连接（TCP + TLS 握手）并留在连接池中：并发发送轻量 GET，不关心响应状态码
+        HTTP/2 单连接多路复用，只需一个请求；返回成功完成的请求数
+        """
+        count = 1 if self.http2 else max(1, min(connections, self.pool_size))
+
+        def ping(_):
+            self._before_request()
+            try:
+                if self.http2:
+                    self._client.get(url, headers=headers, timeout=timeout, extensions={"trace": self._trace})
+                else:
+                    self._session.get(url, headers=headers, timeout=timeout)  # 读完响应后连接自动归还连接池
+                return True
+            except Exception:
+                with self._lock:
+                    self._errors += 1
+                return False
+
+        with ThreadPoolExecutor(max_workers=count) as executor:
+            succeeded = sum(executor.map(ping, range(count)))
+        with self._lock:
+            self._warmed += succeeded
+        return succeeded
+
+    def close(self):
+        if self.http2:
+            self._client.close()
+        else:
+            self._session.close()
+
+
+@st.cache_resource
+def get_deepseek_client():
+    """进程级共享的 DeepSeek 客户端"""
+    return DeepSeekClient()
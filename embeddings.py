@@ -0,0 +1,225 @@
+"""
+向量模型共享与查询向量缓存
+
+知识库和历史库使用同一个 bge-small-zh 模型，各自加载一份会让权重占两份内存、冷启动时间翻倍。
+- EmbeddingRegistry：进程级注册表，同一模型只加载一次，所有向量库共用；记录加载耗时和内存占用
+- EmbeddingProvider：共享的编码器（兼容 LangChain Embeddings 接口），提供批量 embed_many
+
+一轮对话里同一个查询会被多个向量库（知识库、历史库）和多个检索步骤反复编码。
+- QueryEmbedder：进程级 LRU 缓存，跨轮次复用最近的查询向量，并发请求同一文本时只编码一次
+- TurnEmbeddingContext：单轮上下文，保证本轮每个不同的查询字符串只编码一次
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+QUERY_EMBEDDING_CACHE_SIZE = 512
+EMBEDDING_THREADS = int(os.getenv("EMBEDDING_THREADS", "0"))  # 编码使用的 CPU 线程数，0 表示框架默认
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "32"))
+
+
+def _rss_bytes():
+    """当前进程常驻内存（Linux 读 /proc，其他平台退回峰值 RSS）"""
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+        import sys
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+    except Exception:
+        return None
+
+
+def _set_threads(threads):
+    if threads <= 0:
+        return
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except Exception:
+        pass
+
+
+def _parameter_bytes(model):
+    """模型权重占用的字节数（ONNX 模型取文件大小，否则取 LangChain 包装里的 sentence-transformers 模型）"""
+    if getattr(model, "model_bytes", None) is not None:
+        return model.model_bytes
+    client = getattr(model, "client", model)
+    try:
+        return sum(p.numel() * p.element_size() for p in client.parameters())
+    except Exception:
+        return None
+
+
+class EmbeddingProvider:
+    """共享的文本编码器，向量库直接把它当作 embedding_function 使用"""
+
+    def __init__(self, model_name, factory, threads=EMBEDDING_THREADS, batch_size=EMBEDDING_BATCH_SIZE):
+        self.model_name = model_name
+        self.threads = threads
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self.queries = 0
+        self.documents = 0
+        self.batches = 0
+
+        _set_threads(threads)
+        rss_before = _rss_bytes()
+        start = time.time()
+        self.model = factory(model_name)  # 提供 embed_query / embed_documents 的模型
+        self.load_seconds = time.time() - start
+        rss_after = _rss_bytes()
+        self.rss_delta = rss_after - rss_before if rss_before is not None and rss_after is not None else None
+        self.parameter_bytes = _parameter_bytes(self.model)
+        self.backend = getattr(self.model, "backend_name", "pytorch")
+
+    def embed_query(self, text):
+        with self._lock:
+            self.queries += 1
+        return self.model.embed_query(text)
+
+    def embed_many(self, texts, batch_size=None):
+        """批量编码，按 batch_size 分批送入模型"""
+        texts = list(texts)
+        batch_size = batch_size or self.batch_size
+        vectors = []
+        for offset in range(0, len(texts), batch_size):
+            vectors.extend(self.model.embed_documents(texts[offset:offset + batch_size]))
+            with self._lock:
+                self.batches += 1
+        with self._lock:
+            self.documents += len(texts)
+        return vectors
+
+    def embed_documents(self, texts):
+        return self.embed_many(texts)
+
+    def report(self):
+        with self._lock:
+            return {
+                "model": self.model_name,
+                "backend": self.backend,
+                "threads": self.threads,
+                "load_seconds": self.load_seconds,
+                "rss_delta_mb": self.rss_delta / 2 ** 20 if self.rss_delta is not None else None,
+                "parameter_mb": self.parameter_bytes / 2 ** 20 if self.parameter_bytes is not None else None,
+                "queries": self.queries,
+                "documents": self.documents,
+                "batches": self.batches
+            }
+
+
+class EmbeddingRegistry:
+    """进程级向量模型注册表：按模型名共享 EmbeddingProvider"""
+
+    def __init__(self, factory, threads=EMBEDDING_THREADS, batch_size=EMBEDDING_BATCH_SIZE):
+        self.factory = factory  # model_name -> 模型对象
+        self.threads = threads
+        self.batch_size = batch_size
+        self._providers = {}
+        self._lock = threading.Lock()
+
+    def get(self, model_name):
+        # 加载放在锁内：并发的首次请求等待同一次加载，而不是各自再加载一份
+        with self._lock:
+            provider = self._providers.get(model_name)
+            if provider is None:
+                provider = EmbeddingProvider(model_name, self.factory, self.threads, self.batch_size)
+                self._providers[model_name] = provider
+            return provider
+
+    def report(self):
+        with self._lock:
+            providers = list(self._providers.values())
+        return [p.report() for p in providers]
+
+
+class QueryEmbedder:
+    """带 LRU 缓存的查询编码器（线程安全）"""
+
+    def __init__(self, embeddings, maxsize=QUERY_EMBEDDING_CACHE_SIZE):
+        self.embeddings = embeddings  # LangChain Embeddings 对象（提供 embed_query）
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+        self._inflight = {}  # text -> Future，并发时同一文本只编码一次
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def embed(self, text):
+        with self._lock:
+            if text in self._cache:
+                self._cache.move_to_end(text)
+                self.hits += 1
+                return self._cache[text]
+            future = self._inflight.get(text)
+            if future is not None:
+                self.hits += 1
+                owner = False
+            else:
+                future = Future()
+                self._inflight[text] = future
+                self.misses += 1
+                owner = True
+
+        if not owner:
+            return future.result()
+
+        try:
+            vector = self.embeddings.embed_query(text)
+        except Exception as e:
+            with self._lock:
+                del self._inflight[text]
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            del self._inflight[text]
+            self._cache[text] = vector
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        future.set_result(vector)
+        return vector
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._cache),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0
+            }
+
+
+class TurnEmbeddingContext:
+    """单轮对话的查询向量上下文"""
+
+    def __init__(self, embedder):
+        self.embedder = embedder
+        self._vectors = {}
+        self._lock = threading.Lock()
+        self.requests = 0
+
+    def embed(self, text):
+        with self._lock:
+            self.requests += 1
+            if text in self._vectors:
+                return self._vectors[text]
+        vector = self.embedder.embed(text)
+        with self._lock:
+            self._vectors[text] = vector
+        return vector
+
+    def stats(self):
+        with self._lock:
+            return {"requests": self.requests, "distinct": len(self._vectors)}
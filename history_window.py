@@ -0,0 +1,102 @@
+"""
+对话历史窗口策略
+
+流式回答不再把整个会话原样发送：
+- 始终保留开头的 system prompt
+- 窗口之外的旧对话用滚动摘要代替（有摘要时）
+- 只保留最近 max_turns 轮，并且窗口内的对话总 token 不超过预算；当前问题所在的一轮总是保留
+- 窗口起点（水位线）和累计丢弃的 token 数作为状态返回，由调用方持久化；
+  下一轮从水位线开始计算，只统计窗口内的消息，不必每轮从头数整个会话
+"""
+import hashlib
+import os
+
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "3000"))  # 窗口内对话的 token 预算
+HISTORY_MAX_TURNS = int(os.getenv("HISTORY_MAX_TURNS", "6"))  # 最多保留的最近轮数（一问一答为一轮）
+
+
+def _fingerprint(message):
+    return hashlib.md5(f"{message['role']}:{message['content']}".encode("utf-8")).hexdigest()
+
+
+class HistoryWindowPolicy:
+    """按 token 预算和轮数截取对话历史"""
+
+    def __init__(self, count_tokens, token_budget=HISTORY_TOKEN_BUDGET, max_turns=HISTORY_MAX_TURNS,
+                 count_message=None):
+        """count_tokens: 文本 → token 数；count_message: 消息 → token 数（可利用消息上缓存的计数）"""
+        self.count_tokens = count_tokens
+        self.count_message = count_message or (lambda m: count_tokens(m["content"]))
+        self.token_budget = token_budget
+        self.max_turns = max_turns
+
+    def _restore_start(self, dialogue, state):
+        """校验上次的水位线：对话被编辑/截断导致不一致时从头计算"""
+        if not state:
+            return 0, 0
+        start = state.get("start", 0)
+        if not 0 < start < len(dialogue):
+            return 0, 0
+        if state.get("boundary_hash") != _fingerprint(dialogue[start - 1]):
+            return 0, 0
+        return start, state.get("dropped_tokens", 0)
+
+    def apply(self, messages, summary="", state=None):
+        """
+        messages: 完整会话消息（含 system prompt，最后一条为当前问题）
+        summary: 滚动摘要文本（窗口丢弃了旧对话时作为 system 消息插入）
+        state: 上一轮返回的窗口状态
+        返回 (要发送的消息, 新的窗口状态, 统计报告)
+        """
+        head = []
+        for m in messages:
+            if m["role"] != "system":
+                break
+            head.append(m)
+        dialogue = [m for m in messages[len(head):] if m["role"] != "system"]
+
+        start, dropped_before = self._restore_start(dialogue, state)
+        window_tokens = [self.count_message(m) for m in dialogue[start:]]
+        turn_starts = [i for i in range(start, len(dialogue)) if dialogue[i]["role"] == "user"]
+        head_tokens = sum(self.count_message(m) for m in head)
+        summary_message = {"role": "system", "content": f"【此前对话摘要】\n{summary}"} if summary else None
+        summary_tokens = self.count_tokens(summary_message["content"]) if summary_message else 0
+        budget = max(0, self.token_budget - summary_tokens)
+
+        if turn_starts:
+            # 窗口从用户消息开始，之前的孤立消息（如开场欢迎语）计入丢弃
+            lead = turn_starts[0] - start
+            newly_dropped = sum(window_tokens[:lead])
+            total = sum(window_tokens[lead:])
+            # 向后推进窗口起点（按整轮），直到轮数和 token 都满足；最后一轮总是保留
+            turn_index = 0
+            while turn_index < len(turn_starts) - 1 and (
+                    len(turn_starts) - turn_index > self.max_turns or total > budget):
+                next_start = turn_starts[turn_index + 1]
+                turn_tokens = sum(window_tokens[turn_starts[turn_index] - start:next_start - start])
+                total -= turn_tokens
+                newly_dropped += turn_tokens
+                turn_index += 1
+            new_start = turn_starts[turn_index]
+        else:
+            newly_dropped, total, new_start = 0, sum(window_tokens), start
+
+        dropped_tokens = dropped_before + newly_dropped
+        to_send = list(head)
+        if new_start > 0 and summary_message:
+            to_send.append(summary_message)
+        to_send.extend(dialogue[new_start:])
+
+        new_state = {
+            "start": new_start,
+            "dropped_tokens": dropped_tokens,
+            "boundary_hash": _fingerprint(dialogue[new_start - 1]) if new_start > 0 else None
+        }
+        report = {
+            "kept_messages": len(dialogue) - new_start,
+            "dropped_messages": new_start,
+            "kept_tokens": head_tokens + total + (summary_tokens if new_start > 0 and summary_message else 0),
+            "dropped_tokens": dropped_tokens,
+            "summary_used": bool(new_start > 0 and summary_message)
+        }
+        return to_send, new_state, report
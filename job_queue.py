@@ -0,0 +1,186 @@
+"""
+后台任务队列
+
+把回复之后才需要做的工作（长期记忆提取、会话摘要 + 写入历史向量库）移出请求路径：
+- 单个后台工作线程按入队顺序执行
+- 任务持久化到 JSON 文件，进程重启后继续执行未完成的任务
+- 同一类型 + 同一去重键（通常是 session_id）只保留最新的一个待执行任务
+- 失败的任务（处理函数抛出异常）按指数退避重新入队，最多执行 max_attempts 次；重试状态同样持久化
+- 统计队列深度、任务等待/执行耗时
+"""
+import json
+import os
+import threading
+import time
+import traceback
+import uuid
+from collections import deque
+
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "4"))  # 每个任务最多执行次数（含第一次）
+JOB_RETRY_DELAY = float(os.getenv("JOB_RETRY_DELAY", "30"))  # 第一次重试前等待的秒数，之后每次翻倍
+
+
+class JobQueue:
+    """
+    持久化的后台任务队列
+
+    payload 中以下划线开头的字段（如 "_api_key"）只保存在内存中，不写入任务文件。
+    处理函数通过抛出异常表示失败（例如 API 没有返回结果），正常返回即视为完成。
+    """
+
+    def __init__(self, path, latency_window=100, max_attempts=JOB_MAX_ATTEMPTS, retry_delay=JOB_RETRY_DELAY):
+        self.path = path
+        self.max_attempts = max(1, max_attempts)
+        self.retry_delay = retry_delay
+        self._handlers = {}
+        self._pending = []  # 按入队顺序排列的任务
+        self._running = None
+        self._cond = threading.Condition()
+        self._thread = None
+        self._processed = 0
+        self._failed = 0  # 重试次数用尽后放弃的任务
+        self._retried = 0
+        self._deduped = 0
+        self._wait_times = deque(maxlen=latency_window)  # 入队到开始执行
+        self._run_times = deque(maxlen=latency_window)  # 执行耗时
+        self._load()
+
+    # ------------------- 持久化 -------------------
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self._pending = json.load(f).get("jobs", [])
+        except Exception:
+            self._pending = []
+
+    def _persist(self):
+        """原子写入未完成任务（含正在执行的任务，崩溃后会重跑）"""
+        jobs = ([self._running] if self._running else []) + self._pending
+        data = {"jobs": [
+            {**job, "payload": {k: v for k, v in job["payload"].items() if not k.startswith("_")}}
+            for job in jobs
+        ]}
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    # ------------------- 入队 -------------------
+    def register(self, job_type, handler):
+        """注册任务处理函数：handler(**payload)"""
+        self._handlers[job_type] = handler
+
+    def enqueue(self, job_type, dedupe_key, **payload):
+        """入队；已有同类型同键的待执行任务时，用新参数替换它（等待重试的任务重新计数，立即可执行）"""
+        with self._cond:
+            for job in self._pending:
+                if job["type"] == job_type and job["dedupe_key"] == dedupe_key:
+                    job["payload"] = payload
+                    job.pop("attempts", None)
+                    job.pop("not_before", None)
+                    job.pop("last_error", None)
+                    self._deduped += 1
+                    break
+            else:
+                self._pending.append({
+                    "id": uuid.uuid4().hex,
+                    "type": job_type,
+                    "dedupe_key": dedupe_key,
+                    "payload": payload,
+                    "enqueued_at": time.time()
+                })
+            self._persist()
+            self._cond.notify()
+
+    # ------------------- 工作线程 -------------------
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._worker, name="job-queue", daemon=True)
+            self._thread.start()
+        return self
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                index = self._next_ready()
+                while index is None:
+                    # 只有等待重试的任务时，睡到最早的一个到期（有新任务入队会被唤醒）
+                    due = [job["not_before"] - time.time() for job in self._pending]
+                    self._cond.wait(max(0.0, min(due)) if due else None)
+                    index = self._next_ready()
+                self._running = self._pending.pop(index)
+                job = self._running
+
+            start = time.time()
+            error = None
+            try:
+                handler = self._handlers.get(job["type"])
+                if handler is None:
+                    raise KeyError(f"未注册的任务类型: {job['type']}")
+                handler(**job["payload"])
+            except Exception as e:
+                traceback.print_exc()
+                error = f"{type(e).__name__}: {e}"
+
+            with self._cond:
+                if not job.get("attempts"):
+                    self._wait_times.append(start - job["enqueued_at"])  # 重试的退避时间不计入排队等待
+                self._run_times.append(time.time() - start)
+                if error is None:
+                    self._processed += 1
+                else:
+                    self._handle_failure(job, error)
+                self._running = None
+                self._persist()
+
+    def _next_ready(self):
+        """第一个已到执行时间的待执行任务的下标（调用方持有锁）"""
+        now = time.time()
+        for i, job in enumerate(self._pending):
+            if job.get("not_before", 0) <= now:
+                return i
+        return None
+
+    def _handle_failure(self, job, error):
+        """失败的任务：已有更新的同键任务时丢弃，否则按指数退避重新入队，次数用尽后放弃（调用方持有锁）"""
+        if any(p["type"] == job["type"] and p["dedupe_key"] == job["dedupe_key"] for p in self._pending):
+            self._deduped += 1
+            return
+        job["attempts"] = job.get("attempts", 0) + 1
+        job["last_error"] = error
+        if job["attempts"] < self.max_attempts:
+            job["not_before"] = time.time() + self.retry_delay * 2 ** (job["attempts"] - 1)
+            self._pending.append(job)
+            self._retried += 1
+        else:
+            self._failed += 1
+
+    def wait_idle(self, timeout=None):
+        """等待队列清空（测试/关闭时使用），返回是否已清空"""
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            with self._cond:
+                if not self._pending and self._running is None:
+                    return True
+            if deadline is not None and time.time() > deadline:
+                return False
+            time.sleep(0.1)
+
+    def stats(self):
+        """队列统计"""
+        with self._cond:
+            wait_times = list(self._wait_times)
+            run_times = list(self._run_times)
+            return {
+                "depth": len(self._pending) + (1 if self._running else 0),
+                "running": self._running["type"] if self._running else None,
+                "processed": self._processed,
+                "failed": self._failed,
+                "retried": self._retried,
+                "retrying": sum(1 for job in self._pending if job.get("attempts")),
+                "deduped": self._deduped,
+                "avg_wait": sum(wait_times) / len(wait_times) if wait_times else 0.0,
+                "avg_run": sum(run_times) / len(run_times) if run_times else 0.0
+            }
@@ -0,0 +1,80 @@
+"""
+小型 JSON 文件读穿缓存
+
+API Key、长期记忆、会话摘要索引这类按用户存放的小 JSON 文件，每次 rerun / 每轮对话会被读好几次。
+- 读：先 os.stat，mtime 和 size 都没变就直接返回缓存（深拷贝，调用方修改不影响缓存）
+- 写：原子写入（临时文件 + os.replace）后直接更新缓存（写穿）
+- 其他进程或手工修改了文件，mtime/size 变化后自动重新读取
+"""
+import copy
+import json
+import os
+import threading
+
+
+class JSONFileCache:
+    """进程级 JSON 文件缓存（线程安全）"""
+
+    def __init__(self):
+        self._entries = {}  # path -> ((mtime_ns, size), data)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+
+    @staticmethod
+    def _signature(path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def read(self, path, default=None):
+        """读取 JSON；文件不存在返回 default"""
+        signature = self._signature(path)
+        if signature is None:
+            with self._lock:
+                self._entries.pop(path, None)
+            return copy.deepcopy(default)
+
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry and entry[0] == signature:
+                self.hits += 1
+                return copy.deepcopy(entry[1])
+            self.misses += 1
+
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        with self._lock:
+            self._entries[path] = (signature, data)
+        return copy.deepcopy(data)
+
+    def write(self, path, data, indent=2):
+        """原子写入 JSON 并更新缓存"""
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=indent)
+        os.replace(tmp_path, path)
+        signature = self._signature(path)
+        with self._lock:
+            self.writes += 1
+            self._entries[path] = (signature, copy.deepcopy(data))
+
+    def delete(self, path):
+        with self._lock:
+            self._entries.pop(path, None)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "writes": self.writes,
+                "hit_rate": self.hits / total if total else 0.0
+            }
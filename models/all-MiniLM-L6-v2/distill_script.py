@@ -0,0 +1,350 @@
+"""
+CPU 蒸馏脚本：从 bge-small-zh 蒸馏更浅/更窄的领域向量模型
+
+train_script.py 只能在 TPU（torch_xla）上从头训练公开语料；这里在 CPU 上做知识蒸馏：
+- 教师：BAAI/bge-small-zh-v1.5（与线上知识库索引使用的模型相同）
+- 数据：知识库切块 + 对话存储里记录的用户问题（不够时从切块中抽句子作为伪查询）
+- 学生：从教师隔层抽取 --layers 层初始化（类似 DistilBERT），可选 --dim 加一层线性降维
+  （用教师向量的 PCA 主成分初始化，目标为投影后的教师向量）
+- 损失：学生与教师句向量的余弦距离
+- 输出：sentence-transformers 目录 + onnx/model.onnx（已包含池化）和各 CPU 的 qint8 量化版本，
+  可直接用 EMBEDDING_BACKEND=onnx EMBEDDING_ONNX_DIR=<输出目录> 加载
+- 报告：学生 top-k 与教师 top-k 的重合率（recall@k）和单条查询延迟、批量吞吐；留出一部分切块完全不参与训练
+  （也不从中抽训练用的伪查询），分两组评估：
+  * heldout_chunks：从留出切块抽的伪查询，在留出切块上检索（查询和语料都没有见过）
+  * logged_queries：留出的记录问题（未参与训练），在全部切块上检索（与线上索引一致，语料含训练切块）
+
+维度不变时学生向量可以直接检索现有知识库索引（报告中的 recall_on_teacher_index）；
+指定 --dim 后需要用学生模型重建知识库和历史库向量。
+
+用法：
+    python models/all-MiniLM-L6-v2/distill_script.py --layers 4 --output ./models/bge-small-zh-distilled
+"""
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import time
+
+import numpy as np
+import torch
+from torch import nn
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, REPO_ROOT)
+
+from conversation_store import open_conversation_store  # noqa: E402
+from onnx_embeddings import OnnxEmbeddings, QUANTIZE_SETTINGS, quantize_variants  # noqa: E402
+
+MIN_QUERY_CHARS = 4
+SENTENCE_SPLIT = re.compile(r"(?<=[。！？!?；;\n])")
+
+
+# ------------------- 数据 -------------------
+def load_kb_chunks(chroma_dir, collection_name="langchain", batch_size=1000):
+    """分批读取知识库全部切块"""
+    import chromadb
+    collection = chromadb.PersistentClient(path=chroma_dir).get_collection(collection_name)
+    ids = collection.get(include=[])["ids"]
+    chunks = []
+    for offset in range(0, len(ids), batch_size):
+        chunks.extend(collection.get(ids=ids[offset:offset + batch_size], include=["documents"])["documents"])
+    return [c for c in chunks if c and c.strip()]
+
+
+def load_logged_queries(conversations_dir, backend):
+    """对话存储中所有用户提过的问题（去重）"""
+    if not os.path.isdir(conversations_dir):
+        return []
+    store = open_conversation_store(backend, conversations_dir)
+    queries = []
+    seen = set()
+    for username in store.list_users():
+        for session in store.list_sessions(username):
+            data = store.load_session(username, session["session_id"]) or {}
+            for message in data.get("messages", []):
+                text = message.get("content", "").strip()
+                if message.get("role") == "user" and len(text) >= MIN_QUERY_CHARS and text not in seen:
+                    seen.add(text)
+                    queries.append(text)
+    return queries
+
+
+def pseudo_queries(chunks, n, rng):
+    """从切块中抽句子作为伪查询（记录的问题不够时补充）"""
+    sentences = [s.strip() for c in chunks for s in SENTENCE_SPLIT.split(c) if len(s.strip()) >= 8]
+    rng.shuffle(sentences)
+    return [s[:64] for s in sentences[:n]]
+
+
+# ------------------- 学生模型 -------------------
+def build_student(teacher_name, layers, dim, teacher_vectors):
+    """
+    从教师隔层抽取 layers 层；dim > 0 时追加线性降维（PCA 初始化）
+    返回 (学生模型, 降维矩阵或 None)
+    """
+    from sentence_transformers import SentenceTransformer, models
+
+    student = SentenceTransformer(teacher_name, device="cpu")
+    auto_model = student[0].auto_model
+    encoder_layers = auto_model.encoder.layer
+    keep = sorted(set(np.linspace(0, len(encoder_layers) - 1, layers).round().astype(int).tolist()))
+    auto_model.encoder.layer = nn.ModuleList([encoder_layers[i] for i in keep])
+    auto_model.config.num_hidden_layers = len(keep)
+
+    projection = None
+    if dim and dim < teacher_vectors.shape[1]:
+        centered = teacher_vectors - teacher_vectors.mean(axis=0)
+        projection = np.linalg.svd(centered, full_matrices=False)[2][:dim].astype(np.float32)
+        dense = models.Dense(in_features=teacher_vectors.shape[1], out_features=dim, bias=False,
+                             activation_function=nn.Identity())
+        dense.linear.weight.data = torch.from_numpy(projection.copy())
+        student = SentenceTransformer(modules=[student[0], student[1], models.Normalize(), dense, models.Normalize()], device="cpu")
+    return student, projection
+
+
+def _normalize(vectors):
+    return vectors / np.clip(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12, None)
+
+
+def train(student, texts, targets, epochs, batch_size, lr, max_length):
+    """余弦蒸馏：学生句向量逼近（投影后的）教师句向量"""
+    student.max_seq_length = max_length
+    optimizer = torch.optim.AdamW(student.parameters(), lr=lr)
+    steps = epochs * ((len(texts) + batch_size - 1) // batch_size)
+    scheduler = torch.optim.lr_scheduler.LambdaLR(
+        optimizer, lambda step: min(1.0, (step + 1) / max(1, steps // 10)) * max(0.0, 1 - step / max(1, steps)))
+    order = list(range(len(texts)))
+    student.train()
+    for epoch in range(epochs):
+        random.shuffle(order)
+        total, start = 0.0, time.time()
+        for offset in range(0, len(order), batch_size):
+            batch = order[offset:offset + batch_size]
+            features = student.tokenize([texts[i] for i in batch])
+            embeddings = student(features)["sentence_embedding"]
+            embeddings = nn.functional.normalize(embeddings, p=2, dim=1)
+            target = torch.from_numpy(targets[batch])
+            loss = (1 - (embeddings * target).sum(dim=1)).mean()
+            optimizer.zero_grad()
+            loss.backward()
+            torch.nn.utils.clip_grad_norm_(student.parameters(), 1.0)
+            optimizer.step()
+            scheduler.step()
+            total += loss.item() * len(batch)
+        print(f"epoch {epoch + 1}/{epochs}: 余弦距离 {total / len(order):.4f}，用时 {time.time() - start:.0f}s")
+    student.eval()
+
+
+# ------------------- 导出 -------------------
+def export_student(student, output_dir, variants, opset=14):
+    """导出包含池化/降维/归一化的完整句向量模型（输出二维 sentence_embedding）"""
+    onnx_dir = os.path.join(output_dir, "onnx")
+    os.makedirs(onnx_dir, exist_ok=True)
+    model_path = os.path.join(onnx_dir, "model.onnx")
+    sample = student.tokenize(["示例文本"])
+    input_names = [n for n in ("input_ids", "attention_mask", "token_type_ids") if n in sample]
+
+    class SentenceEmbedding(nn.Module):
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, *inputs):
+            return self.model(dict(zip(input_names, inputs)))["sentence_embedding"]
+
+    dynamic_axes = {n: {0: "batch", 1: "sequence"} for n in input_names}
+    dynamic_axes["sentence_embedding"] = {0: "batch"}
+    with torch.no_grad():
+        torch.onnx.export(
+            SentenceEmbedding(student),
+            tuple(sample[n] for n in input_names),
+            model_path,
+            input_names=input_names,
+            output_names=["sentence_embedding"],
+            dynamic_axes=dynamic_axes,
+            opset_version=opset,
+        )
+    return {"model.onnx": model_path, **quantize_variants(model_path, variants)}
+
+
+# ------------------- 评估 -------------------
+def top_k(queries, corpus, k):
+    return np.argsort(-(queries @ corpus.T), axis=1)[:, :k]
+
+
+def recall_at_k(predicted, expected):
+    k = expected.shape[1]
+    return float(np.mean([len(set(p) & set(e)) / k for p, e in zip(predicted, expected)]))
+
+
+def measure_latency(embed, queries, batch_size):
+    """返回 (单条查询延迟中位数 ms, 批量吞吐 条/s)"""
+    embed(queries[:1])  # 预热
+    single = []
+    for q in queries:
+        start = time.perf_counter()
+        embed([q])
+        single.append(time.perf_counter() - start)
+    start = time.perf_counter()
+    for offset in range(0, len(queries), batch_size):
+        embed(queries[offset:offset + batch_size])
+    elapsed = time.perf_counter() - start
+    return float(np.median(single) * 1000), len(queries) / max(elapsed, 1e-9)
+
+
+def _encoder(model, batch_size):
+    return lambda texts: model.encode(texts, batch_size=batch_size, normalize_embeddings=True, convert_to_numpy=True)
+
+
+def retrieval_recall(teacher, student, projection, queries, corpus, teacher_corpus, k, batch_size):
+    """同一批查询在同一语料上，学生 top-k 与教师 top-k 的重合率"""
+    k = min(k, len(corpus))
+    teacher_queries = _encoder(teacher, batch_size)(queries)
+    student_queries = _encoder(student, batch_size)(queries)
+    student_corpus = _encoder(student, batch_size)(corpus)
+    if projection is not None:
+        teacher_queries = _normalize(teacher_queries @ projection.T)
+        teacher_corpus = _normalize(teacher_corpus @ projection.T)
+    expected = top_k(teacher_queries, teacher_corpus, k)
+    result = {
+        "queries": len(queries),
+        "chunks": len(corpus),
+        "recall": recall_at_k(top_k(student_queries, student_corpus, k), expected),
+    }
+    if projection is None:
+        # 学生查询向量直接检索教师建立的现有索引
+        result["recall_on_teacher_index"] = recall_at_k(top_k(student_queries, teacher_corpus, k), expected)
+    return result
+
+
+def evaluate(teacher, student, projection, eval_sets, k, batch_size, onnx_model=None):
+    """
+    eval_sets: {名称: (查询, 语料切块, 教师语料向量)}
+    返回报告：各组 recall@k + 延迟（所有评估查询）+ ONNX 与 PyTorch 学生模型的一致性
+    """
+    report = {"k": k, "dim": int(student.get_sentence_embedding_dimension())}
+    for name, (queries, corpus, teacher_corpus) in eval_sets.items():
+        if queries and corpus:
+            report[name] = retrieval_recall(teacher, student, projection, queries, corpus, teacher_corpus, k,
+                                            batch_size)
+
+    all_queries = [q for queries, _, _ in eval_sets.values() for q in queries]
+    latency = {}
+    for name, model in (("teacher", teacher), ("student", student)):
+        latency[name] = measure_latency(_encoder(model, batch_size), all_queries, batch_size)
+    if onnx_model is not None:
+        latency["student_onnx"] = measure_latency(onnx_model.embed_documents, all_queries, batch_size)
+        onnx_queries = np.asarray(onnx_model.embed_documents(all_queries), dtype=np.float32)
+        student_queries = _encoder(student, batch_size)(all_queries)
+        report["onnx_cosine_to_student"] = float((_normalize(onnx_queries) * student_queries).sum(axis=1).mean())
+    base_ms, base_rate = latency["teacher"]
+    report["latency"] = {
+        name: {"single_ms": ms, "per_second": rate, "speedup": base_ms / max(ms, 1e-9)}
+        for name, (ms, rate) in latency.items()
+    }
+    return report
+
+
+EVAL_SET_TITLES = {
+    "heldout_chunks": "留出切块上的伪查询（查询和语料均未参与训练）",
+    "logged_queries": "留出的记录问题，全部切块（语料含训练切块）",
+}
+
+
+def print_report(report):
+    k = report["k"]
+    print(f"\n评估（学生维度 {report['dim']}）")
+    for name, title in EVAL_SET_TITLES.items():
+        if name not in report:
+            continue
+        r = report[name]
+        print(f"{title}：{r['queries']} 条查询，{r['chunks']} 个切块")
+        print(f"  recall@{k}（学生索引 vs 教师索引）：{r['recall']:.3f}")
+        if "recall_on_teacher_index" in r:
+            print(f"  recall@{k}（学生查询检索现有索引）：{r['recall_on_teacher_index']:.3f}")
+    if "onnx_cosine_to_student" in report:
+        print(f"ONNX 与 PyTorch 学生模型余弦均值：{report['onnx_cosine_to_student']:.4f}")
+    for name, r in report["latency"].items():
+        print(f"{name:>13}: 单条 {r['single_ms']:.1f} ms（{r['speedup']:.1f}x），批量 {r['per_second']:.1f} 条/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CPU 蒸馏领域向量模型")
+    parser.add_argument("--teacher", default="BAAI/bge-small-zh-v1.5")
+    parser.add_argument("--chroma_dir", default=os.path.join(REPO_ROOT, "models", "ruitongkeji"))
+    parser.add_argument("--conversations_dir", default=os.path.join(REPO_ROOT, "conversations"))
+    parser.add_argument("--store", default=os.getenv("CONVERSATION_STORE", "sqlite"), choices=["sqlite", "jsonl"])
+    parser.add_argument("--layers", type=int, default=4, help="学生保留的 Transformer 层数")
+    parser.add_argument("--dim", type=int, default=0, help="学生向量维度（0 表示与教师相同）")
+    parser.add_argument("--epochs", type=int, default=3)
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--lr", type=float, default=5e-5)
+    parser.add_argument("--max_length", type=int, default=256)
+    parser.add_argument("--min_queries", type=int, default=500, help="记录的问题少于这个数时用伪查询补足")
+    parser.add_argument("--eval_fraction", type=float, default=0.1, help="留出不参与训练的切块和记录问题的比例")
+    parser.add_argument("--eval_queries", type=int, default=200, help="从留出切块抽取的伪查询数")
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--threads", type=int, default=0, help="CPU 线程数（0 表示 torch 默认）")
+    parser.add_argument("--variants", nargs="*", default=list(QUANTIZE_SETTINGS), choices=list(QUANTIZE_SETTINGS))
+    parser.add_argument("--no_onnx", action="store_true")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default=os.path.join(REPO_ROOT, "models", "bge-small-zh-distilled"))
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    rng = random.Random(args.seed)
+
+    chunks = load_kb_chunks(args.chroma_dir)
+    queries = load_logged_queries(args.conversations_dir, args.store)
+    print(f"知识库切块 {len(chunks)} 个，记录的问题 {len(queries)} 条")
+    # 按整个切块留出：留出切块不参与训练，训练用的伪查询也只从训练切块中抽取
+    rng.shuffle(chunks)
+    n_eval_chunks = max(1, int(len(chunks) * args.eval_fraction))
+    eval_chunks, train_chunks = chunks[:n_eval_chunks], chunks[n_eval_chunks:]
+    rng.shuffle(queries)
+    n_eval_logged = int(len(queries) * args.eval_fraction)
+    eval_logged, train_queries = queries[:n_eval_logged], queries[n_eval_logged:]
+    if len(train_queries) < args.min_queries:
+        extra = pseudo_queries(train_chunks, args.min_queries - len(train_queries), rng)
+        print(f"补充伪查询 {len(extra)} 条")
+        train_queries += extra
+    eval_pseudo = pseudo_queries(eval_chunks, args.eval_queries, rng)
+    print(f"留出切块 {len(eval_chunks)} 个（伪查询 {len(eval_pseudo)} 条），留出记录问题 {len(eval_logged)} 条")
+
+    from sentence_transformers import SentenceTransformer
+    teacher = SentenceTransformer(args.teacher, device="cpu")
+    train_texts = train_chunks + train_queries
+    print(f"教师编码 {len(train_texts)} 条训练文本...")
+    teacher_vectors = teacher.encode(train_texts, batch_size=args.batch_size, normalize_embeddings=True,
+                                     convert_to_numpy=True, show_progress_bar=True).astype(np.float32)
+
+    student, projection = build_student(args.teacher, args.layers, args.dim, teacher_vectors)
+    targets = teacher_vectors if projection is None else _normalize(teacher_vectors @ projection.T)
+    train(student, train_texts, targets.astype(np.float32), args.epochs, args.batch_size, args.lr, args.max_length)
+
+    os.makedirs(args.output, exist_ok=True)
+    student.save(args.output)
+    onnx_model = None
+    if not args.no_onnx:
+        for name, path in export_student(student, args.output, args.variants).items():
+            print(f"{name}: {path} ({os.path.getsize(path) / 2 ** 20:.1f} MB)")
+        onnx_model = OnnxEmbeddings(args.output, threads=args.threads)
+
+    teacher_eval_chunks = teacher.encode(eval_chunks, batch_size=args.batch_size, normalize_embeddings=True,
+                                         convert_to_numpy=True).astype(np.float32)
+    eval_sets = {
+        "heldout_chunks": (eval_pseudo, eval_chunks, teacher_eval_chunks),
+        "logged_queries": (eval_logged, train_chunks + eval_chunks,
+                           np.concatenate([teacher_vectors[:len(train_chunks)], teacher_eval_chunks])),
+    }
+    report = evaluate(teacher, student, projection, eval_sets, args.k, args.batch_size, onnx_model)
+    report["config"] = {k: v for k, v in vars(args).items() if k not in ("variants",)}
+    with open(os.path.join(args.output, "distill_report.json"), "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print_report(report)
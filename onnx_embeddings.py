@@ -0,0 +1,351 @@
+"""
+ONNX Runtime 向量编码后端
+
+CPU 节点上检索耗时主要花在 PyTorch 编码器上，改用 ONNX Runtime 推理：
+- 模型目录沿用 sentence-transformers 的布局（tokenizer.json、1_Pooling/、onnx/*.onnx），
+  例如 models/all-MiniLM-L6-v2
+- 按 CPU 自动选择量化版本：ARM → model_qint8_arm64，支持 AVX-512 → model_qint8_avx512(_vnni)，
+  AVX2 → model_qint8_avx2，否则用未量化的 model_O4 / model.onnx；Git LFS 指针文件会被跳过
+- 池化方式读取模型自带的 1_Pooling/config.json（MiniLM 为 mean pooling，与 train_script.py 中
+  AutoModelForSentenceEmbedding 一致；bge 为 CLS），有 Normalize 模块时做 L2 归一化，
+  保证与 PyTorch 后端写入向量库的向量一致；导出时已包含池化的模型（输出为二维句向量，
+  如 distill_script.py 蒸馏出的学生模型）直接使用模型输出
+- 提供 embed_query / embed_documents，可直接作为 EmbeddingRegistry 的模型
+
+命令行：
+    # 导出并量化（例如 bge-small-zh）
+    python onnx_embeddings.py export --model BAAI/bge-small-zh-v1.5 --output models/bge-small-zh-v1.5
+    # 与 PyTorch 后端对比余弦一致性和吞吐
+    python onnx_embeddings.py benchmark --model-dir models/bge-small-zh-v1.5 --chroma-dir models/ruitongkeji
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import time
+
+import numpy as np
+
+ONNX_VARIANTS = {
+    "arm64": "model_qint8_arm64.onnx",
+    "avx512_vnni": "model_qint8_avx512_vnni.onnx",
+    "avx512": "model_qint8_avx512.onnx",
+    "avx2": "model_qint8_avx2.onnx",
+}
+UNQUANTIZED_VARIANTS = ("model_O4.onnx", "model.onnx")
+LFS_POINTER_PREFIX = b"version https://git-lfs"
+DEFAULT_MAX_LENGTH = 512
+BENCHMARK_SAMPLE_TEXTS = [
+    "锐瞳智能科技公司主要做什么产品？",
+    "机器视觉光学检测设备的精度能达到多少？",
+    "工业相机和普通相机有什么区别？",
+    "远心镜头适合哪些检测场景？",
+    "大模型在工业质检中有哪些应用？",
+    "How does a telecentric lens reduce perspective error?",
+    "请介绍一下结构光三维测量的原理。",
+    "公司的售后服务流程是怎样的？",
+]
+
+
+def _cpu_flags():
+    try:
+        with open("/proc/cpuinfo", "r") as f:
+            for line in f:
+                if line.startswith("flags"):
+                    return set(line.split(":", 1)[1].split())
+    except OSError:
+        pass
+    return set()
+
+
+def cpu_variant_preference():
+    """按当前 CPU 排好序的量化版本候选"""
+    machine = platform.machine().lower()
+    if machine in ("arm64", "aarch64"):
+        return ["arm64"]
+    flags = _cpu_flags()
+    preference = []
+    if "avx512_vnni" in flags:
+        preference.append("avx512_vnni")
+    if "avx512f" in flags:
+        preference.append("avx512")
+    if "avx2" in flags:
+        preference.append("avx2")
+    return preference
+
+
+def _is_real_model(path):
+    """文件存在且不是未拉取的 Git LFS 指针"""
+    if not os.path.isfile(path):
+        return False
+    with open(path, "rb") as f:
+        return not f.read(len(LFS_POINTER_PREFIX)).startswith(LFS_POINTER_PREFIX)
+
+
+def select_onnx_variant(model_dir):
+    """返回最适合当前 CPU 的 onnx 文件路径；没有可用文件时抛出 FileNotFoundError"""
+    onnx_dir = os.path.join(model_dir, "onnx")
+    candidates = [ONNX_VARIANTS[v] for v in cpu_variant_preference()] + list(UNQUANTIZED_VARIANTS)
+    for name in candidates:
+        path = os.path.join(onnx_dir, name)
+        if _is_real_model(path):
+            return path
+    raise FileNotFoundError(f"{onnx_dir} 中没有可用的 onnx 模型（候选：{', '.join(candidates)}）")
+
+
+def _read_json(path, default=None):
+    if not os.path.exists(path):
+        return default
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _pooling_mode(model_dir):
+    config = _read_json(os.path.join(model_dir, "1_Pooling", "config.json"), {})
+    if config.get("pooling_mode_cls_token"):
+        return "cls"
+    return "mean"
+
+
+def _normalizes(model_dir):
+    modules = _read_json(os.path.join(model_dir, "modules.json"))
+    if modules is None:
+        return True  # 与 AutoModelForSentenceEmbedding 默认 normalize=True 一致
+    return any(m.get("type", "").endswith("Normalize") for m in modules)
+
+
+class OnnxEmbeddings:
+    """ONNX Runtime 句向量编码器（提供 LangChain Embeddings 的 embed_query / embed_documents）"""
+
+    def __init__(self, model_dir, model_file=None, threads=0, max_length=None, pooling=None, normalize=None):
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        self.model_dir = model_dir
+        self.model_file = model_file or select_onnx_variant(model_dir)
+        self.pooling = pooling or _pooling_mode(model_dir)
+        self.normalize = _normalizes(model_dir) if normalize is None else normalize
+        if max_length is None:
+            max_length = _read_json(os.path.join(model_dir, "sentence_bert_config.json"), {}).get(
+                "max_seq_length", DEFAULT_MAX_LENGTH)
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=max_length)
+        self.tokenizer.enable_padding()
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads > 0:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(self.model_file, options, providers=["CPUExecutionProvider"])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        self.model_bytes = os.path.getsize(self.model_file)
+
+    @property
+    def backend_name(self):
+        return f"onnx:{os.path.basename(self.model_file)}"
+
+    def _encode(self, texts):
+        encodings = self.tokenizer.encode_batch(list(texts))
+        input_ids = np.array([e.ids for e in encodings], dtype=np.int64)
+        attention_mask = np.array([e.attention_mask for e in encodings], dtype=np.int64)
+        feeds = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if "token_type_ids" in self.input_names:
+            feeds["token_type_ids"] = np.array([e.type_ids for e in encodings], dtype=np.int64)
+        token_embeddings = self.session.run(None, feeds)[0]
+
+        if token_embeddings.ndim == 2:
+            embeddings = token_embeddings
+        elif self.pooling == "cls":
+            embeddings = token_embeddings[:, 0]
+        else:
+            mask = attention_mask[..., None].astype(np.float32)
+            embeddings = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        if self.normalize:
+            embeddings = embeddings / np.clip(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12, None)
+        return embeddings
+
+    def embed_documents(self, texts):
+        if not texts:
+            return []
+        return self._encode(texts).tolist()
+
+    def embed_query(self, text):
+        return self._encode([text])[0].tolist()
+
+
+# ------------------- 导出与量化 -------------------
+QUANTIZE_SETTINGS = {
+    # 无 VNNI 指令的 x86 上 u8s8 乘加可能饱和，需要 reduce_range
+    "avx2": {"per_channel": False, "reduce_range": True},
+    "avx512": {"per_channel": True, "reduce_range": True},
+    "avx512_vnni": {"per_channel": True, "reduce_range": False},
+    "arm64": {"per_channel": True, "reduce_range": False},
+}
+
+
+def quantize_variants(model_path, variants=tuple(QUANTIZE_SETTINGS)):
+    """在 model_path 同目录下生成各 CPU 的 qint8 动态量化版本，返回 {文件名: 路径}"""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    outputs = {}
+    for variant in variants:
+        path = os.path.join(os.path.dirname(model_path), ONNX_VARIANTS[variant])
+        quantize_dynamic(model_path, path, weight_type=QuantType.QInt8, **QUANTIZE_SETTINGS[variant])
+        outputs[os.path.basename(path)] = path
+    return outputs
+
+
+def export_onnx(model_name, output_dir, variants=tuple(QUANTIZE_SETTINGS), opset=14):
+    """
+    把 sentence-transformers 模型导出为与 models/all-MiniLM-L6-v2 相同的目录布局：
+    模型配置/分词器/池化配置 + onnx/model.onnx + 各 CPU 的 qint8 量化版本
+    """
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    st_model = SentenceTransformer(model_name, device="cpu")
+    st_model.save(output_dir)
+    transformer = st_model[0].auto_model.eval()
+    tokenizer = st_model.tokenizer
+
+    onnx_dir = os.path.join(output_dir, "onnx")
+    os.makedirs(onnx_dir, exist_ok=True)
+    model_path = os.path.join(onnx_dir, "model.onnx")
+    sample = tokenizer(["示例文本"], return_tensors="pt")
+    input_names = [n for n in ("input_ids", "attention_mask", "token_type_ids") if n in sample]
+    dynamic_axes = {n: {0: "batch", 1: "sequence"} for n in input_names}
+    dynamic_axes["token_embeddings"] = {0: "batch", 1: "sequence"}
+
+    class TokenEmbeddings(torch.nn.Module):
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, *inputs):
+            return self.model(**dict(zip(input_names, inputs)))[0]
+
+    with torch.no_grad():
+        torch.onnx.export(
+            TokenEmbeddings(transformer),
+            tuple(sample[n] for n in input_names),
+            model_path,
+            input_names=input_names,
+            output_names=["token_embeddings"],
+            dynamic_axes=dynamic_axes,
+            opset_version=opset,
+        )
+
+    return {"model.onnx": model_path, **quantize_variants(model_path, variants)}
+
+
+# ------------------- 一致性与吞吐 -------------------
+def load_chroma_texts(chroma_dir, limit=256, collection_name="langchain"):
+    """从知识库 Chroma 目录取一批切块作为测试文本"""
+    import chromadb
+    client = chromadb.PersistentClient(path=chroma_dir)
+    return client.get_collection(collection_name).get(limit=limit, include=["documents"])["documents"]
+
+
+def measure_throughput(embed_documents, texts, batch_size=32, repeats=3):
+    """返回 (向量, 每秒编码条数)，取多次运行中最快的一次"""
+    best = None
+    vectors = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        vectors = []
+        for offset in range(0, len(texts), batch_size):
+            vectors.extend(embed_documents(texts[offset:offset + batch_size]))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return np.asarray(vectors, dtype=np.float32), len(texts) / max(best, 1e-9)
+
+
+def parity_report(reference_embed, candidate_embed, texts, batch_size=32, repeats=3):
+    """
+    对比两个编码器：逐条余弦相似度（一致性）和吞吐
+    reference_embed / candidate_embed: texts -> 向量列表（embed_documents）
+    """
+    ref_vectors, ref_rate = measure_throughput(reference_embed, texts, batch_size, repeats)
+    cand_vectors, cand_rate = measure_throughput(candidate_embed, texts, batch_size, repeats)
+    ref_norm = ref_vectors / np.clip(np.linalg.norm(ref_vectors, axis=1, keepdims=True), 1e-12, None)
+    cand_norm = cand_vectors / np.clip(np.linalg.norm(cand_vectors, axis=1, keepdims=True), 1e-12, None)
+    cosine = (ref_norm * cand_norm).sum(axis=1)
+
+    # 检索一致性：以参考向量的最近邻为准，候选编码器的 top-1 是否相同
+    ref_top = np.argsort(-(ref_norm @ ref_norm.T - 2 * np.eye(len(texts))), axis=1)[:, 0]
+    cand_top = np.argsort(-(cand_norm @ ref_norm.T - 2 * np.eye(len(texts))), axis=1)[:, 0]
+    return {
+        "texts": len(texts),
+        "cosine_mean": float(cosine.mean()),
+        "cosine_min": float(cosine.min()),
+        "top1_agreement": float((ref_top == cand_top).mean()) if len(texts) > 1 else 1.0,
+        "reference_per_second": ref_rate,
+        "candidate_per_second": cand_rate,
+        "speedup": cand_rate / max(ref_rate, 1e-9),
+    }
+
+
+def _benchmark(args):
+    from langchain_community.embeddings import HuggingFaceEmbeddings
+
+    texts = BENCHMARK_SAMPLE_TEXTS
+    if args.texts_file:
+        with open(args.texts_file, "r", encoding="utf-8") as f:
+            texts = [line.strip() for line in f if line.strip()]
+    elif args.chroma_dir:
+        texts = load_chroma_texts(args.chroma_dir, limit=args.limit)
+
+    reference = HuggingFaceEmbeddings(model_name=args.reference or args.model_dir)
+    onnx_dir = os.path.join(args.model_dir, "onnx")
+    files = [os.path.join(onnx_dir, f) for f in sorted(os.listdir(onnx_dir))
+             if f.endswith(".onnx") and _is_real_model(os.path.join(onnx_dir, f))]
+    selected = select_onnx_variant(args.model_dir)
+    print(f"测试文本 {len(texts)} 条，当前 CPU 选用 {os.path.basename(selected)}")
+    for path in files:
+        try:
+            candidate = OnnxEmbeddings(args.model_dir, model_file=path, threads=args.threads)
+        except Exception as e:  # 例如 ARM 量化模型在 x86 上无法加载
+            print(f"{os.path.basename(path)}: 加载失败 {e}")
+            continue
+        report = parity_report(reference.embed_documents, candidate.embed_documents, texts,
+                               batch_size=args.batch_size, repeats=args.repeats)
+        print(
+            f"{os.path.basename(path)}: 余弦均值 {report['cosine_mean']:.4f}，最小 {report['cosine_min']:.4f}，"
+            f"top-1 一致率 {report['top1_agreement']:.0%}；"
+            f"PyTorch {report['reference_per_second']:.1f} 条/s，ONNX {report['candidate_per_second']:.1f} 条/s"
+            f"（{report['speedup']:.1f}x）"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ONNX 向量模型导出 / 一致性与吞吐测试")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subparsers.add_parser("export", help="导出并量化 sentence-transformers 模型")
+    export_parser.add_argument("--model", default="BAAI/bge-small-zh-v1.5")
+    export_parser.add_argument("--output", default="./models/bge-small-zh-v1.5")
+    export_parser.add_argument("--variants", nargs="*", default=list(QUANTIZE_SETTINGS),
+                               choices=list(QUANTIZE_SETTINGS))
+    export_parser.add_argument("--overwrite", action="store_true")
+
+    bench_parser = subparsers.add_parser("benchmark", help="与 PyTorch 后端对比余弦一致性和吞吐")
+    bench_parser.add_argument("--model-dir", default="./models/bge-small-zh-v1.5")
+    bench_parser.add_argument("--reference", help="PyTorch 参考模型（默认与 --model-dir 相同）")
+    bench_parser.add_argument("--chroma-dir", help="从知识库取测试文本")
+    bench_parser.add_argument("--texts-file", help="每行一条测试文本")
+    bench_parser.add_argument("--limit", type=int, default=256)
+    bench_parser.add_argument("--batch-size", type=int, default=32)
+    bench_parser.add_argument("--repeats", type=int, default=3)
+    bench_parser.add_argument("--threads", type=int, default=0)
+
+    args = parser.parse_args()
+    if args.command == "export":
+        if os.path.exists(args.output) and not args.overwrite:
+            parser.error(f"{args.output} 已存在（使用 --overwrite 覆盖）")
+        shutil.rmtree(args.output, ignore_errors=True)
+        for name, path in export_onnx(args.model, args.output, args.variants).items():
+            print(f"{name}: {path} ({os.path.getsize(path) / 2 ** 20:.1f} MB)")
+    else:
+        _benchmark(args)
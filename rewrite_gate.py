@@ -0,0 +1,102 @@
+"""
+Query 改写门控
+
+大多数问题本身是完整的，不含指代词或省略，改写后原样返回，白白多一次 API 往返。
+- needs_rewrite：本地规则检测指代（这个/它/上面…）、省略（还有呢/那价格呢…）和过短的追问
+- RewriteGate：只对需要改写的问题调用 LLM，结果按（对话历史指纹，用户问题）缓存
+"""
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+
+REWRITE_CACHE_SIZE = 1024
+SHORT_FOLLOWUP_CHARS = 6  # 去掉标点后不超过这么多字的问题视为追问
+
+# 指代词：出现即可能需要结合上下文补全
+ANAPHORA_PATTERN = re.compile(
+    r"(这个|那个|这些|那些|这款|那款|这种|那种|这里|那里|这边|那边|它们|它|他们|她们|他|她|"
+    r"上面|上述|上文|前面|刚才|刚刚|之前|以上|其中|该产品|该公司|此项|这样|那样)"
+)
+# 省略 / 承接式追问
+ELLIPSIS_PATTERN = re.compile(
+    r"(^(那|那么|还有|然后|另外|其他|其它|再|也|所以|怎么说)|"
+    r"(还有呢|然后呢|呢[？?。]?$))"
+)
+ENGLISH_ANAPHORA_PATTERN = re.compile(r"\b(it|its|this|that|these|those|they|them|above|previous)\b", re.IGNORECASE)
+PUNCTUATION_PATTERN = re.compile(r"[\s，。！？、；：,.!?;:\"'“”‘’（）()【】\[\]…~～-]")
+
+
+def needs_rewrite(user_input):
+    """判断问题是否需要结合上下文改写，返回 (是否需要, 原因)"""
+    text = user_input.strip()
+    if not text:
+        return False, "empty"
+    if ANAPHORA_PATTERN.search(text):
+        return True, "anaphora"
+    if ENGLISH_ANAPHORA_PATTERN.search(text):
+        return True, "anaphora"
+    if ELLIPSIS_PATTERN.search(text):
+        return True, "ellipsis"
+    if len(PUNCTUATION_PATTERN.sub("", text)) <= SHORT_FOLLOWUP_CHARS:
+        return True, "short_followup"
+    return False, "complete"
+
+
+class RewriteGate:
+    """改写门控 + 改写结果缓存（线程安全）"""
+
+    def __init__(self, maxsize=REWRITE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.total = 0
+        self.skipped = 0
+        self.cache_hits = 0
+        self.llm_calls = 0
+
+    @staticmethod
+    def history_fingerprint(history_context):
+        return hashlib.md5((history_context or "").encode("utf-8")).hexdigest()
+
+    def rewrite(self, user_input, history_context, llm_rewrite):
+        """
+        需要改写时调用 llm_rewrite()（返回改写结果或 None），否则直接返回原问题
+        """
+        with self._lock:
+            self.total += 1
+        need, _ = needs_rewrite(user_input)
+        if not need:
+            with self._lock:
+                self.skipped += 1
+            return user_input
+
+        key = (self.history_fingerprint(history_context), user_input)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self.cache_hits += 1
+                return self._cache[key]
+            self.llm_calls += 1
+
+        result = llm_rewrite()
+        if not result:
+            return user_input
+        with self._lock:
+            self._cache[key] = result
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        return result
+
+    def stats(self):
+        with self._lock:
+            saved = self.skipped + self.cache_hits
+            return {
+                "total": self.total,
+                "skipped": self.skipped,
+                "cache_hits": self.cache_hits,
+                "llm_calls": self.llm_calls,
+                "skip_rate": self.skipped / self.total if self.total else 0.0,
+                "hit_rate": self.cache_hits / (self.total - self.skipped) if self.total > self.skipped else 0.0,
+                "saved_calls": saved
+            }
@@ -0,0 +1,150 @@
+"""
+中文分词（词典 Trie + 最少切分）
+
+BM25 和会话关键词匹配共用：
+- 领域词典（公司名、光学/机器视觉术语等）构建前缀树，动态规划求词数最少的切分
+- 英文/数字连续串作为一个词（统一小写）
+- 长词额外输出其中包含的词典子词（检索模式，「工业相机」也能被「相机」命中）
+- 词典外的连续单字可输出字二元组（bigram），比单字倒排更有区分度
+"""
+import hashlib
+import os
+import re
+
+DEFAULT_LEXICON_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "models", "domain_lexicon.txt")
+
+STOPWORDS = {
+    "的", "是", "在", "和", "了", "我", "你", "他", "她", "它", "这", "那", "有", "什么", "怎么", "如何",
+    "吗", "呢", "吧", "啊", "呀", "哦", "与", "及", "或", "也", "都", "就", "还", "又", "被", "把", "给",
+    "对", "从", "到", "为", "以", "之", "其", "个", "请", "一下", "一个", "这个", "那个", "我们", "你们",
+    "他们", "可以", "能够", "哪些", "哪个", "多少", "哪里", "哪儿", "请问", "是否", "以及", "还有"
+}
+CHUNK_PATTERN = re.compile(r"[一-龥a-z0-9]+")
+ALNUM_PATTERN = re.compile(r"[a-z0-9]")
+_WORD_END = "\0"
+
+
+class Segmenter:
+    """基于前缀树的分词器"""
+
+    def __init__(self, words=(), bigrams=True, lexicon_tag="custom"):
+        self.bigrams = bigrams
+        self._trie = {}
+        self._words = set()
+        self.lexicon_tag = lexicon_tag
+        for word in words:
+            self.add_word(word)
+        # 多字停用词也放进词典，保证能被整体切出后再过滤
+        for word in STOPWORDS:
+            if len(word) > 1:
+                self.add_word(word)
+
+    @classmethod
+    def from_file(cls, path=DEFAULT_LEXICON_PATH, bigrams=True):
+        words = []
+        digest = hashlib.md5()
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    word = line.strip()
+                    if word and not word.startswith("#"):
+                        words.append(word)
+                        digest.update(word.encode("utf-8") + b"\n")
+        return cls(words, bigrams=bigrams, lexicon_tag=digest.hexdigest()[:8])
+
+    @property
+    def version(self):
+        """分词器版本标识：词典或参数变化时随之变化（用于判断 BM25 索引是否需要重建）"""
+        return f"trie-v1:{self.lexicon_tag}:{'bigram' if self.bigrams else 'char'}"
+
+    def add_word(self, word):
+        word = word.strip().lower()
+        if not word:
+            return
+        node = self._trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[_WORD_END] = True
+        self._words.add(word)
+
+    def _prefix_words(self, text, start):
+        """text[start:] 开头的所有词典词的结束位置"""
+        ends = []
+        node = self._trie
+        for i in range(start, len(text)):
+            node = node.get(text[i])
+            if node is None:
+                break
+            if _WORD_END in node:
+                ends.append(i + 1)
+        return ends
+
+    def _segment_chunk(self, chunk):
+        """动态规划求词数最少的切分，返回 [(词, 是否词典词), ...]"""
+        n = len(chunk)
+        best = [(0, None, False)] + [(n + 1, None, False)] * n  # (词数, 上一位置, 是否词典词)
+        for i in range(n):
+            cost = best[i][0]
+            if cost > n:
+                continue
+            edges = [(end, True) for end in self._prefix_words(chunk, i)]
+            if ALNUM_PATTERN.match(chunk[i]):
+                end = i + 1
+                while end < n and ALNUM_PATTERN.match(chunk[end]):
+                    end += 1
+                edges.append((end, True))  # 英文/数字串整体作为一个词
+            else:
+                edges.append((i + 1, chunk[i] in self._words))
+            for end, in_dict in edges:
+                # 词数更少优先；词数相同时优先词典词
+                if cost + 1 < best[end][0] or (cost + 1 == best[end][0] and in_dict and not best[end][2]):
+                    best[end] = (cost + 1, i, in_dict)
+
+        pieces = []
+        end = n
+        while end > 0:
+            _, start, in_dict = best[end]
+            pieces.append((chunk[start:end], in_dict))
+            end = start
+        return pieces[::-1]
+
+    def cut(self, text):
+        """精确切分（不去停用词、不展开子词和 bigram）"""
+        words = []
+        for chunk in CHUNK_PATTERN.findall(text.lower()):
+            words.extend(word for word, _ in self._segment_chunk(chunk))
+        return words
+
+    def tokens(self, text):
+        """检索用词项：词典词 + 长词中的子词 + 未登录单字的 bigram，去停用词"""
+        result = []
+        for chunk in CHUNK_PATTERN.findall(text.lower()):
+            unknown_run = []
+            for word, in_dict in self._segment_chunk(chunk) + [("", True)]:
+                if not in_dict and word not in STOPWORDS:
+                    unknown_run.append(word)
+                    continue
+                # 输出之前积累的未登录单字
+                if unknown_run:
+                    if self.bigrams and len(unknown_run) > 1:
+                        result.extend(a + b for a, b in zip(unknown_run, unknown_run[1:])
+                                      if a + b not in STOPWORDS)
+                    else:
+                        result.extend(ch for ch in unknown_run if ch not in STOPWORDS)
+                    unknown_run = []
+                if not word or word in STOPWORDS:
+                    continue
+                result.append(word)
+                if len(word) > 2:
+                    for start in range(len(word) - 1):
+                        result.extend(word[start:end] for end in self._prefix_words(word, start)
+                                      if end - start < len(word))
+        return result
+
+    def keywords(self, text):
+        """查询关键词：长度 >= 2 的检索词项（去重，保持顺序）"""
+        seen = []
+        for token in self.tokens(text):
+            if len(token) >= 2 and token not in STOPWORDS and token not in seen:
+                seen.append(token)
+        return seen
@@ -0,0 +1,110 @@
+"""
+启动耗时分析
+
+记录进程启动时各模块的导入耗时和各资源（向量库、索引、模型）的构建耗时：
+- lazy_module：模块代理，第一次访问属性时才导入（登录页不为用不到的重依赖买单），导入耗时计入分析
+- StartupProfile.measure / timed：记录一段代码或一个资源构建函数的耗时，同名只记录第一次
+- mark：记录里程碑（如「登录页就绪」）距进程开始导入 app.py 的时间
+"""
+import functools
+import importlib
+import threading
+import time
+from contextlib import contextmanager
+
+
+class StartupProfile:
+    """进程级启动耗时记录（线程安全）"""
+
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self._lock = threading.Lock()
+        self._entries = {}  # name -> {"kind", "seconds", "at", "ok"}
+        self._marks = {}  # name -> 距 origin 的秒数
+
+    def record(self, name, seconds, kind="resource", ok=True, started=None):
+        with self._lock:
+            if name in self._entries:
+                return
+            self._entries[name] = {
+                "kind": kind,
+                "seconds": seconds,
+                "at": (started if started is not None else time.perf_counter() - seconds) - self.origin,
+                "ok": ok
+            }
+
+    @contextmanager
+    def measure(self, name, kind="resource"):
+        start = time.perf_counter()
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            self.record(name, time.perf_counter() - start, kind, ok=ok, started=start)
+
+    def timed(self, name):
+        """资源构建函数的装饰器；返回 None 视为不可用"""
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                result = None
+                try:
+                    result = fn(*args, **kwargs)
+                    return result
+                finally:
+                    self.record(name, time.perf_counter() - start, "resource", ok=result is not None, started=start)
+            return wrapper
+        return decorator
+
+    def mark(self, name):
+        with self._lock:
+            self._marks.setdefault(name, time.perf_counter() - self.origin)
+
+    def loaded(self, name):
+        """资源是否已经构建过（用于只在已加载时展示统计，避免展示本身触发加载）"""
+        with self._lock:
+            return name in self._entries
+
+    def report(self):
+        with self._lock:
+            entries = sorted(self._entries.items(), key=lambda item: item[1]["at"])
+            imports = [dict(name=n, **e) for n, e in entries if e["kind"] == "import"]
+            resources = [dict(name=n, **e) for n, e in entries if e["kind"] == "resource"]
+            return {
+                "imports": imports,
+                "resources": resources,
+                "import_seconds": sum(e["seconds"] for e in imports),
+                "resource_seconds": sum(e["seconds"] for e in resources),
+                "marks": dict(self._marks)
+            }
+
+
+STARTUP_PROFILE = StartupProfile()
+
+
+class _LazyModule:
+    """第一次访问属性时导入真正的模块"""
+
+    def __init__(self, name, profile):
+        self._name = name
+        self._profile = profile
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            with self._profile.measure(self._name, "import"):
+                self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        state = "loaded" if self._module is not None else "not loaded"
+        return f"<lazy module {self._name!r} ({state})>"
+
+
+def lazy_module(name, profile=STARTUP_PROFILE):
+    return _LazyModule(name, profile)
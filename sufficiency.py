@@ -0,0 +1,154 @@
+"""
+本地充分性判断
+
+替代「把上下文和问题发给 DeepSeek，让它回答 是/否」的远程调用：
+- 特征：查询与上下文的向量相似度（最大值、均值）、查询关键词在上下文中的覆盖率
+- 打分：一个小型逻辑回归，默认使用手工设定的权重
+- 只有落在不确定区间 [lower, upper] 内时才回退到 LLM 判断，
+  回退得到的 LLM 结论作为标注样本，积累够了之后重新拟合逻辑回归（在线校准）
+"""
+import json
+import os
+import threading
+
+import numpy as np
+
+LOCAL_JUDGE_LOWER = float(os.getenv("LOCAL_JUDGE_LOWER", "0.3"))  # 低于此概率直接判「否」
+LOCAL_JUDGE_UPPER = float(os.getenv("LOCAL_JUDGE_UPPER", "0.7"))  # 高于此概率直接判「是」
+CALIBRATION_MIN_SAMPLES = 30  # 至少积累这么多 LLM 标注样本才重新拟合
+CALIBRATION_REFIT_EVERY = 20  # 每新增这么多样本重新拟合一次
+CALIBRATION_MAX_SAMPLES = 2000
+
+FEATURE_NAMES = ["max_similarity", "mean_similarity", "keyword_coverage"]
+# 默认权重：相似度高、关键词覆盖全 → 足够回答
+DEFAULT_WEIGHTS = [8.0, 2.0, 3.0]
+DEFAULT_BIAS = -8.0
+
+
+def distance_to_similarity(distance):
+    """Chroma 的 L2 距离（归一化向量）转余弦相似度"""
+    return float(min(1.0, max(0.0, 1.0 - distance / 2.0)))
+
+
+def keyword_coverage(keywords, context_text):
+    """查询关键词在上下文中出现的比例；没有关键词时记为 0.5（不提供信息）"""
+    if not keywords:
+        return 0.5
+    context_text = context_text.lower()
+    return sum(1 for kw in keywords if kw in context_text) / len(keywords)
+
+
+class SufficiencyJudge:
+    """带 LLM 回退和在线校准的本地充分性判断器（线程安全）"""
+
+    def __init__(self, path, lower=LOCAL_JUDGE_LOWER, upper=LOCAL_JUDGE_UPPER):
+        self.path = path
+        self.lower = lower
+        self.upper = upper
+        self.weights = np.array(DEFAULT_WEIGHTS, dtype=float)
+        self.bias = DEFAULT_BIAS
+        self._samples = []  # [[features..., label], ...]
+        self._new_samples = 0
+        self._lock = threading.Lock()
+        self.local_decisions = 0
+        self.fallbacks = 0
+        self.fallback_agreements = 0  # 回退时本地倾向与 LLM 结论一致的次数
+        self._load()
+
+    # ------------------- 持久化 -------------------
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self._samples = data.get("samples", [])
+            if data.get("weights"):
+                self.weights = np.array(data["weights"], dtype=float)
+                self.bias = float(data.get("bias", DEFAULT_BIAS))
+        except Exception:
+            pass
+
+    def _save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({
+                "feature_names": FEATURE_NAMES,
+                "weights": self.weights.tolist(),
+                "bias": self.bias,
+                "samples": self._samples[-CALIBRATION_MAX_SAMPLES:]
+            }, f)
+        os.replace(tmp_path, self.path)
+
+    # ------------------- 打分 -------------------
+    def features(self, similarities, keywords, context_text):
+        """similarities: 查询与各上下文片段的相似度列表"""
+        sims = [float(s) for s in similarities] or [0.0]
+        return [max(sims), sum(sims) / len(sims), keyword_coverage(keywords, context_text)]
+
+    def probability(self, features):
+        z = float(np.dot(self.weights, features) + self.bias)
+        return 1.0 / (1.0 + np.exp(-z))
+
+    def _refit(self):
+        """用 LLM 标注样本拟合逻辑回归（带 L2 正则的梯度下降）"""
+        data = np.array(self._samples[-CALIBRATION_MAX_SAMPLES:], dtype=float)
+        X, y = data[:, :-1], data[:, -1]
+        if len(set(y.tolist())) < 2:
+            return
+        w, b = self.weights.copy(), self.bias
+        for _ in range(500):
+            p = 1.0 / (1.0 + np.exp(-(X @ w + b)))
+            grad_w = X.T @ (p - y) / len(y) + 0.01 * w
+            grad_b = float(np.mean(p - y))
+            w -= 0.5 * grad_w
+            b -= 0.5 * grad_b
+        self.weights, self.bias = w, b
+
+    def _record(self, features, label):
+        with self._lock:
+            self._samples.append(list(features) + [1.0 if label else 0.0])
+            self._new_samples += 1
+            if len(self._samples) >= CALIBRATION_MIN_SAMPLES and self._new_samples >= CALIBRATION_REFIT_EVERY:
+                self._refit()
+                self._new_samples = 0
+            try:
+                self._save()
+            except Exception:
+                pass
+
+    # ------------------- 判断 -------------------
+    def decide(self, features, llm_fallback, default):
+        """
+        返回 True/False。概率落在不确定区间时调用 llm_fallback()（返回 True/False/None），
+        LLM 也失败时返回 default
+        """
+        p = self.probability(features)
+        if p >= self.upper or p <= self.lower:
+            with self._lock:
+                self.local_decisions += 1
+            return p >= self.upper
+
+        with self._lock:
+            self.fallbacks += 1
+        result = llm_fallback()
+        if result is None:
+            return default
+        with self._lock:
+            if (p >= 0.5) == result:
+                self.fallback_agreements += 1
+        self._record(features, result)
+        return result
+
+    def stats(self):
+        with self._lock:
+            total = self.local_decisions + self.fallbacks
+            return {
+                "total": total,
+                "local": self.local_decisions,
+                "fallbacks": self.fallbacks,
+                "fallback_rate": self.fallbacks / total if total else 0.0,
+                "agreement_rate": self.fallback_agreements / self.fallbacks if self.fallbacks else 0.0,
+                "samples": len(self._samples),
+                "band": (self.lower, self.upper)
+            }
@@ -0,0 +1,42 @@
+from context_packer import ContextPacker
+
+
+def count_tokens(text):
+    return len(text)
+
+
+def truncate(text, max_tokens):
+    return text[:max_tokens]
+
+
+def test_top_candidate_larger_than_budget_is_truncated_in_first():
+    packer = ContextPacker(count_tokens, truncate, budget=100)
+    candidates = [
+        {"text": "会" * 300, "score": 1.5, "source": "session", "label": "[当前会话上下文]"},
+        {"text": "甲" * 30, "score": 0.6, "source": "knowledge", "label": "[知识库]"},
+        {"text": "乙" * 30, "score": 0.5, "source": "knowledge", "label": "[知识库]"},
+    ]
+
+    packed, report = packer.pack(candidates)
+
+    assert packed[0]["source"] == "session"
+    assert packed[0]["truncated"]
+    assert packed[0]["text"] == "会" * 100
+    assert report["packed_tokens"] <= 100
+    assert report["packed"] == 1
+
+
+def test_rest_is_filled_by_density_after_top_candidate():
+    packer = ContextPacker(count_tokens, truncate, budget=100)
+    candidates = [
+        {"text": "会" * 60, "score": 1.5, "source": "session", "label": "[当前会话上下文]"},
+        {"text": "甲" * 50, "score": 0.9, "source": "knowledge", "label": "[知识库]"},
+        {"text": "乙" * 20, "score": 0.5, "source": "knowledge", "label": "[知识库]"},
+        {"text": "丙" * 20, "score": 0.4, "source": "knowledge", "label": "[知识库]"},
+    ]
+
+    packed, report = packer.pack(candidates)
+
+    assert [c["text"][0] for c in packed] == ["会", "乙", "丙"]
+    assert report["packed_tokens"] == 100
+    assert report["dropped"] == 1
@@ -0,0 +1,175 @@
+"""
+Token 计数服务
+
+替代 `len(text) // 2` 估算和按字符截断：
+- 优先加载本地的 DeepSeek 分词器（tokenizer.json，与线上词表一致），
+  依次尝试 tokenizers 和 transformers；都不可用时退回按 DeepSeek 官方换算比例估算
+  （1 个中文字符约 0.6 token，1 个英文字符约 0.3 token）
+- 分词器文件不随仓库分发，`python token_counter.py download` 从 Hugging Face Hub 下载到默认目录；
+  没有下载时使用的是估算值（stats()["exact"] 为 False）
+- 计数结果按文本做 LRU 缓存；会话消息上还会记录 tokens 字段，每条消息只计算一次
+- truncate 按 token 截断，截断点对齐到原文字符（不会切出半个汉字）
+"""
+import argparse
+import math
+import os
+import re
+import threading
+from collections import OrderedDict
+
+DEFAULT_TOKENIZER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "models", "deepseek_tokenizer")
+TOKEN_CACHE_SIZE = 8192
+CJK_PATTERN = re.compile(r"[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uff00-\uffef]")
+CJK_TOKEN_RATIO = 0.6
+OTHER_TOKEN_RATIO = 0.3
+DEEPSEEK_TOKENIZER_REPO = "deepseek-ai/DeepSeek-V3"  # deepseek-chat 使用的分词器
+TOKENIZER_FILES = ("tokenizer.json", "tokenizer_config.json")
+
+
+def _estimate(text):
+    cjk = len(CJK_PATTERN.findall(text))
+    return int(math.ceil(cjk * CJK_TOKEN_RATIO + (len(text) - cjk) * OTHER_TOKEN_RATIO))
+
+
+class TokenCounter:
+    """线程安全的 token 计数器"""
+
+    def __init__(self, tokenizer_path=DEFAULT_TOKENIZER_PATH, cache_size=TOKEN_CACHE_SIZE):
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._encode = None  # text -> (token 数, 每个 token 在原文中的结束位置)
+        self.backend = "heuristic"
+        self._load(tokenizer_path)
+
+    def _load(self, tokenizer_path):
+        if not tokenizer_path or not os.path.exists(tokenizer_path):
+            return
+        tokenizer_file = tokenizer_path
+        if os.path.isdir(tokenizer_path):
+            tokenizer_file = os.path.join(tokenizer_path, "tokenizer.json")
+        try:
+            from tokenizers import Tokenizer
+            tokenizer = Tokenizer.from_file(tokenizer_file)
+
+            def encode(text):
+                encoding = tokenizer.encode(text, add_special_tokens=False)
+                return len(encoding.ids), [end for _, end in encoding.offsets]
+
+            self._encode = encode
+            self.backend = "tokenizers"
+            return
+        except Exception:
+            pass
+        try:
+            from transformers import AutoTokenizer
+            tokenizer = AutoTokenizer.from_pretrained(
+                tokenizer_path if os.path.isdir(tokenizer_path) else os.path.dirname(tokenizer_path)
+            )
+
+            def encode(text):
+                encoding = tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)
+                return len(encoding["input_ids"]), [end for _, end in encoding["offset_mapping"]]
+
+            self._encode = encode
+            self.backend = "transformers"
+        except Exception:
+            pass
+
+    @property
+    def name(self):
+        """计数方式标识，随计数写入消息；换了分词器后旧计数自动失效"""
+        return f"deepseek-{self.backend}" if self._encode else "heuristic-v1"
+
+    def count(self, text):
+        if not text:
+            return 0
+        with self._lock:
+            if text in self._cache:
+                self._cache.move_to_end(text)
+                self.hits += 1
+                return self._cache[text]
+            self.misses += 1
+        n = self._encode(text)[0] if self._encode else _estimate(text)
+        with self._lock:
+            self._cache[text] = n
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return n
+
+    def truncate(self, text, max_tokens):
+        """截取前 max_tokens 个 token 对应的原文"""
+        if not text or max_tokens <= 0:
+            return ""
+        if self.count(text) <= max_tokens:
+            return text
+        if self._encode:
+            _, ends = self._encode(text)
+            return text[:ends[max_tokens - 1]]
+        used = 0.0
+        for i, ch in enumerate(text):
+            used += CJK_TOKEN_RATIO if CJK_PATTERN.match(ch) else OTHER_TOKEN_RATIO
+            if used > max_tokens:
+                return text[:i]
+        return text
+
+    def message_tokens(self, message):
+        """
+        消息的 token 数，记录在消息的 tokens 字段上（随会话保存，每条消息只计算一次）
+        计数方式或内容长度变化（如被编辑）时重新计算
+        """
+        content = message.get("content", "")
+        cached = message.get("tokens")
+        if cached and cached.get("counter") == self.name and cached.get("chars") == len(content):
+            return cached["count"]
+        n = self.count(content)
+        message["tokens"] = {"count": n, "counter": self.name, "chars": len(content)}
+        return n
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "backend": self.name,
+                "exact": self._encode is not None,
+                "cached": len(self._cache),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0
+            }
+
+
+def download_tokenizer(output_dir=DEFAULT_TOKENIZER_PATH, repo_id=DEEPSEEK_TOKENIZER_REPO):
+    """从 Hugging Face Hub 下载 DeepSeek 分词器文件（只下载分词器，不下载模型权重；可用 HF_ENDPOINT 指定镜像）"""
+    from huggingface_hub import hf_hub_download
+
+    os.makedirs(output_dir, exist_ok=True)
+    for filename in TOKENIZER_FILES:
+        hf_hub_download(repo_id, filename, local_dir=output_dir)
+    return output_dir
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="DeepSeek 分词器下载 / token 计数")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    download_parser = subparsers.add_parser("download", help="下载 DeepSeek 分词器到本地")
+    download_parser.add_argument("--repo", default=DEEPSEEK_TOKENIZER_REPO)
+    download_parser.add_argument("--output", default=DEFAULT_TOKENIZER_PATH)
+
+    count_parser = subparsers.add_parser("count", help="统计文本的 token 数")
+    count_parser.add_argument("text")
+    count_parser.add_argument("--tokenizer", default=DEFAULT_TOKENIZER_PATH)
+
+    args = parser.parse_args()
+    if args.command == "download":
+        path = download_tokenizer(args.output, args.repo)
+        counter = TokenCounter(path)
+        print(f"{path}: {counter.name}")
+        if not counter.stats()["exact"]:
+            print("警告：分词器加载失败（需要安装 tokenizers 或 transformers），仍在使用估算")
+    else:
+        counter = TokenCounter(args.tokenizer)
+        print(f"{counter.count(args.text)} ({counter.name})")
@@ -0,0 +1,108 @@
+"""
+单轮对话并发流水线
+
+把一轮对话拆成若干阶段（会话摘要、Query 改写、知识库检索、历史检索…），
+按声明的依赖关系调度：互不依赖的阶段在线程池中并行执行，
+每个阶段记录开始/结束时间，便于分析首字延迟（TTFT）。
+"""
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+try:
+    from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+except ImportError:
+    add_script_run_ctx = get_script_run_ctx = None
+
+TURN_PIPELINE_WORKERS = int(os.getenv("TURN_PIPELINE_WORKERS", "8"))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_pipeline_executor():
+    """进程共享的线程池（惰性创建）"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=TURN_PIPELINE_WORKERS, thread_name_prefix="turn")
+        return _executor
+
+
+class TurnPipeline:
+    """
+    按依赖并发执行的阶段集合
+
+    用法：
+        pipeline = TurnPipeline()
+        pipeline.add_stage("rewrite", rewrite_fn, deps=("history_context",))
+        results = pipeline.run()
+
+    阶段函数以依赖阶段的名称为关键字参数接收其结果；
+    阶段抛出异常时结果记为 None，异常保存在 errors 中，不影响其他阶段。
+    """
+
+    def __init__(self):
+        self._stages = {}  # name -> (fn, deps)
+        self.results = {}
+        self.errors = {}
+        self.timings = {}  # name -> {"start": 秒, "end": 秒, "duration": 秒}（相对 run() 开始）
+        self.total_time = 0.0
+
+    def add_stage(self, name, fn, deps=()):
+        """声明一个阶段，依赖必须已声明（保证无环）"""
+        if name in self._stages:
+            raise ValueError(f"阶段重复声明: {name}")
+        missing = [d for d in deps if d not in self._stages]
+        if missing:
+            raise ValueError(f"阶段 {name} 依赖未声明的阶段: {missing}")
+        self._stages[name] = (fn, tuple(deps))
+        return self
+
+    def _run_stage(self, name, fn, kwargs, ctx, t0):
+        # 让工作线程可以调用 st.warning 等 Streamlit API
+        if ctx is not None and add_script_run_ctx is not None:
+            add_script_run_ctx(threading.current_thread(), ctx)
+        start = time.perf_counter()
+        try:
+            return fn(**kwargs)
+        finally:
+            end = time.perf_counter()
+            self.timings[name] = {"start": start - t0, "end": end - t0, "duration": end - start}
+
+    def run(self):
+        """执行所有阶段，返回 {阶段名: 结果}"""
+        ctx = get_script_run_ctx() if get_script_run_ctx is not None else None
+        executor = get_pipeline_executor()
+        t0 = time.perf_counter()
+        pending = dict(self._stages)
+        running = {}
+
+        while pending or running:
+            ready = [name for name, (_, deps) in pending.items()
+                     if all(d in self.results for d in deps)]
+            for name in ready:
+                fn, deps = pending.pop(name)
+                kwargs = {d: self.results[d] for d in deps}
+                future = executor.submit(self._run_stage, name, fn, kwargs, ctx, t0)
+                running[future] = name
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    self.results[name] = future.result()
+                except Exception as e:
+                    self.errors[name] = e
+                    self.results[name] = None
+
+        self.total_time = time.perf_counter() - t0
+        return self.results
+
+    def timing_report(self):
+        """按开始时间排序的阶段耗时列表"""
+        return [
+            {"stage": name, **timing}
+            for name, timing in sorted(self.timings.items(), key=lambda x: x[1]["start"])
+        ]
@@ -0,0 +1,134 @@
+"""
+启动预热与就绪探针
+
+部署后的第一个用户要为模型加载、第一次分词、Chroma HNSW 加载、BM25 索引构建、
+与 DeepSeek API 的第一次 TLS 握手买单。进程启动后在后台线程依次执行预热步骤：
+- 每一步记录耗时和异常；标记为 required 的步骤全部成功后进程才算「就绪」
+- 就绪状态通过两种方式暴露给负载均衡：
+  * HTTP 探针（设置 WARMUP_HEALTH_PORT 后启用，默认只监听 127.0.0.1）：GET 任意路径，就绪返回 200，
+    否则 503（JSON 中附各步骤状态）
+  * 就绪文件：WARMUP_READY_FILE，就绪后写入（含 pid 和各步骤耗时），开始预热时和进程退出时删除
+"""
+import atexit
+import json
+import os
+import threading
+import time
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WARMUP_HEALTH_PORT = int(os.getenv("WARMUP_HEALTH_PORT", "0"))  # 默认不启动 HTTP 探针，设置端口后才监听
+WARMUP_HEALTH_HOST = os.getenv("WARMUP_HEALTH_HOST", "127.0.0.1")  # 默认只监听本机；探针返回 pid 和错误信息，不做鉴权
+WARMUP_READY_FILE = os.getenv("WARMUP_READY_FILE", "")  # 为空表示不写就绪文件
+
+
+class Warmup:
+    """按顺序执行预热步骤的后台任务（每个进程一个）"""
+
+    def __init__(self, ready_file=WARMUP_READY_FILE, port=WARMUP_HEALTH_PORT, host=WARMUP_HEALTH_HOST):
+        self.ready_file = ready_file
+        self.port = port
+        self.host = host
+        self._steps = []
+        self._status = {}  # name -> {"state", "seconds", "error", "required"}
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self.started_at = None
+        self.finished_at = None
+        self.server_error = None
+        self._server = None
+
+    def add_step(self, name, fn, required=False):
+        self._steps.append((name, fn, required))
+        self._status[name] = {"state": "pending", "seconds": None, "error": None, "required": required}
+        return self
+
+    def start(self):
+        self.started_at = time.time()
+        self._remove_ready_file()
+        atexit.register(self._remove_ready_file)
+        if self.port:
+            self._start_server()
+        threading.Thread(target=self._run, name="warmup", daemon=True).start()
+        return self
+
+    def _run(self):
+        for name, fn, _ in self._steps:
+            with self._lock:
+                self._status[name]["state"] = "running"
+            start = time.perf_counter()
+            try:
+                fn()
+                state, error = "ok", None
+            except Exception as e:
+                state, error = "failed", f"{type(e).__name__}: {e}"
+                traceback.print_exc()
+            with self._lock:
+                self._status[name].update(state=state, seconds=time.perf_counter() - start, error=error)
+        self.finished_at = time.time()
+        self._done.set()
+        if self.ready:
+            self._write_ready_file()
+
+    @property
+    def ready(self):
+        if not self._done.is_set():
+            return False
+        with self._lock:
+            return all(s["state"] == "ok" for s in self._status.values() if s["required"])
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def status(self):
+        with self._lock:
+            steps = [dict(name=name, **self._status[name]) for name, _, _ in self._steps]
+        finished = self.finished_at is not None
+        return {
+            "ready": self.ready,
+            "finished": finished,
+            "pid": os.getpid(),
+            "elapsed": (self.finished_at if finished else time.time()) - self.started_at if self.started_at else 0.0,
+            "steps": steps,
+            "server_error": self.server_error
+        }
+
+    # ------------------- 就绪文件 -------------------
+    def _write_ready_file(self):
+        if not self.ready_file:
+            return
+        tmp_path = f"{self.ready_file}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.status(), f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.ready_file)
+
+    def _remove_ready_file(self):
+        if self.ready_file and os.path.exists(self.ready_file):
+            try:
+                os.remove(self.ready_file)
+            except OSError:
+                pass
+
+    # ------------------- HTTP 探针 -------------------
+    def _start_server(self):
+        warmup = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = json.dumps(warmup.status(), ensure_ascii=False).encode("utf-8")
+                self.send_response(200 if warmup.ready else 503)
+                self.send_header("Content-Type", "application/json; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # 探针很频繁，不写访问日志
+
+        try:
+            self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        except OSError as e:
+            self.server_error = f"端口 {self.port} 不可用: {e}"
+            return
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="warmup-probe", daemon=True).start()